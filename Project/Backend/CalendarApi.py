@@ -1,21 +1,36 @@
 import os
-import json
 import re
 from datetime import datetime
 from typing import Optional
 
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, ORJSONResponse
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
+from pagination import decode_cursor, encode_cursor, event_upstream_mask, parse_fields, query_scope
+
 app = FastAPI()
 
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
 
+DEFAULT_EVENT_PAGE_SIZE = 10
+MAX_EVENT_PAGE_SIZE = 250
+EVENT_FIELDS = ("id", "summary", "start_time", "end_time", "meeting_link", "organizer")
+DEFAULT_EVENT_FIELDS = ("summary", "start_time", "meeting_link", "organizer")
+# Upstream fields behind each output field
+EVENT_UPSTREAM_FIELDS = {
+    "id": "id",
+    "summary": "summary",
+    "start_time": "start",
+    "end_time": "end",
+    "meeting_link": "hangoutLink,description,location",
+    "organizer": "organizer/email",
+}
+
 
 # 🔐 Extract meeting links (Google Meet, Zoom, Teams)
 def extract_meeting_link(text):
@@ -63,25 +78,36 @@ def authorize():
 # ------------------ API: Get Calendar Events ------------------
 
 @app.get("/events")
-def get_calendar_events():
+def get_calendar_events(
+    limit: int = Query(default=DEFAULT_EVENT_PAGE_SIZE, ge=1, le=MAX_EVENT_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    fields: Optional[str] = Query(default=None, description=f"Comma-separated subset of: {', '.join(EVENT_FIELDS)}"),
+):
+    selected = parse_fields(fields, EVENT_FIELDS, DEFAULT_EVENT_FIELDS)
+    scope = query_scope("events", limit)
+    position = decode_cursor(cursor, scope) or {}
     try:
         creds = authenticate_calendar()
         service = build('calendar', 'v3', credentials=creds)
 
-        now = datetime.utcnow().isoformat() + 'Z'
+        # Later pages must repeat the first page's timeMin for the page token to stay valid
+        now = position.get("m") or datetime.utcnow().isoformat() + 'Z'
         results = service.events().list(
             calendarId='primary',
             timeMin=now,
-            maxResults=10,
+            maxResults=limit,
+            pageToken=position.get("p"),
             singleEvents=True,
-            orderBy='startTime'
+            orderBy='startTime',
+            fields=f"items({event_upstream_mask(selected, EVENT_UPSTREAM_FIELDS)}),nextPageToken"
         ).execute()
 
         events = results.get('items', [])
         output = []
 
         for event in events:
-            start = event['start'].get('dateTime', event['start'].get('date'))
+            start = event.get('start', {})
+            end = event.get('end', {})
             summary = event.get('summary', 'No Title')
             description = event.get('description', '')
             location = event.get('location', '')
@@ -90,14 +116,19 @@ def get_calendar_events():
 
             meeting_link = hangout or extract_meeting_link(description) or location
 
-            output.append({
+            record = {
+                "id": event.get('id', ''),
                 "summary": summary,
-                "start_time": start,
+                "start_time": start.get('dateTime', start.get('date')),
+                "end_time": end.get('dateTime', end.get('date')),
                 "meeting_link": meeting_link,
                 "organizer": organizer
-            })
+            }
+            output.append({f: record[f] for f in selected})
 
-        return JSONResponse(content={"events": output})
+        page_token = results.get('nextPageToken')
+        next_cursor = encode_cursor(scope, {"p": page_token, "m": now}) if page_token else None
+        return ORJSONResponse(content={"events": output, "next_cursor": next_cursor})
 
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
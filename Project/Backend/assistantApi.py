@@ -5,12 +5,14 @@ from datetime import datetime
 from typing import Optional
 
 from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, RedirectResponse
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from pagination import decode_cursor, encode_cursor, event_upstream_mask, parse_fields, query_scope
+
 app = FastAPI()
 
 # Configuration
@@ -24,6 +26,26 @@ CALENDAR_SCOPE = ["https://www.googleapis.com/auth/calendar.readonly"]
 GMAIL_PORT = 8080  # For Gmail auth
 CALENDAR_PORT = 8082  # Changed from 8081 to avoid conflicts
 
+# Page sizes and the fields a caller may project to
+DEFAULT_EMAIL_PAGE_SIZE = 20
+MAX_EMAIL_PAGE_SIZE = 100  # every message on a page costs a messages.get
+EMAIL_FIELDS = ("id", "thread_id", "from", "date", "subject", "snippet")
+DEFAULT_EMAIL_FIELDS = ("subject", "snippet")
+EMAIL_HEADERS = {"from": "From", "date": "Date", "subject": "Subject"}
+DEFAULT_EVENT_PAGE_SIZE = 10
+MAX_EVENT_PAGE_SIZE = 250
+EVENT_FIELDS = ("id", "summary", "start_time", "end_time", "meeting_link", "organizer")
+DEFAULT_EVENT_FIELDS = ("summary", "start_time", "meeting_link", "organizer")
+# Upstream fields behind each output field
+EVENT_UPSTREAM_FIELDS = {
+    "id": "id",
+    "summary": "summary",
+    "start_time": "start",
+    "end_time": "end",
+    "meeting_link": "hangoutLink,description,location",
+    "organizer": "organizer/email",
+}
+
 # ------------------ Helper Functions ------------------
 
 def extract_meeting_link(text: str) -> Optional[str]:
@@ -224,26 +246,62 @@ def authorize_both():
 # ------------------ 🌐 /email ------------------
 
 @app.get("/email")
-def read_gmail(filters: Optional[str] = Query(default="newer_than:2d is:unread")):
+def read_gmail(
+    filters: Optional[str] = Query(default="newer_than:2d is:unread"),
+    limit: int = Query(default=DEFAULT_EMAIL_PAGE_SIZE, ge=1, le=MAX_EMAIL_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    fields: Optional[str] = Query(default=None, description=f"Comma-separated subset of: {', '.join(EMAIL_FIELDS)}"),
+):
+    selected = parse_fields(fields, EMAIL_FIELDS, DEFAULT_EMAIL_FIELDS)
+    scope = query_scope("email", filters, limit)
+    position = decode_cursor(cursor, scope) or {}
     try:
         creds = authenticate_gmail()
         service = build('gmail', 'v1', credentials=creds)
 
-        results = service.users().messages().list(userId='me', q=filters).execute()
+        results = service.users().messages().list(
+            userId='me',
+            q=filters,
+            maxResults=limit,
+            pageToken=position.get("p"),
+            fields="messages/id,nextPageToken"
+        ).execute()
         messages = results.get('messages', [])
 
+        # Fetch only the metadata the requested fields need; ids alone come from the listing
+        headers = [EMAIL_HEADERS[f] for f in selected if f in EMAIL_HEADERS]
+        mask = ["id"]
+        if "thread_id" in selected:
+            mask.append("threadId")
+        if "snippet" in selected:
+            mask.append("snippet")
+        if headers:
+            mask.append("payload/headers")
+
         output = []
         for msg in messages:
-            msg_data = service.users().messages().get(userId='me', id=msg['id']).execute()
-            headers = msg_data['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            snippet = msg_data.get('snippet', '')
-            output.append({
-                "subject": subject,
-                "snippet": snippet
-            })
-
-        return JSONResponse(content={"emails": output})
+            msg_data = msg
+            if len(mask) > 1:
+                msg_data = service.users().messages().get(
+                    userId='me',
+                    id=msg['id'],
+                    format='metadata',
+                    metadataHeaders=headers,
+                    fields=",".join(mask)
+                ).execute()
+            found = {h['name']: h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
+            record = {
+                "id": msg['id'],
+                "thread_id": msg_data.get('threadId', ''),
+                "snippet": msg_data.get('snippet', ''),
+            }
+            for field, header in EMAIL_HEADERS.items():
+                record[field] = found.get(header, 'No Subject' if field == "subject" else '')
+            output.append({f: record[f] for f in selected})
+
+        page_token = results.get('nextPageToken')
+        next_cursor = encode_cursor(scope, {"p": page_token}) if page_token else None
+        return ORJSONResponse(content={"emails": output, "next_cursor": next_cursor})
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -251,25 +309,36 @@ def read_gmail(filters: Optional[str] = Query(default="newer_than:2d is:unread")
 # ------------------ 🌐 /calendar ------------------
 
 @app.get("/calendar")
-def get_calendar_events():
+def get_calendar_events(
+    limit: int = Query(default=DEFAULT_EVENT_PAGE_SIZE, ge=1, le=MAX_EVENT_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    fields: Optional[str] = Query(default=None, description=f"Comma-separated subset of: {', '.join(EVENT_FIELDS)}"),
+):
+    selected = parse_fields(fields, EVENT_FIELDS, DEFAULT_EVENT_FIELDS)
+    scope = query_scope("calendar", limit)
+    position = decode_cursor(cursor, scope) or {}
     try:
         creds = authenticate_calendar()
         service = build('calendar', 'v3', credentials=creds)
 
-        now = datetime.utcnow().isoformat() + 'Z'
+        # Later pages must repeat the first page's timeMin for the page token to stay valid
+        now = position.get("m") or datetime.utcnow().isoformat() + 'Z'
         results = service.events().list(
             calendarId='primary',
             timeMin=now,
-            maxResults=10,
+            maxResults=limit,
+            pageToken=position.get("p"),
             singleEvents=True,
-            orderBy='startTime'
+            orderBy='startTime',
+            fields=f"items({event_upstream_mask(selected, EVENT_UPSTREAM_FIELDS)}),nextPageToken"
         ).execute()
 
         events = results.get('items', [])
         output = []
 
         for event in events:
-            start = event['start'].get('dateTime', event['start'].get('date'))
+            start = event.get('start', {})
+            end = event.get('end', {})
             summary = event.get('summary', 'No Title')
             description = event.get('description', '')
             location = event.get('location', '')
@@ -278,14 +347,19 @@ def get_calendar_events():
 
             meeting_link = hangout or extract_meeting_link(description) or location
 
-            output.append({
+            record = {
+                "id": event.get('id', ''),
                 "summary": summary,
-                "start_time": start,
+                "start_time": start.get('dateTime', start.get('date')),
+                "end_time": end.get('dateTime', end.get('date')),
                 "meeting_link": meeting_link,
                 "organizer": organizer
-            })
+            }
+            output.append({f: record[f] for f in selected})
 
-        return JSONResponse(content={"events": output})
+        page_token = results.get('nextPageToken')
+        next_cursor = encode_cursor(scope, {"p": page_token, "m": now}) if page_token else None
+        return ORJSONResponse(content={"events": output, "next_cursor": next_cursor})
 
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
@@ -1,17 +1,50 @@
 import os
+import copy
 import json
 import re
-from datetime import datetime
+import heapq
+import time
+import uuid
+import base64
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
-from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+import httplib2
+from cachetools import LRUCache, TTLCache
+
+from fastapi import FastAPI, Query, HTTPException, Request as HTTPRequest, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, RedirectResponse
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-app = FastAPI()
+from pagination import decode_cursor, encode_cursor, event_upstream_mask, parse_fields, query_scope
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app):
+    renewal = asyncio.create_task(watch_renewal_loop())
+    if os.path.exists(GMAIL_TOKEN_FILE) or os.path.exists(CALENDAR_TOKEN_FILE):
+        prefetcher.register(DEFAULT_USER)
+    prefetching = asyncio.create_task(prefetcher.run())
+    yield
+    prefetching.cancel()
+    renewal.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configuration
 CREDENTIALS_FILE = "credentials.json"
@@ -25,6 +58,16 @@ COMBINED_SCOPES = [
     "https://www.googleapis.com/auth/calendar.readonly"
 ]
 
+DEFAULT_EMAIL_QUERY = "newer_than:2d is:unread"
+# Token files hold a single account, so the service has one user
+DEFAULT_USER = "default"
+
+# Calendar fan-out
+CALENDAR_LIST_TTL = 900  # seconds
+CALENDAR_FETCH_WORKERS = 8
+calendar_list_cache = TTLCache(maxsize=64, ttl=CALENDAR_LIST_TTL)
+calendar_pool = ThreadPoolExecutor(max_workers=CALENDAR_FETCH_WORKERS, thread_name_prefix="calendar")
+
 # Update your port assignments
 GMAIL_PORT = 8080  # For Gmail auth
 CALENDAR_PORT = 8082  # Changed from 8081 to avoid conflicts
@@ -55,6 +98,778 @@ def check_credentials_file():
             detail=f"Invalid JSON in '{CREDENTIALS_FILE}'. Please check the file format."
         )
 
+def list_calendars(creds):
+    """Return the user's selected calendars (cached)."""
+    key = creds.refresh_token or creds.token
+    with cache_lock:
+        cached = calendar_list_cache.get(key)
+    if cached is not None:
+        return cached
+
+    service = build('calendar', 'v3', credentials=creds)
+    calendars = []
+    page_token = None
+    while True:
+        response = execute(service.calendarList().list(
+            minAccessRole="reader",
+            pageToken=page_token,
+            fields="items(id,summary,summaryOverride,primary,selected),nextPageToken"
+        ))
+        for item in response.get("items", []):
+            if item.get("primary") or item.get("selected"):
+                calendars.append({
+                    "id": item["id"],
+                    "name": item.get("summaryOverride") or item.get("summary") or item["id"],
+                })
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+    calendars = calendars or [{"id": "primary", "name": "primary"}]
+    with cache_lock:
+        calendar_list_cache[key] = calendars
+    return calendars
+
+def fetch_calendar_events(creds, calendar, time_min, max_results, fields=None):
+    """
+    Fetch upcoming events of one calendar; each worker builds its own (non thread-safe) client.
+
+    fields is a partial-response mask for the event items; the store answers with full events.
+    """
+    if calendar_store_usable(calendar["id"]):
+        # Push notifications or prefetch keep the store current, so no upstream call is needed
+        with cache_lock:
+            stored = list(calendar_store[calendar["id"]]["events"].values())
+        now = datetime.fromisoformat(time_min.replace('Z', '+00:00')).timestamp()
+        upcoming = sorted((e for e in stored if event_start_key({"start": e["end"]}) > now), key=event_start_key)
+        events = [dict(e, _calendar=calendar["name"]) for e in upcoming[:max_results]]
+        return events
+
+    service = build('calendar', 'v3', credentials=creds)
+    results = execute(service.events().list(
+        calendarId=calendar["id"],
+        timeMin=time_min,
+        maxResults=max_results,
+        singleEvents=True,
+        orderBy='startTime',
+        fields=f"items({fields})" if fields else None
+    ))
+    events = results.get('items', [])
+    for event in events:
+        event["_calendar"] = calendar["name"]
+    return events
+
+def event_start_key(event):
+    """Sort key for merging: event start as a UTC epoch."""
+    start = event['start'].get('dateTime') or event['start'].get('date')
+    dt = datetime.fromisoformat(start)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def merge_calendar_events(streams, limit):
+    """K-way merge of sorted per-calendar streams, skipping events shared between calendars."""
+    seen = set()
+    merged = []
+    for event in heapq.merge(*streams, key=event_start_key):
+        start = event['start'].get('dateTime') or event['start'].get('date')
+        identity = (event.get('iCalUID') or event.get('id'), start)
+        if identity in seen:
+            continue
+        seen.add(identity)
+        merged.append(event)
+        if len(merged) >= limit:
+            break
+    return merged
+
+# ------------------ Pagination & Projection ------------------
+DEFAULT_EMAIL_PAGE_SIZE = 20
+MAX_EMAIL_PAGE_SIZE = 100  # every message on a page may cost a messages.get
+DEFAULT_EVENT_PAGE_SIZE = 10
+MAX_EVENT_PAGE_SIZE = 250
+
+EMAIL_FIELDS = ("id", "thread_id", "from", "date", "subject", "snippet")
+DEFAULT_EMAIL_FIELDS = ("subject", "snippet")
+EMAIL_HEADERS = {"from": "From", "date": "Date", "subject": "Subject"}
+
+EVENT_FIELDS = ("id", "summary", "start_time", "end_time", "meeting_link", "organizer", "calendar")
+DEFAULT_EVENT_FIELDS = ("summary", "start_time", "meeting_link", "organizer", "calendar")
+# Upstream fields behind each output field; id, iCalUID and start are always needed to merge and page
+EVENT_UPSTREAM_FIELDS = {
+    "summary": "summary",
+    "end_time": "end",
+    "meeting_link": "hangoutLink,description,location",
+    "organizer": "organizer/email",
+}
+
+# ------------------ Push Notifications & Caches ------------------
+# Gmail watch needs a Pub/Sub topic; Calendar channels need a public HTTPS base URL
+GMAIL_PUBSUB_TOPIC = os.environ.get("GMAIL_PUBSUB_TOPIC")
+WEBHOOK_BASE_URL = os.environ.get("WEBHOOK_BASE_URL")
+PUSH_VERIFICATION_TOKEN = os.environ.get("PUSH_VERIFICATION_TOKEN")
+CALENDAR_WATCH_TTL = 7 * 24 * 3600  # seconds, the maximum Google allows
+WATCH_RENEW_MARGIN = 12 * 3600  # renew watches expiring within this many seconds
+WATCH_RENEW_INTERVAL = 3600  # seconds between renewal passes
+CALENDAR_SYNC_LOOKBACK_DAYS = 1
+# Listings the inbox watch does not cover are served for this long, or for the user's
+# prefetch interval when that is longer (prefetch refreshes them before they go stale)
+CACHE_MAX_AGE = 120  # seconds
+# The watch only reports inbox changes, and relative dates drift without any change at all
+INBOX_QUERY_RE = re.compile(r'(?<![-\w])(?:in|label):inbox\b', re.IGNORECASE)
+UNWATCHED_QUERY_RE = re.compile(r'\b(?:newer_than|older_than|newer|older):|\bor\b|[{}]', re.IGNORECASE)
+
+cache_lock = threading.RLock()
+message_cache = LRUCache(maxsize=5000)  # message id -> the EMAIL_FIELDS fetched for it so far
+email_query_cache = {}  # (Gmail query, page token, page size) -> (fetched_at, [message ids], next page token)
+calendar_store = {}  # calendar id -> {"events": {event id: event}, "sync_token": str, "synced_at": float}
+watch_state = {"gmail": None, "calendars": {}}  # active watches and their expirations
+
+def _watch_live(watch):
+    return bool(watch) and watch["expiration"] > time.time()
+
+def gmail_push_active():
+    """True while a Gmail watch is live, so cached listings can be trusted."""
+    return _watch_live(watch_state["gmail"])
+
+def calendar_push_active(calendar_id):
+    """True while a channel for the calendar is live and the local store is synced."""
+    with cache_lock:
+        synced = bool(calendar_store.get(calendar_id, {}).get("sync_token"))
+        watch = watch_state["calendars"].get(calendar_id)
+    return synced and _watch_live(watch)
+
+def push_covers_query(query):
+    """True if every change that can alter the query's results is reported by the inbox watch."""
+    query = query or ""
+    return bool(INBOX_QUERY_RE.search(query)) and not UNWATCHED_QUERY_RE.search(query)
+
+def cached_listing(key):
+    """Cached (message ids, next page token) for a listing if a live watch or a recent fetch vouches for it."""
+    with cache_lock:
+        entry = email_query_cache.get(key)
+    if not entry:
+        return None
+    if (gmail_push_active() and push_covers_query(key[0])) or time.time() - entry[0] < prefetcher.max_age(DEFAULT_USER):
+        return entry[1], entry[2]
+    return None
+
+def calendar_store_usable(calendar_id):
+    """True if the local store can answer for the calendar (live channel or recent sync)."""
+    max_age = prefetcher.max_age(DEFAULT_USER)
+    with cache_lock:
+        store = calendar_store.get(calendar_id)
+        fresh = bool(store and store.get("sync_token")) and time.time() - store["synced_at"] < max_age
+    return fresh or calendar_push_active(calendar_id)
+
+def apply_gmail_history(history_id):
+    """Invalidate mail caches for everything that changed since the last seen historyId."""
+    watch = watch_state["gmail"]
+    start_history_id = watch and watch.get("history_id")
+    if not start_history_id:
+        with cache_lock:
+            email_query_cache.clear()
+        return
+
+    service = build('gmail', 'v1', credentials=authenticate_gmail())
+    changed = False
+    page_token = None
+    try:
+        while True:
+            response = execute(service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                pageToken=page_token,
+                historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+            ))
+            with cache_lock:
+                for record in response.get("history", []):
+                    for deleted in record.get("messagesDeleted", []):
+                        message_cache.pop(deleted["message"]["id"], None)
+                    changed = changed or any(
+                        record.get(kind) for kind in ("messagesAdded", "messagesDeleted", "labelsAdded", "labelsRemoved")
+                    )
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+    except HttpError as e:
+        # 404 means the start historyId is too old to diff against
+        if e.resp.status != 404:
+            raise
+        changed = True
+
+    with cache_lock:
+        if changed:
+            email_query_cache.clear()
+        watch["history_id"] = max(int(history_id), int(start_history_id))
+
+def sync_calendar(creds, calendar_id):
+    """Incrementally sync one calendar into calendar_store using its sync token."""
+    service = build('calendar', 'v3', credentials=creds)
+    with cache_lock:
+        store = calendar_store.setdefault(calendar_id, {"events": {}, "sync_token": None, "synced_at": 0})
+        sync_token = store["sync_token"]
+
+    params = {"calendarId": calendar_id, "singleEvents": True}
+    if sync_token:
+        params["syncToken"] = sync_token
+    else:
+        lookback = datetime.now(timezone.utc) - timedelta(days=CALENDAR_SYNC_LOOKBACK_DAYS)
+        params["timeMin"] = lookback.isoformat()
+
+    changes = []
+    page_token = None
+    try:
+        while True:
+            response = execute(service.events().list(pageToken=page_token, **params))
+            changes.extend(response.get("items", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+    except HttpError as e:
+        # 410 Gone: the sync token expired, start over with a full sync
+        if e.resp.status == 410 and sync_token:
+            with cache_lock:
+                calendar_store[calendar_id] = {"events": {}, "sync_token": None, "synced_at": 0}
+            return sync_calendar(creds, calendar_id)
+        raise
+
+    with cache_lock:
+        events = {} if not sync_token else store["events"]
+        for event in changes:
+            if event.get("status") == "cancelled":
+                events.pop(event["id"], None)
+            else:
+                events[event["id"]] = event
+        calendar_store[calendar_id] = {
+            "events": events,
+            "sync_token": response.get("nextSyncToken"),
+            "synced_at": time.time(),
+        }
+
+def start_gmail_watch():
+    """(Re)register the Gmail Pub/Sub watch on the inbox."""
+    service = build('gmail', 'v1', credentials=authenticate_gmail())
+    response = service.users().watch(
+        userId='me',
+        body={"topicName": GMAIL_PUBSUB_TOPIC, "labelIds": ["INBOX"], "labelFilterBehavior": "INCLUDE"}
+    ).execute()
+    with cache_lock:
+        # Listings cached before the watch existed may be stale
+        email_query_cache.clear()
+        watch_state["gmail"] = {
+            "history_id": int(response["historyId"]),
+            "expiration": int(response["expiration"]) / 1000,
+        }
+
+def start_calendar_watch(creds, calendar_id):
+    """(Re)open a notification channel for one calendar and prime its local store."""
+    service = build('calendar', 'v3', credentials=creds)
+    with cache_lock:
+        old = watch_state["calendars"].get(calendar_id)
+    body = {
+        "id": str(uuid.uuid4()),
+        "type": "web_hook",
+        "address": f"{WEBHOOK_BASE_URL.rstrip('/')}/notifications/calendar",
+        "params": {"ttl": str(CALENDAR_WATCH_TTL)},
+    }
+    if PUSH_VERIFICATION_TOKEN:
+        body["token"] = PUSH_VERIFICATION_TOKEN
+    channel = service.events().watch(calendarId=calendar_id, body=body, singleEvents=True).execute()
+    sync_calendar(creds, calendar_id)
+
+    with cache_lock:
+        watch_state["calendars"][calendar_id] = {
+            "channel_id": channel["id"],
+            "resource_id": channel["resourceId"],
+            "expiration": int(channel["expiration"]) / 1000,
+        }
+    if old:
+        try:
+            service.channels().stop(body={"id": old["channel_id"], "resourceId": old["resource_id"]}).execute()
+        except HttpError:
+            pass  # already expired
+
+def renew_watches():
+    """Register missing watches and renew those close to expiry. Returns what was renewed."""
+    renewed = []
+    deadline = time.time() + WATCH_RENEW_MARGIN
+    if GMAIL_PUBSUB_TOPIC and os.path.exists(GMAIL_TOKEN_FILE):
+        watch = watch_state["gmail"]
+        if not watch or watch["expiration"] < deadline:
+            start_gmail_watch()
+            renewed.append("gmail")
+    if WEBHOOK_BASE_URL and os.path.exists(CALENDAR_TOKEN_FILE):
+        creds = authenticate_calendar()
+        for calendar in list_calendars(creds):
+            with cache_lock:
+                watch = watch_state["calendars"].get(calendar["id"])
+            if not watch or watch["expiration"] < deadline:
+                start_calendar_watch(creds, calendar["id"])
+                renewed.append(calendar["id"])
+    return renewed
+
+async def watch_renewal_loop():
+    while True:
+        try:
+            await run_in_threadpool(renew_watches)
+        except Exception as e:
+            logger.warning("Watch renewal failed: %s", e)
+        await asyncio.sleep(WATCH_RENEW_INTERVAL)
+
+def load_email_summaries(filters, refresh=False, limit=DEFAULT_EMAIL_PAGE_SIZE, page_token=None, offset=0,
+                         fields=DEFAULT_EMAIL_FIELDS):
+    """
+    One page of a Gmail query, projected to the requested fields, using the listing and message caches.
+
+    Returns the result and the (page token, offset) to continue from, or None after the last page.
+    Messages not loaded before the request budget ran out are left for the next page and the
+    result is marked partial.
+    """
+    creds = authenticate_gmail()
+    service = build('gmail', 'v1', credentials=creds)
+
+    key = (filters, page_token, limit)
+    listing = None if refresh else cached_listing(key)
+    if listing is None:
+        results = execute(service.users().messages().list(
+            userId='me',
+            q=filters,
+            maxResults=limit,
+            pageToken=page_token,
+            fields="messages/id,nextPageToken"
+        ))
+        listing = ([msg['id'] for msg in results.get('messages', [])], results.get('nextPageToken'))
+        with cache_lock:
+            email_query_cache[key] = (time.time(), *listing)
+    message_ids, next_page_token = listing
+
+    # Messages are only fetched for fields the listing cannot answer, and only those fields
+    needed = [f for f in fields if f != "id"]
+    headers = [EMAIL_HEADERS[f] for f in needed if f in EMAIL_HEADERS]
+    mask = ["id"]
+    if "thread_id" in needed:
+        mask.append("threadId")
+    if "snippet" in needed:
+        mask.append("snippet")
+    if headers:
+        mask.append("payload/headers")
+
+    output = []
+    partial = False
+    next_position = (next_page_token, 0) if next_page_token else None
+    for index in range(offset, len(message_ids)):
+        message_id = message_ids[index]
+        with cache_lock:
+            cached = message_cache.get(message_id) or {"id": message_id}
+        if any(f not in cached for f in needed):
+            try:
+                msg_data = execute(service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    format='metadata',
+                    metadataHeaders=headers,
+                    fields=",".join(mask)
+                ))
+            except DeadlineExceeded:
+                partial = True
+                next_position = (page_token, index)
+                break
+            found = {h['name']: h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
+            cached = dict(cached)
+            for field, header in EMAIL_HEADERS.items():
+                if header in headers:
+                    cached[field] = found.get(header, 'No Subject' if field == "subject" else '')
+            if "snippet" in needed:
+                cached["snippet"] = msg_data.get('snippet', '')
+            if "thread_id" in needed:
+                cached["thread_id"] = msg_data.get('threadId', '')
+            with cache_lock:
+                message_cache[message_id] = cached
+        output.append({f: cached[f] for f in fields})
+    return {"emails": output, "partial": partial}, next_position
+
+def load_upcoming_events(limit=DEFAULT_EVENT_PAGE_SIZE, after=None, fields=DEFAULT_EVENT_FIELDS):
+    """
+    Next events across all selected calendars, merged in start order and projected to the requested fields.
+
+    after is the (start epoch, ids already returned at that start) the previous page ended on.
+    Returns the result and the position to continue from, or None when nothing follows.
+    Calendars that do not answer within the request budget are left out and the result is marked partial.
+    """
+    creds = authenticate_calendar()
+
+    start_after, seen_ids = after or (None, [])
+    if start_after is None:
+        time_min = datetime.utcnow().isoformat() + 'Z'
+    else:
+        time_min = datetime.fromtimestamp(start_after, timezone.utc).isoformat()
+    # One extra event per calendar tells whether another page follows
+    per_calendar = limit + len(seen_ids) + 1
+    mask = event_upstream_mask(fields, EVENT_UPSTREAM_FIELDS, always=("id", "iCalUID", "start"))
+    futures = [
+        submit_with_context(calendar_pool, fetch_calendar_events, creds, calendar, time_min, per_calendar, mask)
+        for calendar in list_calendars(creds)
+    ]
+    streams = []
+    partial = False
+    for future in futures:
+        try:
+            streams.append(future.result(timeout=remaining_time()))
+        except (TimeoutError, FuturesTimeoutError):
+            partial = True
+
+    if start_after is not None:
+        # timeMin bounds event ends, so events already under way at the cursor come back too
+        streams = [
+            [e for e in stream
+             if event_start_key(e) > start_after or (event_start_key(e) == start_after and e['id'] not in seen_ids)]
+            for stream in streams
+        ]
+    events = merge_calendar_events(streams, limit + 1)
+    next_position = None
+    if len(events) > limit:
+        events = events[:limit]
+        last_start = event_start_key(events[-1])
+        at_last = [e['id'] for e in events if event_start_key(e) == last_start]
+        next_position = (last_start, (seen_ids if last_start == start_after else []) + at_last)
+    output = []
+
+    for event in events:
+        start = event['start'].get('dateTime', event['start'].get('date'))
+        end = event.get('end', {})
+        summary = event.get('summary', 'No Title')
+        description = event.get('description', '')
+        location = event.get('location', '')
+        hangout = event.get('hangoutLink', '')
+        organizer = event.get('organizer', {}).get('email', '')
+
+        meeting_link = hangout or extract_meeting_link(description) or location
+
+        record = {
+            "id": event['id'],
+            "summary": summary,
+            "start_time": start,
+            "end_time": end.get('dateTime', end.get('date')),
+            "meeting_link": meeting_link,
+            "organizer": organizer,
+            "calendar": event["_calendar"]
+        }
+        output.append({f: record[f] for f in fields})
+    return {"events": output, "partial": partial}, next_position
+
+# ------------------ Background Prefetch ------------------
+PREFETCH_BASE_INTERVAL = int(os.environ.get("PREFETCH_BASE_INTERVAL", "300"))  # seconds
+PREFETCH_MIN_INTERVAL = 60
+PREFETCH_MAX_INTERVAL = 3600
+PREFETCH_CONCURRENCY = 1
+PREFETCH_TICK = 5  # seconds between scheduler passes
+PREFETCH_ACTIVITY_WINDOW = 3600  # request rate is measured over this many seconds
+# Prefetch backs off while this many foreground requests are in flight
+PREFETCH_BUSY_THRESHOLD = 4
+
+foreground_inflight = 0
+
+@app.middleware("http")
+async def track_foreground_requests(request: HTTPRequest, call_next):
+    global foreground_inflight
+    foreground_inflight += 1
+    try:
+        return await call_next(request)
+    finally:
+        foreground_inflight -= 1
+
+class PrefetchScheduler:
+    """
+    Keeps each authorized user's unread mail and upcoming events warm in the caches.
+
+    A user's refresh interval shrinks as they make more requests; cached data stays fresh
+    for that interval, so every prefetch is usable. Users with no requests in the activity
+    window are not prefetched until they return. Prefetch runs on its own small pool and
+    pauses while the foreground is busy, so it never competes with user requests.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY, thread_name_prefix="prefetch")
+
+    def register(self, user):
+        with self.lock:
+            self.users.setdefault(user, {"requests": deque(), "next_run": 0.0, "running": False})
+
+    def record_request(self, user):
+        with self.lock:
+            state = self.users.get(user)
+            if state is None:
+                return
+            state["requests"].append(time.time())
+            # A newly active user should not wait out a long idle interval
+            state["next_run"] = min(state["next_run"], time.time() + self._interval(state))
+
+    def _interval(self, state):
+        cutoff = time.time() - PREFETCH_ACTIVITY_WINDOW
+        requests = state["requests"]
+        while requests and requests[0] < cutoff:
+            requests.popleft()
+        if not requests:
+            return PREFETCH_MAX_INTERVAL
+        interval = PREFETCH_BASE_INTERVAL / len(requests) ** 0.5
+        return max(PREFETCH_MIN_INTERVAL, min(PREFETCH_MAX_INTERVAL, interval))
+
+    def max_age(self, user):
+        """How long the user's cached data counts as fresh: until the next prefetch is due."""
+        with self.lock:
+            state = self.users.get(user)
+            if state is None:
+                return CACHE_MAX_AGE
+            interval = self._interval(state)  # also drops requests outside the activity window
+            active = bool(state["requests"])
+        return max(CACHE_MAX_AGE, interval + PREFETCH_TICK) if active else CACHE_MAX_AGE
+
+    def _prefetch(self, user):
+        try:
+            if os.path.exists(GMAIL_TOKEN_FILE):
+                load_email_summaries(DEFAULT_EMAIL_QUERY, refresh=True)
+            if os.path.exists(CALENDAR_TOKEN_FILE):
+                creds = authenticate_calendar()
+                for calendar in list_calendars(creds):
+                    sync_calendar(creds, calendar["id"])
+        except Exception as e:
+            logger.warning("Prefetch for %s failed: %s", user, e)
+        finally:
+            with self.lock:
+                state = self.users[user]
+                state["running"] = False
+                interval = self._interval(state)
+                # Idle users wait for their next request (record_request reschedules them)
+                state["next_run"] = time.time() + interval if state["requests"] else float("inf")
+
+    def run_due(self):
+        """Start prefetches that are due; returns the users started."""
+        if foreground_inflight >= PREFETCH_BUSY_THRESHOLD:
+            return []
+        started = []
+        now = time.time()
+        with self.lock:
+            for user, state in self.users.items():
+                if not state["running"] and state["next_run"] <= now:
+                    state["running"] = True
+                    started.append(user)
+        for user in started:
+            self.pool.submit(self._prefetch, user)
+        return started
+
+    async def run(self):
+        while True:
+            self.run_due()
+            await asyncio.sleep(PREFETCH_TICK)
+
+prefetcher = PrefetchScheduler()
+
+# ------------------ Request Coalescing & Admission Control ------------------
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "16"))  # below the 40-thread worker pool
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", "32"))
+QUEUE_DEADLINE = float(os.environ.get("QUEUE_DEADLINE", "5"))  # seconds a request may wait for a slot
+RETRY_AFTER = 2  # seconds
+
+class SingleFlight:
+    """Concurrent calls with the same key share a single execution and its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+inflight_reads = SingleFlight()
+
+class AdmissionController:
+    """
+    Bounds concurrently executing requests and the queue in front of them.
+
+    Requests that find the queue full, or wait longer than the deadline for a slot,
+    are shed with 503 and Retry-After instead of piling up in the worker pool.
+    """
+
+    def __init__(self, limit, queue_size, deadline):
+        self.slots = asyncio.Semaphore(limit)
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.waiting = 0
+
+    def _overloaded(self):
+        return JSONResponse(
+            content={"error": "Server is overloaded, please retry shortly."},
+            status_code=503,
+            headers={"Retry-After": str(RETRY_AFTER)}
+        )
+
+    async def __call__(self, request: HTTPRequest, call_next):
+        if self.slots.locked() and self.waiting >= self.queue_size:
+            return self._overloaded()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=self.deadline)
+        except asyncio.TimeoutError:
+            return self._overloaded()
+        finally:
+            self.waiting -= 1
+        try:
+            return await call_next(request)
+        finally:
+            self.slots.release()
+
+# Registered after the foreground tracker so shed requests never count as in flight
+app.middleware("http")(AdmissionController(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS, QUEUE_DEADLINE))
+
+# ------------------ Request Budgets & Hedging ------------------
+REQUEST_BUDGET = float(os.environ.get("REQUEST_BUDGET", "8"))  # seconds a foreground request may take
+MAX_REQUEST_SECONDS = float(os.environ.get("MAX_REQUEST_SECONDS", "10"))  # cap on any single Google call
+# A read still running at its method's p95 latency is raced against a duplicate
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05  # seconds
+HEDGE_WORKERS = 16
+LATENCY_WINDOW = 200  # recent samples kept per API method
+THREAD_HTTP_CONNECTIONS = 4  # kept per hedge thread
+
+request_deadline = contextvars.ContextVar("request_deadline", default=None)  # time.monotonic() value
+hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+thread_state = threading.local()
+
+class DeadlineExceeded(TimeoutError):
+    """A Google call could not finish within the request budget (or its own timeout)."""
+
+@app.middleware("http")
+async def apply_request_budget(request: HTTPRequest, call_next):
+    # Outermost middleware, so time spent queued for admission counts against the budget
+    request_deadline.set(time.monotonic() + REQUEST_BUDGET)
+    return await call_next(request)
+
+class LatencyTracker:
+    """Recent latencies per API method, used to decide when a read is slow enough to hedge."""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, method, seconds):
+        with self.lock:
+            self.samples.setdefault(method, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def hedge_delay(self, method):
+        with self.lock:
+            samples = sorted(self.samples.get(method, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, samples[int(HEDGE_PERCENTILE * (len(samples) - 1))])
+
+latencies = LatencyTracker()
+
+def remaining_time():
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def request_timeout():
+    """Timeout for the next Google call; background work only gets the per-call cap."""
+    remaining = remaining_time()
+    if remaining is None:
+        return MAX_REQUEST_SECONDS
+    if remaining <= 0:
+        raise DeadlineExceeded("Request budget spent before the Google call started")
+    return min(remaining, MAX_REQUEST_SECONDS)
+
+def submit_with_context(pool, fn, *args):
+    """Submit to a pool so the worker sees the caller's request deadline."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+def thread_http(credentials):
+    # httplib2 is not thread-safe, so hedged attempts each use their own thread's connection.
+    # Credentials are reloaded per request, so clients are keyed by the grant rather than the
+    # object and given the current credentials; least recently used connections are closed.
+    connections = getattr(thread_state, "connections", None)
+    if connections is None:
+        connections = thread_state.connections = OrderedDict()
+    grant = getattr(credentials, "refresh_token", None) or getattr(credentials, "token", None)
+    key = (grant, tuple(sorted(getattr(credentials, "scopes", None) or ())))
+    http = connections.pop(key, None)
+    if http is None:
+        http = AuthorizedHttp(credentials, http=httplib2.Http())
+    else:
+        http.credentials = credentials
+    connections[key] = http
+    while len(connections) > THREAD_HTTP_CONNECTIONS:
+        connections.popitem(last=False)[1].http.close()
+    return http
+
+def set_timeout(http, timeout):
+    # httplib2 only applies its timeout to new connections, so open sockets are updated as well
+    http.http.timeout = timeout
+    for connection in http.http.connections.values():
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+def attempt(request, http, timeout):
+    set_timeout(http, timeout)
+    started = time.monotonic()
+    try:
+        response = request.execute(http=http)
+    except DeadlineExceeded:
+        raise
+    except TimeoutError as e:
+        raise DeadlineExceeded(f"{request.methodId} did not respond within {timeout:.1f}s") from e
+    latencies.record(request.methodId, time.monotonic() - started)
+    return response
+
+def execute(request):
+    """
+    Execute a Google API request within the request budget.
+
+    GETs that outlive their method's p95 latency are raced against a duplicate sent on
+    another connection; the first success wins. Raises DeadlineExceeded when out of time.
+    """
+    timeout = request_timeout()
+    delay = latencies.hedge_delay(request.methodId) if request.method == "GET" else None
+    if delay is None or delay >= timeout:
+        return attempt(request, request.http, timeout)
+
+    credentials = request.http.credentials
+    primary = submit_with_context(hedge_pool, lambda: attempt(request, thread_http(credentials), timeout))
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+
+    duplicate = copy.copy(request)
+    duplicate.headers = dict(request.headers)
+    hedge_timeout = request_timeout()
+    hedge = submit_with_context(hedge_pool, lambda: attempt(duplicate, thread_http(credentials), hedge_timeout))
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    return primary.result()
+
 # ------------------ Authentication Functions ------------------
 def authenticate_gmail():
     """Authenticate with Gmail API with proper refresh token handling"""
@@ -257,6 +1072,7 @@ async def home():
 def authorize_both():
     try:
         gmail_creds, calendar_creds = authenticate_combined()
+        prefetcher.register(DEFAULT_USER)
         return HTMLResponse("""
         <h3>✅ Authorization Complete</h3>
         <p>Both Gmail and Calendar are now authorized.</p>
@@ -275,26 +1091,25 @@ def authorize_both():
 # ------------------ 🌐 /email ------------------
 
 @app.get("/email")
-def read_gmail(filters: Optional[str] = Query(default="newer_than:2d is:unread")):
+def read_gmail(
+    filters: Optional[str] = Query(default=DEFAULT_EMAIL_QUERY),
+    limit: int = Query(default=DEFAULT_EMAIL_PAGE_SIZE, ge=1, le=MAX_EMAIL_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    fields: Optional[str] = Query(default=None, description=f"Comma-separated subset of: {', '.join(EMAIL_FIELDS)}"),
+):
+    selected = parse_fields(fields, EMAIL_FIELDS, DEFAULT_EMAIL_FIELDS)
+    scope = query_scope("email", filters, limit)
+    position = decode_cursor(cursor, scope) or {}
     try:
-        creds = authenticate_gmail()
-        service = build('gmail', 'v1', credentials=creds)
-
-        results = service.users().messages().list(userId='me', q=filters).execute()
-        messages = results.get('messages', [])
-
-        output = []
-        for msg in messages:
-            msg_data = service.users().messages().get(userId='me', id=msg['id']).execute()
-            headers = msg_data['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            snippet = msg_data.get('snippet', '')
-            output.append({
-                "subject": subject,
-                "snippet": snippet
-            })
-
-        return JSONResponse(content={"emails": output})
+        prefetcher.record_request(DEFAULT_USER)
+        result, next_position = inflight_reads.do(
+            ("email", filters, limit, cursor, selected), load_email_summaries, filters,
+            limit=limit, page_token=position.get("p"), offset=position.get("o", 0), fields=selected
+        )
+        next_cursor = encode_cursor(scope, {"p": next_position[0], "o": next_position[1]}) if next_position else None
+        return ORJSONResponse(content=dict(result, next_cursor=next_cursor))
+    except DeadlineExceeded as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -302,42 +1117,69 @@ def read_gmail(filters: Optional[str] = Query(default="newer_than:2d is:unread")
 # ------------------ 🌐 /calendar ------------------
 
 @app.get("/calendar")
-def get_calendar_events():
+def get_calendar_events(
+    limit: int = Query(default=DEFAULT_EVENT_PAGE_SIZE, ge=1, le=MAX_EVENT_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    fields: Optional[str] = Query(default=None, description=f"Comma-separated subset of: {', '.join(EVENT_FIELDS)}"),
+):
+    selected = parse_fields(fields, EVENT_FIELDS, DEFAULT_EVENT_FIELDS)
+    scope = query_scope("calendar")
+    position = decode_cursor(cursor, scope)
     try:
-        creds = authenticate_calendar()
-        service = build('calendar', 'v3', credentials=creds)
-
-        now = datetime.utcnow().isoformat() + 'Z'
-        results = service.events().list(
-            calendarId='primary',
-            timeMin=now,
-            maxResults=10,
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-
-        events = results.get('items', [])
-        output = []
-
-        for event in events:
-            start = event['start'].get('dateTime', event['start'].get('date'))
-            summary = event.get('summary', 'No Title')
-            description = event.get('description', '')
-            location = event.get('location', '')
-            hangout = event.get('hangoutLink', '')
-            organizer = event.get('organizer', {}).get('email', '')
-
-            meeting_link = hangout or extract_meeting_link(description) or location
-
-            output.append({
-                "summary": summary,
-                "start_time": start,
-                "meeting_link": meeting_link,
-                "organizer": organizer
-            })
-
-        return JSONResponse(content={"events": output})
+        prefetcher.record_request(DEFAULT_USER)
+        result, next_position = inflight_reads.do(
+            ("calendar", limit, cursor, selected), load_upcoming_events,
+            limit=limit, after=position and (position["t"], position["k"]), fields=selected
+        )
+        next_cursor = encode_cursor(scope, {"t": next_position[0], "k": next_position[1]}) if next_position else None
+        return ORJSONResponse(content=dict(result, next_cursor=next_cursor))
+
+    except DeadlineExceeded as e:
+        return JSONResponse(content={"error": str(e)}, status_code=504)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
 
+# ------------------ 🌐 Push notifications ------------------
+
+def _check_push_token(token: Optional[str]):
+    if PUSH_VERIFICATION_TOKEN and token != PUSH_VERIFICATION_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid push token")
+
+@app.post("/notifications/gmail", status_code=204)
+async def gmail_notification(request: HTTPRequest, token: Optional[str] = Query(default=None)):
+    """Pub/Sub push endpoint for Gmail watch notifications."""
+    _check_push_token(token)
+    envelope = await request.json()
+    try:
+        data = json.loads(base64.b64decode(envelope["message"]["data"]))
+        history_id = int(data["historyId"])
+    except (KeyError, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Malformed Pub/Sub message")
+    await run_in_threadpool(apply_gmail_history, history_id)
+    return Response(status_code=204)
+
+@app.post("/notifications/calendar", status_code=204)
+async def calendar_notification(request: HTTPRequest):
+    """Webhook for Calendar events.watch channel notifications."""
+    _check_push_token(request.headers.get("X-Goog-Channel-Token"))
+    channel_id = request.headers.get("X-Goog-Channel-ID")
+    state = request.headers.get("X-Goog-Resource-State")
+    with cache_lock:
+        calendar_id = next(
+            (cid for cid, watch in watch_state["calendars"].items() if watch["channel_id"] == channel_id),
+            None
+        )
+    # "sync" only confirms a new channel; unknown channels belong to a previous process
+    if calendar_id and state != "sync":
+        await run_in_threadpool(sync_calendar, authenticate_calendar(), calendar_id)
+    return Response(status_code=204)
+
+@app.post("/watch/renew")
+def renew_watch_subscriptions():
+    """Renew Gmail and Calendar watches now (also runs hourly in the background)."""
+    try:
+        return JSONResponse(content={"renewed": renew_watches()})
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
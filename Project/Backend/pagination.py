@@ -0,0 +1,47 @@
+import json
+import base64
+import binascii
+import hashlib
+
+from fastapi import HTTPException
+
+# ------------------ Pagination & Projection ------------------
+# Shared by calandgmail.py, assistantApi.py and CalendarApi.py
+
+def parse_fields(fields, allowed, default):
+    """Requested output fields, in order; 400 for unknown names."""
+    if not fields:
+        return default
+    requested = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in requested if f not in allowed]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(allowed)}"
+        )
+    return requested
+
+def query_scope(*parts):
+    """Fingerprint of the query a cursor belongs to."""
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()[:12]
+
+def encode_cursor(scope, state):
+    payload = json.dumps(dict(state, s=scope), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_cursor(cursor, scope):
+    """State stored in an opaque cursor; 400 if it is malformed or from a different query."""
+    if not cursor:
+        return None
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(state, dict) or state.get("s") != scope:
+        raise HTTPException(status_code=400, detail="Cursor does not belong to this query")
+    return state
+
+def event_upstream_mask(fields, upstream_fields, always=()):
+    """Calendar `fields` selector for the output fields; `always` lists upstream fields every caller needs."""
+    extra = [upstream_fields[f] for f in fields if f in upstream_fields]
+    return ",".join([*always, *extra])
@@ -0,0 +1,71 @@
+"""
+Local stand-in for Google push delivery.
+
+Posts Gmail Pub/Sub and Calendar channel notification payloads to a running
+calandgmail server, so the webhook routes can be exercised without a public URL.
+
+    python push_standin.py gmail --history-id 123456
+    python push_standin.py calendar --channel-id <id from /watch/renew> --state exists
+"""
+import argparse
+import base64
+import json
+import os
+import uuid
+
+import requests
+
+DEFAULT_BASE_URL = "http://localhost:8000"
+
+
+def post_gmail(base_url, email_address, history_id, token=None):
+    data = json.dumps({"emailAddress": email_address, "historyId": history_id}).encode()
+    envelope = {
+        "message": {
+            "data": base64.b64encode(data).decode(),
+            "messageId": str(uuid.uuid4()),
+            "publishTime": "2025-01-01T00:00:00Z",
+        },
+        "subscription": "projects/local/subscriptions/gmail-push",
+    }
+    params = {"token": token} if token else None
+    return requests.post(f"{base_url}/notifications/gmail", json=envelope, params=params, timeout=30)
+
+
+def post_calendar(base_url, channel_id, state="exists", resource_id="local-resource", token=None, message_number=1):
+    headers = {
+        "X-Goog-Channel-ID": channel_id,
+        "X-Goog-Resource-ID": resource_id,
+        "X-Goog-Resource-State": state,
+        "X-Goog-Message-Number": str(message_number),
+    }
+    if token:
+        headers["X-Goog-Channel-Token"] = token
+    return requests.post(f"{base_url}/notifications/calendar", headers=headers, timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL)
+    parser.add_argument("--token", default=os.environ.get("PUSH_VERIFICATION_TOKEN"))
+    sub = parser.add_subparsers(dest="kind", required=True)
+
+    gmail = sub.add_parser("gmail", help="Send a Gmail watch notification")
+    gmail.add_argument("--history-id", type=int, required=True)
+    gmail.add_argument("--email", default="me@example.com")
+
+    calendar = sub.add_parser("calendar", help="Send a Calendar channel notification")
+    calendar.add_argument("--channel-id", required=True)
+    calendar.add_argument("--state", default="exists", choices=["sync", "exists", "not_exists"])
+    calendar.add_argument("--resource-id", default="local-resource")
+
+    args = parser.parse_args()
+    if args.kind == "gmail":
+        response = post_gmail(args.base_url, args.email, args.history_id, args.token)
+    else:
+        response = post_calendar(args.base_url, args.channel_id, args.state, args.resource_id, args.token)
+    print(response.status_code, response.text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,44 @@
 import os
+import re
+import sys
+import mmap
+import copy
+import json
+import random
+import sqlite3
+import pstats
+import cProfile
+import contextvars
+import heapq
+import hashlib
 import logging
-from datetime import datetime, timedelta, timezone
-from typing import Dict, Any
+import tempfile
+import threading
+import unicodedata
+import uuid
+import email.policy
+import urllib.request
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, date, time, timedelta, timezone
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from time import monotonic, time_ns
+from email.parser import BytesFeedParser
+from email.header import Header
+from email.utils import formataddr, getaddresses, parseaddr
+from html.parser import HTMLParser
+from typing import Dict, Any, NamedTuple, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from http import HTTPStatus
+import httplib2
+from cachetools import LRUCache, TTLCache
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp, Request as AuthRequest
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from email.mime.text import MIMEText
 import base64
 
@@ -20,16 +53,1257 @@ CALENDAR_READ_SCOPE = ['https://www.googleapis.com/auth/calendar.readonly', "htt
 GMAIL_READ_SCOPE = ['https://www.googleapis.com/auth/gmail.readonly',
                     "https://www.googleapis.com/auth/gmail.send"]
 
+# Arizona does not observe DST, so this keeps the historical fixed UTC-7 behaviour
+DEFAULT_TIMEZONE = os.environ.get('DEFAULT_TIMEZONE', 'America/Phoenix')
+
 # ---------------- Helper: Parameter Parsing ----------------
 def parse_parameters(param_list):
     return {param['name']: param['value'] for param in param_list}
 
 
+def parse_list_parameter(value):
+    """Accept a JSON array or a comma-separated string and return a list of strings."""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    try:
+        parsed = json.loads(value)
+        return parsed if isinstance(parsed, list) else [parsed]
+    except ValueError:
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# ---------------- Helper: Result Cursors ----------------
+MORE_RESULTS_HINT = "More results are available; ask to show more to continue."
+PARTIAL_RESULTS_HINT = "Some results could not be fetched in time; ask to show more to continue."
+
+
+def query_fingerprint(value):
+    """Short, stable fingerprint of a query so a cursor is only resumed for the same question."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def load_cursor(session_attributes, function, fingerprint=None):
+    """Return the stored cursor for a function, if any and (when given) for the same query."""
+    try:
+        cursor = json.loads(session_attributes.get(f'cursor.{function}') or 'null')
+    except ValueError:
+        return None
+    if not isinstance(cursor, dict) or (fingerprint and cursor.get('f') != fingerprint):
+        return None
+    return cursor
+
+
+def resume_cursor(session_attributes, function, params, show_more):
+    """
+    Returns (cursor to resume from or None, fingerprint of this query).
+
+    A repeat call with the same filters resumes the stored cursor, so does a "show more" call
+    with no query parameters (it continues the last listing of the function). show_more=false
+    starts the listing over.
+    """
+    query_params = {k: v for k, v in params.items() if k not in ('show_more', 'time_zone', 'profile')}
+    fingerprint = query_fingerprint([function, query_params])
+    if show_more is False:
+        return None, fingerprint
+    if show_more and not query_params:
+        cursor = load_cursor(session_attributes, function)
+        return cursor, cursor['f'] if cursor else fingerprint
+    return load_cursor(session_attributes, function, fingerprint), fingerprint
+
+
+def store_cursor(session_attributes, function, cursor):
+    key = f'cursor.{function}'
+    if cursor:
+        session_attributes[key] = json.dumps(cursor, separators=(',', ':'))
+    else:
+        session_attributes.pop(key, None)
+
+
+# ---------------- Helper: Time Expressions ----------------
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+          'august', 'september', 'october', 'november', 'december']
+
+# (start hour, end hour) in the user's local time
+PARTS_OF_DAY = {
+    'morning': (8, 12),
+    'noon': (12, 13),
+    'afternoon': (12, 17),
+    'evening': (17, 21),
+    'tonight': (18, 23),
+    'night': (18, 23),
+}
+
+_TIME = r'(\d{1,2})(?::(\d{2}))?\s*(am|pm|a\.m\.|p\.m\.)?'
+TIME_RANGE_RE = re.compile(r'(?:from|between)?\s*\b' + _TIME + r'\s*(?:-|to|until|till|and)\s*' + _TIME + r'(?!\S)')
+TIME_RE = re.compile(r'(?:\bat\s+)?\b(\d{1,2})(?::(\d{2}))?\s*(am|pm|a\.m\.|p\.m\.)|\bat\s+(\d{1,2})(?::(\d{2}))?\b|\b(\d{1,2}):(\d{2})\b')
+ISO_DATE_RE = re.compile(r'\b(\d{4})-(\d{2})-(\d{2})\b')
+MONTH_DAY_RE = re.compile(r'\b(' + '|'.join(MONTHS) + r')\s+(\d{1,2})(?:st|nd|rd|th)?\b|\b(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?(' + '|'.join(MONTHS) + r')\b')
+DAY_COUNT_RE = re.compile(r'\b(?:next|in|within|over the next|coming)\s+(\d{1,3})\s+(day|week)s?\b')
+DAYS_FROM_NOW_RE = re.compile(r'\b(\d{1,3}|a|one)\s+(day|week)s?\s+from\s+(?:now|today)\b')
+EVENING_RE = re.compile(r'\b(?:tonight|evening|night)\b')
+WEEKDAY_RE = re.compile(r'\b(this|next|coming)?\s*(' + '|'.join(WEEKDAYS) + r')\b')
+
+
+class TimeSpan(NamedTuple):
+    start: datetime
+    end: datetime
+    has_time: bool
+
+
+def resolve_timezone(tz_name=None):
+    """Return a ZoneInfo for an IANA name, falling back to DEFAULT_TIMEZONE."""
+    for name in (tz_name, DEFAULT_TIMEZONE):
+        if not name:
+            continue
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            logger.warning("Unknown time zone %r", name)
+    return timezone.utc
+
+
+def _to_24h(hour, minute, meridiem):
+    hour, minute = int(hour), int(minute or 0)
+    if meridiem:
+        meridiem = meridiem.replace('.', '')
+        if meridiem == 'pm' and hour < 12:
+            hour += 12
+        elif meridiem == 'am' and hour == 12:
+            hour = 0
+    if hour > 23 or minute > 59:
+        raise ValueError(f"Invalid time {hour}:{minute:02d}")
+    return hour, minute
+
+
+def _parse_clock(text):
+    """Extract a (start, end) clock range from text; returns (range or None, remaining text)."""
+    # "tonight at 8" and "this evening 7-9" are evening hours without saying pm
+    evening = bool(EVENING_RE.search(text))
+    match = TIME_RANGE_RE.search(text)
+    if match:
+        sh, sm, smer, eh, em, emer = match.groups()
+        # "2-4pm" applies the trailing meridiem to both ends
+        smer = smer or (emer if int(sh) <= int(eh) or emer == 'am' else None)
+        start = _to_24h(sh, sm, smer)
+        end = _to_24h(eh, em, emer)
+        if smer and not emer:
+            # "7pm-9" ends at 9 pm; "10pm-1" runs past midnight
+            end = _to_24h(eh, em, smer)
+            if end <= start:
+                end = _to_24h(eh, em, 'am' if smer.replace('.', '') == 'pm' else 'pm')
+        elif not smer and not emer and evening and start[0] < 12:
+            start = (start[0] + 12, start[1])
+            if end[0] < 12 and (end[0] + 12, end[1]) > start:
+                end = (end[0] + 12, end[1])
+        # Without any meridiem an end before the start is an afternoon hour: "10 to 2", "9-5"
+        elif not smer and not emer and end < start and end[0] < 12:
+            end = (end[0] + 12, end[1])
+        return (start, end), text[:match.start()] + ' ' + text[match.end():]
+
+    match = TIME_RE.search(text)
+    if match:
+        if match.group(1):
+            start = _to_24h(match.group(1), match.group(2), match.group(3))
+        else:
+            hour, minute = int(match.group(4) or match.group(6)), match.group(5) or match.group(7)
+            # Bare "at 3" means 3 PM for the usual working hours, any hour is PM in the evening
+            if hour < 12 and (evening or (match.group(4) and 1 <= hour <= 6)):
+                hour += 12
+            start = _to_24h(hour, minute, None)
+        end = (start[0] + 1, start[1]) if start[0] < 23 else (23, 59)
+        return (start, end), text[:match.start()] + ' ' + text[match.end():]
+
+    for word, (sh, eh) in PARTS_OF_DAY.items():
+        if re.search(rf'\b{word}\b', text):
+            return ((sh, 0), (eh, 0)), text
+    if re.search(r'\bmidnight\b', text):
+        return ((0, 0), (1, 0)), text
+    return None, text
+
+
+def _parse_days(text, today):
+    """Extract a [first day, last day) date range from text, or None."""
+    if re.search(r'\bday after tomorrow\b', text):
+        return today + timedelta(days=2), today + timedelta(days=3)
+    # Before "now" below: "2 days from now" is a single day
+    match = DAYS_FROM_NOW_RE.search(text)
+    if match:
+        count = 1 if match.group(1) in ('a', 'one') else int(match.group(1))
+        day = today + timedelta(days=count * 7 if match.group(2) == 'week' else count)
+        return day, day + timedelta(days=1)
+    if re.search(r'\b(today|tonight|now)\b', text):
+        return today, today + timedelta(days=1)
+    if re.search(r'\btomorrow\b', text):
+        return today + timedelta(days=1), today + timedelta(days=2)
+    if re.search(r'\byesterday\b', text):
+        return today - timedelta(days=1), today
+
+    match = ISO_DATE_RE.search(text)
+    if match:
+        day = date(*map(int, match.groups()))
+        return day, day + timedelta(days=1)
+
+    match = MONTH_DAY_RE.search(text)
+    if match:
+        month_name = match.group(1) or match.group(4)
+        day_num = int(match.group(2) or match.group(3))
+        day = date(today.year, MONTHS.index(month_name) + 1, day_num)
+        if day < today - timedelta(days=30):
+            day = day.replace(year=today.year + 1)
+        return day, day + timedelta(days=1)
+
+    match = DAY_COUNT_RE.search(text)
+    if match:
+        count, unit = int(match.group(1)), match.group(2)
+        days = count * 7 if unit == 'week' else count
+        return today, today + timedelta(days=days)
+
+    week_start = today - timedelta(days=today.weekday())
+    if re.search(r'\b(this|the) weekend\b|\bweekend\b', text):
+        saturday = week_start + timedelta(days=5)
+        if re.search(r'\bnext weekend\b', text):
+            saturday += timedelta(days=7)
+        return max(saturday, today), saturday + timedelta(days=2)
+    if re.search(r'\bnext week\b', text):
+        return week_start + timedelta(days=7), week_start + timedelta(days=14)
+    if re.search(r'\b(this|the rest of the) week\b', text):
+        return today, week_start + timedelta(days=7)
+
+    month_start = today.replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    if re.search(r'\bnext month\b', text):
+        return next_month, (next_month + timedelta(days=32)).replace(day=1)
+    if re.search(r'\bthis month\b', text):
+        return today, next_month
+
+    match = WEEKDAY_RE.search(text)
+    if match:
+        qualifier, weekday = match.groups()
+        delta = (WEEKDAYS.index(weekday) - today.weekday()) % 7
+        if qualifier == 'next' and delta == 0:
+            delta = 7
+        day = today + timedelta(days=delta)
+        return day, day + timedelta(days=1)
+    return None
+
+
+@lru_cache(maxsize=1024)
+def _parse_time_expression_cached(expression, tz_name, reference_day, default_day):
+    tz = resolve_timezone(tz_name)
+    # ISO dates look like clock ranges ("05-01"), so keep them away from the clock parser
+    iso_date = ISO_DATE_RE.search(expression)
+    clock, remainder = _parse_clock(ISO_DATE_RE.sub(' ', expression))
+    days = _parse_days(iso_date.group(0) if iso_date else remainder, reference_day)
+    if days is None and clock is None:
+        return None
+    first_day, last_day = days or (default_day, default_day + timedelta(days=1))
+
+    if clock is None:
+        start = datetime.combine(first_day, time(), tz)
+        end = datetime.combine(last_day, time(), tz)
+        return TimeSpan(start, end, False)
+
+    (sh, sm), (eh, em) = clock
+    start = datetime.combine(first_day, time(sh, sm), tz)
+    end = datetime.combine(first_day, time(eh, em), tz)
+    if end <= start:
+        end += timedelta(days=1)
+    return TimeSpan(start, end, True)
+
+
+def parse_time_expression(expression, tz_name=None, now=None, default_day=None):
+    """
+    Resolves a natural-language time expression into a TimeSpan in the user's time zone.
+
+    Understands relative days ("today", "tomorrow", "next tuesday", "next 3 days",
+    "2 days from now", "this weekend", "next month"), ISO and month-name dates, clock
+    times and ranges ("9 AM", "2-4pm", "7pm-9", "tonight at 8") and parts of the day ("afternoon").
+
+    A bare clock time falls on default_day (today unless given).
+    Results are memoized per (expression, time zone, reference day, default day).
+    Returns None when nothing in the expression could be understood.
+    """
+    if not expression:
+        return None
+    tz_name = tz_name or DEFAULT_TIMEZONE
+    now = now or datetime.now(resolve_timezone(tz_name))
+    normalized = ' '.join(str(expression).lower().replace(',', ' ').split())
+    reference_day = now.astimezone(resolve_timezone(tz_name)).date()
+    try:
+        return _parse_time_expression_cached(normalized, tz_name, reference_day, default_day or reference_day)
+    except ValueError:
+        return None
+
+
+# ---------------- Helper: Profiling ----------------
+# Set PROFILE_INVOCATIONS=true, or pass profile=true on the event, to trace an invocation
+PROFILE_INVOCATIONS = os.environ.get('PROFILE_INVOCATIONS', 'false').lower() == 'true'
+# Fraction of traced invocations that also capture cProfile stats; profile=cprofile always does
+PROFILE_CPROFILE_RATE = float(os.environ.get('PROFILE_CPROFILE_RATE', '0'))
+# 'stdout' lands traces in CloudWatch Logs; any other value is a file path traces are appended to
+PROFILE_EXPORT = os.environ.get('PROFILE_EXPORT', 'stdout')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp')
+SERVICE_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'productivity-assistant')
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+_active_trace = contextvars.ContextVar('active_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_export_lock = threading.Lock()
+
+
+class Trace:
+    """Spans (and cProfile runs, if captured) recorded by one invocation across all its threads."""
+
+    def __init__(self, capture_profile=False):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.profiles = [] if capture_profile else None
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def add_profile(self, profiler):
+        with self.lock:
+            self.profiles.append(profiler)
+
+
+@contextmanager
+def span(name, attributes=None, kind=SPAN_KIND_INTERNAL):
+    """Record a span nested under the current one; does nothing unless the invocation is traced."""
+    trace = _active_trace.get()
+    if trace is None:
+        yield None
+        return
+    record = {'name': name, 'span_id': os.urandom(8).hex(), 'parent': _current_span.get(), 'kind': kind,
+              'attributes': dict(attributes or {}), 'start': time_ns(), 'error': None}
+    token = _current_span.set(record['span_id'])
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        record['end'] = time_ns()
+        trace.record(record)
+
+
+def traced(name):
+    """Decorator recording each call of the function as a span."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _run_traced(func, args):
+    trace = _active_trace.get()
+    # Before 3.12 cProfile only sees the thread that enabled it, so pool tasks profile themselves
+    if trace is None or trace.profiles is None or sys.version_info >= (3, 12):
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        trace.add_profile(profiler)
+
+
+def submit_traced(pool, func, *args):
+    """Submit to a thread pool, carrying the caller's trace, parent span and deadline into the worker."""
+    return pool.submit(contextvars.copy_context().run, _run_traced, func, args)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def export_trace(trace):
+    """Write the trace as one OTLP/JSON ExportTraceServiceRequest line to stdout or PROFILE_EXPORT."""
+    spans = [{
+        'traceId': trace.trace_id,
+        'spanId': s['span_id'],
+        'parentSpanId': s['parent'] or '',
+        'name': s['name'],
+        'kind': s['kind'],
+        'startTimeUnixNano': str(s['start']),
+        'endTimeUnixNano': str(s['end']),
+        'attributes': _otlp_attributes(s['attributes']),
+        'status': {'code': 2, 'message': s['error']} if s['error'] else {},
+    } for s in sorted(trace.spans, key=lambda s: s['start'])]
+    line = json.dumps({'resourceSpans': [{
+        'resource': {'attributes': _otlp_attributes({'service.name': SERVICE_NAME})},
+        'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}],
+    }]}, separators=(',', ':'))
+
+    with _export_lock:
+        if PROFILE_EXPORT == 'stdout':
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+        else:
+            with open(PROFILE_EXPORT, 'a') as f:
+                f.write(line + '\n')
+
+
+def dump_profile(trace):
+    """Merge the trace's cProfile runs into one pstats file and return its path."""
+    path = os.path.join(PROFILE_DIR, f'profile-{trace.trace_id}.pstats')
+    pstats.Stats(*trace.profiles).dump_stats(path)
+    return path
+
+
+@contextmanager
+def profile_invocation(name, requested=None, attributes=None):
+    """Trace one invocation (and maybe cProfile it) when profiling is switched on, then export it."""
+    mode = str(requested or '').lower()
+    if not (mode in ('true', 'cprofile') or (PROFILE_INVOCATIONS and mode != 'false')):
+        yield None
+        return
+
+    trace = Trace(capture_profile=mode == 'cprofile' or random.random() < PROFILE_CPROFILE_RATE)
+    trace_token = _active_trace.set(trace)
+    try:
+        with span(name, attributes, kind=SPAN_KIND_SERVER) as root:
+            profiler = cProfile.Profile() if trace.profiles is not None else None
+            if profiler:
+                profiler.enable()
+            try:
+                yield root
+            finally:
+                if profiler:
+                    profiler.disable()
+                    trace.add_profile(profiler)
+                    try:
+                        root['attributes']['profile.path'] = dump_profile(trace)
+                    except Exception as e:
+                        logger.warning("Could not write profile: %s", e)
+    finally:
+        _active_trace.reset(trace_token)
+        # A broken exporter must never fail the invocation it was observing
+        try:
+            export_trace(trace)
+        except Exception as e:
+            logger.warning("Could not export trace: %s", e)
+
+
+def profiled(handler):
+    """Wrap a Lambda handler so that profiled invocations are traced and exported."""
+    @wraps(handler)
+    def wrapper(event, context):
+        requested = next((p.get('value') for p in event.get('parameters') or [] if p.get('name') == 'profile'), None)
+        attributes = {
+            'faas.name': SERVICE_NAME,
+            'faas.invocation_id': getattr(context, 'aws_request_id', None),
+            'agent.action_group': event.get('actionGroup'),
+            'agent.function': event.get('function'),
+        }
+        with profile_invocation(f"lambda_handler {event.get('function')}", requested, attributes):
+            return handler(event, context)
+    return wrapper
+
+# ---------------- Helper: Upstream Execution ----------------
+UPSTREAM_CONCURRENCY = int(os.environ.get('UPSTREAM_CONCURRENCY', '8'))
+# Long windows are fetched as concurrent shards so they finish inside the Lambda timeout
+MAX_WINDOW_DAYS = int(os.environ.get('MAX_WINDOW_DAYS', '90'))
+SHARD_DAYS = int(os.environ.get('SHARD_DAYS', '7'))
+# Gmail recommends at most 50 calls per batch request
+BATCH_SIZE = 50
+# Bedrock rejects action group responses over 25 KB
+MAX_RESPONSE_CHARS = int(os.environ.get('MAX_RESPONSE_CHARS', '20000'))
+
+# Time held back from the Lambda timeout to format and return whatever was fetched
+DEADLINE_RESERVE_MS = int(os.environ.get('DEADLINE_RESERVE_MS', '1500'))
+# Cap on a single upstream call even when the invocation has more time left
+MAX_REQUEST_SECONDS = float(os.environ.get('MAX_REQUEST_SECONDS', '10'))
+# A read still running at its method's p95 latency is raced against a duplicate
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05  # seconds
+LATENCY_WINDOW = 200  # recent samples kept per API method
+THREAD_HTTP_CONNECTIONS = int(os.environ.get('THREAD_HTTP_CONNECTIONS', '4'))  # kept per worker thread
+
+_upstream_slots = threading.BoundedSemaphore(UPSTREAM_CONCURRENCY)
+_upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_CONCURRENCY, thread_name_prefix='upstream')
+_hedge_pool = ThreadPoolExecutor(max_workers=2 * UPSTREAM_CONCURRENCY, thread_name_prefix='hedge')
+_thread_state = threading.local()
+# monotonic() time by which the current invocation must have its upstream work done
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """An upstream call could not finish within the invocation's (or its own) time budget."""
+
+
+class LatencyTracker:
+    """Recent latencies per API method, used to decide when a read is slow enough to hedge."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, method, seconds):
+        with self.lock:
+            self.samples.setdefault(method, deque(maxlen=self.window)).append(seconds)
+
+    def hedge_delay(self, method):
+        """Seconds to wait before hedging, or None while there are too few samples to tell."""
+        with self.lock:
+            samples = sorted(self.samples.get(method, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, samples[int(HEDGE_PERCENTILE * (len(samples) - 1))])
+
+
+_latencies = LatencyTracker()
+
+
+def set_deadline(context):
+    """Derive the invocation deadline from the Lambda context (no deadline without one)."""
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        _deadline.set(None)
+        return
+    remaining_ms = get_remaining()
+    _deadline.set(monotonic() + max(remaining_ms - DEADLINE_RESERVE_MS, remaining_ms // 2) / 1000)
+
+
+def remaining_time():
+    """Seconds left before the deadline, or None when there is none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - monotonic()
+
+
+def deadline_passed():
+    remaining = remaining_time()
+    return remaining is not None and remaining <= 0
+
+
+def more_results_hint():
+    return PARTIAL_RESULTS_HINT if deadline_passed() else MORE_RESULTS_HINT
+
+
+def _request_timeout():
+    remaining = remaining_time()
+    if remaining is None:
+        return MAX_REQUEST_SECONDS
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline reached before the upstream call started")
+    return min(remaining, MAX_REQUEST_SECONDS)
+
+
+def _thread_http(credentials):
+    # httplib2 connections are not thread-safe, so every worker thread gets its own per user.
+    # Credentials are rebuilt on every invocation, so the client is keyed by user and handed the
+    # current credentials; the least recently used connections are closed beyond the limit.
+    connections = getattr(_thread_state, 'connections', None)
+    if connections is None:
+        connections = _thread_state.connections = OrderedDict()
+    key = (user_cache_key(credentials), tuple(sorted(getattr(credentials, 'scopes', None) or ())))
+    http = connections.pop(key, None)
+    if http is None:
+        http = AuthorizedHttp(credentials, http=httplib2.Http())
+    else:
+        http.credentials = credentials
+    connections[key] = http
+    while len(connections) > THREAD_HTTP_CONNECTIONS:
+        connections.popitem(last=False)[1].http.close()
+    return http
+
+
+def _set_timeout(http, timeout):
+    # httplib2 only applies its timeout to new connections, so open sockets are updated as well
+    http.http.timeout = timeout
+    for connection in http.http.connections.values():
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+
+def _attempt(request, timeout):
+    http = _thread_http(request.http.credentials)
+    _set_timeout(http, timeout)
+    started = monotonic()
+    try:
+        response = request.execute(http=http)
+    except DeadlineExceeded:
+        raise
+    except TimeoutError as e:
+        raise DeadlineExceeded(f"{request.methodId} did not respond within {timeout:.1f}s") from e
+    _latencies.record(request.methodId, monotonic() - started)
+    return response
+
+
+def _hedged(request, timeout, delay, record):
+    """Run a read; if it outlives the method's p95 latency, race it against a duplicate."""
+    primary = _hedge_pool.submit(contextvars.copy_context().run, _attempt, request, timeout)
+    done, _ = wait([primary], timeout=delay)
+    # Hedges only use spare slots, so a saturated pool never doubles its own load
+    if done or not _upstream_slots.acquire(blocking=False):
+        return primary.result()
+
+    duplicate = copy.copy(request)
+    duplicate.headers = dict(request.headers)
+    hedge = _hedge_pool.submit(contextvars.copy_context().run, _attempt, duplicate, _request_timeout())
+    hedge.add_done_callback(lambda _: _upstream_slots.release())
+    if record is not None:
+        record['attributes']['upstream.hedged'] = True
+
+    # The first successful response wins; the slower attempt finishes in the background
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    return primary.result()
+
+
+def _request_attributes(request):
+    # The query string is dropped since Gmail search terms would end up in the trace
+    return {'http.request.method': request.method, 'url.path': request.uri.split('?', 1)[0]}
+
+
+def execute_request(request):
+    """
+    Execute a Google API request under the shared concurrency limit on a per-thread connection.
+
+    The call is bounded by the invocation deadline, and slow GETs are hedged. Raises
+    DeadlineExceeded when the deadline is reached first.
+    """
+    with span(request.methodId or 'google.request', _request_attributes(request), kind=SPAN_KIND_CLIENT) as record:
+        queued_at = time_ns()
+        remaining = remaining_time()
+        if not _upstream_slots.acquire(timeout=None if remaining is None else max(remaining, 0)):
+            raise DeadlineExceeded("Deadline reached while waiting for an upstream slot")
+        try:
+            if record is not None:
+                record['attributes']['upstream.wait_ms'] = (time_ns() - queued_at) // 1_000_000
+            timeout = _request_timeout()
+            delay = _latencies.hedge_delay(request.methodId) if request.method == 'GET' else None
+            if delay is None or delay >= timeout:
+                return _attempt(request, timeout)
+            return _hedged(request, timeout, delay, record)
+        finally:
+            _upstream_slots.release()
+
+
+def execute_batch(service, requests):
+    """
+    Execute requests as one batched HTTP call per BATCH_SIZE requests.
+
+    Returns (response, exception) pairs in the order of the input requests.
+    """
+    results = [None] * len(requests)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+    for start in range(0, len(requests), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        end = min(start + BATCH_SIZE, len(requests))
+        for i in range(start, end):
+            batch.add(requests[i], request_id=str(i))
+        with span('google.batch', {'batch.size': end - start}, kind=SPAN_KIND_CLIENT), _upstream_slots:
+            http = _thread_http(requests[start].http.credentials)
+            _set_timeout(http, _request_timeout())
+            try:
+                batch.execute(http=http)
+            except DeadlineExceeded:
+                raise
+            except TimeoutError as e:
+                raise DeadlineExceeded("Batch request did not complete in time") from e
+    return results
+
+
+def split_window(start, end, shard_days=None):
+    """Split [start, end) into consecutive shards of at most shard_days days."""
+    step = timedelta(days=shard_days or SHARD_DAYS)
+    shards = []
+    while start < end:
+        shards.append((start, min(start + step, end)))
+        start += step
+    return shards
+
+
+@traced('collect_page')
+def collect_page(entries, budget=None, stop=None):
+    """
+    Take (position, formatted item) pairs in order until the response size budget is spent.
+    An item of None marks where fetching stopped at the deadline, and ends the page there.
+
+    Returns the items that fit and the position of the first one left out (None if all fit).
+    """
+    budget = budget or MAX_RESPONSE_CHARS
+    output, used, next_position = [], 0, None
+    for position, item in entries:
+        if item is None or used + len(item) > budget:
+            next_position = position
+            break
+        output.append(item)
+        used += len(item) + 2
+    if stop is not None:
+        stop.set()
+    return output, next_position
+
+
+def collect_within_budget(items, budget=None, stop=None):
+    """Take formatted items in order until the response size budget is spent."""
+    output, omitted = collect_page(((True, item) for item in items), budget, stop)
+    if omitted:
+        output.append("More results were omitted to stay within the response size limit; narrow the query to see them.")
+    return output
+
+
+@traced('discovery.build')
+def build_service(api, version, creds):
+    return build(api, version, credentials=creds)
+
+
+def user_cache_key(creds):
+    """Stable, non-secret key identifying the user behind a set of credentials."""
+    secret = getattr(creds, 'refresh_token', None) or getattr(creds, 'token', None) or ''
+    return hashlib.sha256(secret.encode()).hexdigest()[:16]
+
+
+# ---------------- Helper: Compact Records ----------------
+RECORD_CACHE_BYTES = int(os.environ.get('RECORD_CACHE_BYTES', str(16 * 1024 * 1024)))
+RECORD_CACHE_TTL = int(os.environ.get('RECORD_CACHE_TTL', '120'))
+
+
+class MailRecord:
+    """Compact message summary; sender strings are interned and the timestamp is epoch seconds."""
+    __slots__ = ('id', 'thread_id', 'sender', 'subject', 'snippet', 'timestamp', 'unread')
+
+    def __init__(self, id, thread_id, sender, subject, snippet, timestamp, unread):
+        self.id = id
+        self.thread_id = thread_id
+        self.sender = sys.intern(sender)
+        self.subject = subject
+        self.snippet = snippet
+        self.timestamp = timestamp
+        self.unread = unread
+
+    @classmethod
+    def from_message(cls, message):
+        headers = {h['name'].lower(): h['value'] for h in message.get('payload', {}).get('headers', [])}
+        return cls(
+            message['id'],
+            message.get('threadId', ''),
+            headers.get('from', ''),
+            headers.get('subject', 'No Subject'),
+            message.get('snippet', ''),
+            int(message.get('internalDate', 0)) // 1000,
+            'UNREAD' in message.get('labelIds', []),
+        )
+
+    def format(self):
+        return f"ID: {self.id}\nSubject: {self.subject}\nSnippet: {self.snippet}"
+
+    def nbytes(self):
+        # Interned sender strings are shared between records and not counted
+        return (sys.getsizeof(self) + sys.getsizeof(self.id) + sys.getsizeof(self.thread_id)
+                + sys.getsizeof(self.subject) + sys.getsizeof(self.snippet))
+
+
+class EventRecord:
+    """Compact event instance; start/end are epoch seconds, organizer strings are interned."""
+    __slots__ = ('id', 'ical_uid', 'etag', 'calendar', 'summary', 'start', 'end', 'all_day', 'organizer', 'link')
+
+    def __init__(self, id, ical_uid, etag, calendar, summary, start, end, all_day, organizer, link):
+        self.id = id
+        self.ical_uid = ical_uid
+        self.etag = etag
+        self.calendar = calendar
+        self.summary = summary
+        self.start = start
+        self.end = end
+        self.all_day = all_day
+        self.organizer = sys.intern(organizer)
+        self.link = link
+
+    @classmethod
+    def from_event(cls, event, calendar, tz=timezone.utc):
+        return cls(
+            event['id'],
+            event.get('iCalUID') or event['id'],
+            event.get('etag', ''),
+            calendar,
+            event.get('summary', 'No Title'),
+            int(event_start_key(event, tz)),
+            int(event_start_key({'start': event.get('end', event['start'])}, tz)),
+            'date' in event['start'],
+            event.get('organizer', {}).get('email', ''),
+            event.get('hangoutLink') or event.get('location') or '',
+        )
+
+    def _zone(self, tz):
+        # All-day events start at midnight in their calendar's zone, whatever zone they are read in
+        return resolve_timezone(self.calendar.get('timeZone')) if self.all_day else tz
+
+    def local_start(self, tz=timezone.utc):
+        return datetime.fromtimestamp(self.start, self._zone(tz))
+
+    def local_end(self, tz=timezone.utc):
+        return datetime.fromtimestamp(self.end, self._zone(tz))
+
+    def _format_time(self, epoch, tz):
+        moment = datetime.fromtimestamp(epoch, self._zone(tz))
+        return moment.date().isoformat() if self.all_day else moment.isoformat()
+
+    def format(self, tz=timezone.utc):
+        line = (f"Summary: {self.summary}\nStart: {self._format_time(self.start, tz)}\n"
+                f"End: {self._format_time(self.end, tz)}\nOrganizer: {self.organizer}\nLink: {self.link or 'N/A'}")
+        if not self.calendar['primary']:
+            line += f"\nCalendar: {self.calendar['name']}"
+        return line
+
+    def nbytes(self):
+        # The calendar dict and interned organizer are shared between records
+        return (sys.getsizeof(self) + sys.getsizeof(self.id) + sys.getsizeof(self.ical_uid)
+                + sys.getsizeof(self.etag) + sys.getsizeof(self.summary) + sys.getsizeof(self.link))
+
+
+def records_nbytes(records):
+    return sys.getsizeof(records) + sum(record.nbytes() for record in records)
+
+
+_record_cache = TTLCache(maxsize=RECORD_CACHE_BYTES, ttl=RECORD_CACHE_TTL, getsizeof=records_nbytes)
+# cachetools caches are not thread-safe (even a get expires entries), and pool workers share them
+_cache_lock = threading.Lock()
+
+
+def cached_records(key):
+    with _cache_lock:
+        return _record_cache.get(key)
+
+
+def cache_records(key, records):
+    """Store a tuple of records in the byte-capped record cache; oversized entries are skipped."""
+    records = tuple(records)
+    with _cache_lock:
+        try:
+            _record_cache[key] = records
+        except ValueError:
+            pass
+    return records
+
+
+# ---------------- Helper: Recurrence Expansion ----------------
+RRULE_WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+MAX_RECURRENCE_PERIODS = 5000
+
+
+class UnsupportedRecurrence(ValueError):
+    pass
+
+
+def _parse_ical_datetime(value, tz):
+    """Parse an iCalendar DATE or DATE-TIME value into an aware datetime."""
+    if value.endswith('Z'):
+        return datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+    if 'T' in value:
+        return datetime.strptime(value, '%Y%m%dT%H%M%S').replace(tzinfo=tz)
+    return datetime.strptime(value, '%Y%m%d').replace(tzinfo=tz)
+
+
+def _parse_recurrence(lines, tz):
+    """Split Google's recurrence lines into (rrule dict, exdates, rdates)."""
+    rule, exdates, rdates = None, set(), []
+    for line in lines:
+        name, _, value = line.partition(':')
+        prop, *prop_params = name.split(';')
+        prop_tz = tz
+        for param in prop_params:
+            if param.startswith('TZID='):
+                prop_tz = resolve_timezone(param[5:])
+        if prop == 'RRULE':
+            if rule is not None:
+                raise UnsupportedRecurrence("Multiple RRULEs")
+            rule = dict(part.split('=', 1) for part in value.split(';') if part)
+        elif prop == 'EXDATE':
+            exdates.update(_parse_ical_datetime(v, prop_tz).timestamp() for v in value.split(','))
+        elif prop == 'RDATE':
+            rdates.extend(_parse_ical_datetime(v, prop_tz) for v in value.split(','))
+    return rule, exdates, rdates
+
+
+def _days_in_month(year, month):
+    return ((date(year + month // 12, month % 12 + 1, 1)) - timedelta(days=1)).day
+
+
+def _month_days(year, month, rule, dtstart):
+    """Candidate days of a month for MONTHLY/YEARLY rules."""
+    last = _days_in_month(year, month)
+    days = set()
+    if 'BYMONTHDAY' in rule:
+        for token in rule['BYMONTHDAY'].split(','):
+            n = int(token)
+            n = last + n + 1 if n < 0 else n
+            if 1 <= n <= last:
+                days.add(n)
+    if 'BYDAY' in rule:
+        for token in rule['BYDAY'].split(','):
+            ordinal, weekday = token[:-2], RRULE_WEEKDAYS.index(token[-2:])
+            matches = [d for d in range(1, last + 1) if date(year, month, d).weekday() == weekday]
+            if ordinal:
+                index = int(ordinal)
+                if -len(matches) <= index <= len(matches) and index != 0:
+                    days.add(matches[index - 1 if index > 0 else index])
+            else:
+                days.update(matches)
+    if not days and 'BYMONTHDAY' not in rule and 'BYDAY' not in rule and dtstart.day <= last:
+        days.add(dtstart.day)
+    return [date(year, month, d) for d in sorted(days)]
+
+
+def _rrule_days(rule, dtstart, skip_before):
+    """Yield candidate days of an RRULE in order, starting from the period containing dtstart."""
+    freq = rule.get('FREQ')
+    interval = int(rule.get('INTERVAL', 1))
+    start_day = dtstart.date()
+    by_month = {int(m) for m in rule['BYMONTH'].split(',')} if 'BYMONTH' in rule else None
+    by_weekday = None
+    if 'BYDAY' in rule and freq in ('DAILY', 'WEEKLY'):
+        if any(token[:-2] for token in rule['BYDAY'].split(',')):
+            raise UnsupportedRecurrence("Ordinal BYDAY outside MONTHLY/YEARLY")
+        by_weekday = {RRULE_WEEKDAYS.index(token) for token in rule['BYDAY'].split(',')}
+    # Weeks (and so which weeks an INTERVAL skips) begin on WKST; Google writes WKST=SU
+    if rule.get('WKST', 'MO') not in RRULE_WEEKDAYS:
+        raise UnsupportedRecurrence(f"Unknown WKST {rule['WKST']}")
+    week_start_day = RRULE_WEEKDAYS.index(rule.get('WKST', 'MO'))
+
+    # Without COUNT earlier occurrences cannot affect the window, so jump close to it
+    skip_periods = 0
+    if 'COUNT' not in rule and skip_before > start_day:
+        unit = {'DAILY': 1, 'WEEKLY': 7}.get(freq)
+        if unit:
+            skip_periods = max(0, (skip_before - start_day).days // (unit * interval) - 1)
+
+    for period in range(skip_periods, skip_periods + MAX_RECURRENCE_PERIODS):
+        step = period * interval
+        if freq == 'DAILY':
+            candidates = [start_day + timedelta(days=step)]
+        elif freq == 'WEEKLY':
+            week_start = start_day - timedelta(days=(start_day.weekday() - week_start_day) % 7) + timedelta(weeks=step)
+            offsets = sorted((d - week_start_day) % 7 for d in by_weekday or {start_day.weekday()})
+            candidates = [week_start + timedelta(days=offset) for offset in offsets]
+        elif freq == 'MONTHLY':
+            month_index = start_day.month - 1 + step
+            candidates = _month_days(start_day.year + month_index // 12, month_index % 12 + 1, rule, dtstart)
+        elif freq == 'YEARLY':
+            year = start_day.year + step
+            months = sorted(by_month) if by_month else [start_day.month]
+            candidates = [d for month in months for d in _month_days(year, month, rule, dtstart)]
+        else:
+            raise UnsupportedRecurrence(f"Unsupported FREQ {freq}")
+
+        for day in candidates:
+            if by_month and day.month not in by_month:
+                continue
+            if freq == 'DAILY' and by_weekday and day.weekday() not in by_weekday:
+                continue
+            yield day
+
+
+def expand_recurrence(master, window_start, window_end, default_tz):
+    """
+    Expands a recurring master event into instance dicts overlapping [window_start, window_end).
+
+    Supports DAILY/WEEKLY/MONTHLY/YEARLY rules with INTERVAL, COUNT, UNTIL, BYDAY,
+    BYMONTHDAY, BYMONTH and WKST, plus EXDATE/RDATE. Raises UnsupportedRecurrence otherwise.
+    """
+    all_day = 'date' in master['start']
+    tz = resolve_timezone(master['start'].get('timeZone')) if master['start'].get('timeZone') else default_tz
+    if all_day:
+        dtstart = datetime.fromisoformat(master['start']['date']).replace(tzinfo=tz)
+        dtend = datetime.fromisoformat(master['end']['date']).replace(tzinfo=tz)
+    else:
+        dtstart = datetime.fromisoformat(master['start']['dateTime']).astimezone(tz)
+        dtend = datetime.fromisoformat(master['end']['dateTime']).astimezone(tz)
+    duration = dtend - dtstart
+
+    rule, exdates, rdates = _parse_recurrence(master.get('recurrence', []), tz)
+    if rule is None:
+        raise UnsupportedRecurrence("Missing RRULE")
+    if set(rule) - {'FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'BYDAY', 'BYMONTHDAY', 'BYMONTH', 'WKST'}:
+        raise UnsupportedRecurrence(f"Unsupported RRULE parts in {rule}")
+    count = int(rule['COUNT']) if 'COUNT' in rule else None
+    until = _parse_ical_datetime(rule['UNTIL'], tz) if 'UNTIL' in rule else None
+    if until and 'T' not in rule['UNTIL']:
+        until += timedelta(days=1, microseconds=-1)
+
+    occurrences = []
+    seen = 0
+    skip_before = (window_start - duration).astimezone(tz).date()
+    for day in _rrule_days(rule, dtstart, skip_before):
+        # Combine in the series' zone so instances keep their wall-clock time across DST
+        start = datetime.combine(day, dtstart.timetz().replace(tzinfo=None), tz)
+        if start < dtstart:
+            continue
+        if (until and start > until) or (count is not None and seen >= count) or start >= window_end:
+            break
+        seen += 1
+        occurrences.append(start)
+    occurrences.extend(r for r in rdates if window_start - duration < r < window_end)
+
+    instances = []
+    for start in sorted(set(occurrences)):
+        end = start + duration
+        if end <= window_start or start.timestamp() in exdates:
+            continue
+        instance = {k: v for k, v in master.items() if k != 'recurrence'}
+        if all_day:
+            instance['start'] = {'date': start.date().isoformat()}
+            instance['end'] = {'date': end.date().isoformat()}
+            instance['id'] = f"{master['id']}_{start.strftime('%Y%m%d')}"
+        else:
+            instance['start'] = {'dateTime': start.isoformat(), 'timeZone': str(tz)}
+            instance['end'] = {'dateTime': end.isoformat(), 'timeZone': str(tz)}
+            instance['id'] = f"{master['id']}_{start.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}"
+        instance['originalStartTime'] = dict(instance['start'])
+        instance['recurringEventId'] = master['id']
+        instances.append(instance)
+    return instances
+
+
+# ---------------- Helper: Near-Duplicate Clustering ----------------
+# 5 bands of 4 rows put the LSH candidate threshold near 0.67 Jaccard similarity
+MINHASH_BANDS = 5
+MINHASH_ROWS = 4
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', '0.6'))
+SHINGLE_WORDS = 3
+WORD_RE = re.compile(r'[^\W\d_]+|\d+')
+
+_MERSENNE_PRIME = (1 << 61) - 1
+# Fixed seed so clusters, and the cursors that skip over them, are stable between invocations
+_minhash_rng = random.Random(0x5EED)
+_MINHASH_PARAMS = [(_minhash_rng.randrange(1, _MERSENNE_PRIME), _minhash_rng.randrange(_MERSENNE_PRIME))
+                   for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+
+
+def shingles(text):
+    """Word 3-grams with numbers collapsed, so "Build #812 failed" and "Build #813 failed" match."""
+    words = ['#' if word.isdigit() else word for word in WORD_RE.findall(text.lower())]
+    if len(words) <= SHINGLE_WORDS:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def minhash(features):
+    if not features:
+        return None
+    hashes = [int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), 'little') for f in features]
+    return tuple(min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _MINHASH_PARAMS)
+
+
+def cluster_similar(records):
+    """
+    Group near-duplicate messages from the same sender using MinHash LSH, in one pass.
+
+    Returns, for every record, the index of its cluster's representative: the earliest
+    (newest) member. Each record is only compared with the first record of its LSH buckets.
+    """
+    parent = list(range(len(records)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets = {}
+    signatures = [minhash(shingles(f"{record.subject} {record.snippet}")) for record in records]
+    for i, (record, signature) in enumerate(zip(records, signatures)):
+        if signature is None:
+            continue
+        sender = parseaddr(record.sender)[1].lower()
+        for band in range(MINHASH_BANDS):
+            key = (sender, band, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS])
+            first = buckets.setdefault(key, i)
+            if first == i:
+                continue
+            agreement = sum(x == y for x, y in zip(signatures[first], signature)) / len(signature)
+            if agreement >= SIMILARITY_THRESHOLD:
+                root_a, root_b = find(first), find(i)
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+    return [find(i) for i in range(len(records))]
+
+
+# ---------------- Helper: Contact Index ----------------
+# A sighting counts half as much after this many days
+CONTACT_HALF_LIFE_DAYS = float(os.environ.get('CONTACT_HALF_LIFE_DAYS', '30'))
+CONTACT_SOURCES_MAX = 50_000  # message/event IDs remembered so re-fetches are not counted twice
+CONTACT_SEED_MESSAGES = 20  # messages searched to seed the index when a lookup finds nothing
+CONTACT_HEADERS = ('from', 'to', 'cc')
+
+
+class ContactMatch(NamedTuple):
+    name: str
+    address: str
+    count: int
+    last_seen: float
+
+
+def name_tokens(text):
+    """Lowercased, accent-free words of a name or address: "José.Pérez@x.io" -> jose, perez, x, io."""
+    folded = unicodedata.normalize('NFKD', text.lower())
+    return WORD_RE.findall(''.join(c for c in folded if not unicodedata.combining(c)))
+
+
+class _TrieNode:
+    __slots__ = ('children', 'addresses')
+
+    def __init__(self):
+        self.children = {}
+        self.addresses = set()
+
+
+class Contact:
+    """One address; weight is its sighting count decayed by age, as of the latest sighting."""
+    __slots__ = ('address', 'name', 'words', 'weight', 'updated', 'count')
+
+    def __init__(self, address):
+        self.address = address
+        self.name = ''
+        self.words = set()
+        self.weight = 0.0
+        self.updated = 0.0
+        self.count = 0
+
+    def seen(self, timestamp):
+        half_life = CONTACT_HALF_LIFE_DAYS * 86400
+        if timestamp >= self.updated:
+            self.weight = self.weight * 0.5 ** ((timestamp - self.updated) / half_life) + 1
+            self.updated = timestamp
+        else:
+            self.weight += 0.5 ** ((self.updated - timestamp) / half_life)
+        self.count += 1
+
+    def score(self, now):
+        return self.weight * 0.5 ** ((now - self.updated) / (CONTACT_HALF_LIFE_DAYS * 86400))
+
+
+class ContactIndex:
+    """
+    Prefix trie over the names and addresses of everyone seen in mail headers and event attendees.
+
+    Every word of a contact indexes it at each of its prefixes, so a lookup walks one node per
+    query character and ranks the matches by recency-weighted frequency.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._contacts = {}
+        self._sources = LRUCache(maxsize=CONTACT_SOURCES_MAX)
+        self._self = set()
+        self._lock = threading.Lock()
+
+    def _insert(self, contact, text):
+        for word in name_tokens(text):
+            if word in contact.words:
+                continue
+            contact.words.add(word)
+            node = self._root
+            for char in word:
+                node = node.children.setdefault(char, _TrieNode())
+                node.addresses.add(contact.address)
+
+    def add(self, source_id, people, timestamp, own=()):
+        """Record the (name, address) pairs of one message or event; own lists the user's addresses."""
+        timestamp = min(timestamp, datetime.now(timezone.utc).timestamp())
+        with self._lock:
+            self._self.update(address.lower() for address in own)
+            if source_id in self._sources:
+                return
+            self._sources[source_id] = True
+            for name, address in people:
+                address = address.strip().lower()
+                if '@' not in address:
+                    continue
+                contact = self._contacts.get(address)
+                if contact is None:
+                    contact = self._contacts[address] = Contact(address)
+                    self._insert(contact, address)
+                if name and (not contact.name or timestamp >= contact.updated):
+                    contact.name = name
+                if name:
+                    self._insert(contact, name)
+                contact.seen(timestamp)
+
+    def lookup(self, query, limit=5, now=None):
+        """Contacts with a word starting with each query word, best first."""
+        words = name_tokens(query)
+        if not words:
+            return []
+        now = now or datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            matches = None
+            for word in words:
+                node = self._root
+                for char in word:
+                    node = node.children.get(char)
+                    if node is None:
+                        return []
+                matches = node.addresses if matches is None else matches & node.addresses
+            ranked = heapq.nlargest(limit, (self._contacts[address] for address in matches if address not in self._self),
+                                    key=lambda contact: contact.score(now))
+            return [ContactMatch(c.name, c.address, c.count, c.updated) for c in ranked]
+
+
+_contact_indexes = {}
+_contact_indexes_lock = threading.Lock()
+
+
+def contact_index(user):
+    with _contact_indexes_lock:
+        return _contact_indexes.setdefault(user, ContactIndex())
+
+
+def index_message_contacts(user, message):
+    """Feed the From/To/Cc headers of a metadata-format message to the user's contact index."""
+    headers = message.get('payload', {}).get('headers', [])
+    people = getaddresses([h['value'] for h in headers if h['name'].lower() in CONTACT_HEADERS])
+    contact_index(user).add(('message', message['id']), people, int(message.get('internalDate', 0)) // 1000)
+
+
+def index_event_contacts(user, event, tz=timezone.utc):
+    """Feed the organizer and attendees of an event to the user's contact index."""
+    people = [event.get('organizer', {})] + event.get('attendees', [])
+    contact_index(user).add(
+        ('event', event['id']),
+        [(person.get('displayName', ''), person['email']) for person in people if person.get('email')],
+        event_start_key(event, tz) if 'start' in event else 0,
+        own=[person['email'] for person in people if person.get('self') and person.get('email')]
+    )
+
+
 # ---------------- Gmail Support ----------------
 def build_gmail_query(from_last_x_days=None, show_only_unread=False, subject_contains=None, sender_email=None):
     query_parts = []
     if from_last_x_days is not None:
-        from_last_x_days = min(int(from_last_x_days), 7)
+        from_last_x_days = min(int(from_last_x_days), MAX_WINDOW_DAYS)
         query_parts.append(f"newer_than:{from_last_x_days}d")
     if str(show_only_unread).lower() == 'true':
         query_parts.append("is:unread")
@@ -40,6 +1314,7 @@ def build_gmail_query(from_last_x_days=None, show_only_unread=False, subject_con
     return ' '.join(query_parts)
 
 
+@traced('auth.gmail')
 def authenticate_gmail():
     if os.path.exists('gmail_token.json'):
         creds = Credentials.from_authorized_user_file('gmail_token.json', GMAIL_READ_SCOPE)
@@ -51,31 +1326,610 @@ def authenticate_gmail():
     return creds
 
 
-def read_gmail(query):
-    creds = authenticate_gmail()
-    service = build('gmail', 'v1', credentials=creds)
-    emails = []
-    next_page_token = None
+def shard_gmail_query(query, now=None):
+    """Rewrite a newer_than:Nd query into newest-first after:/before: shards of SHARD_DAYS each."""
+    match = re.search(r'\bnewer_than:(\d+)d\b', query)
+    if not match or int(match.group(1)) <= SHARD_DAYS:
+        return [query]
+    base = (query[:match.start()] + query[match.end():]).strip()
+    # Hour-aligned boundaries keep shard queries (and their cache keys) stable between calls
+    now = (now or datetime.now(timezone.utc)).replace(minute=0, second=0, microsecond=0)
+    shards = split_window(now - timedelta(days=int(match.group(1))), now)
+    queries = []
+    for i, (start, end) in enumerate(reversed(shards)):
+        # The newest shard stays open-ended so mail arriving mid-request is not lost
+        before = f" before:{int(end.timestamp())}" if i else ""
+        queries.append(f"{base} after:{int(start.timestamp())}{before}".strip())
+    return queries
+
+
+@traced('gmail.fetch_shard')
+def fetch_gmail_shard(service, user, query, stop, skip=0):
+    """
+    Returns (records, cut short). Messages are listed a page at a time and fetched with one
+    batch per page. Fetching stops after the page that reaches the deadline or fills a
+    response with the records past the first `skip`; the shard is then cut short, keeps the
+    records that arrived, and the caller resumes after the last of them.
+    """
+    key = (user, 'gmail', query)
+    cached = cached_records(key)
+    if cached is not None:
+        return cached, False
+
+    records, size, complete = [], 0, True
+    request = service.users().messages().list(userId='me', q=query, maxResults=BATCH_SIZE)
+
+    try:
+        while request is not None and not stop.is_set():
+            results = execute_request(request)
+            message_ids = [msg['id'] for msg in results.get('messages', [])]
+            found = {message_id: cached_records((user, 'message', message_id)) for message_id in message_ids}
+            missing = [message_id for message_id in message_ids if found[message_id] is None]
+            gets = [
+                service.users().messages().get(userId='me', id=message_id, format='metadata',
+                                               metadataHeaders=['From', 'To', 'Cc', 'Subject'])
+                for message_id in missing
+            ]
+            for message_id, (msg_data, error) in zip(missing, execute_batch(service, gets) if gets else []):
+                if error is not None:
+                    logger.warning("Could not load message %s: %s", message_id, error)
+                    complete = False
+                    continue
+                index_message_contacts(user, msg_data)
+                found[message_id] = cache_records((user, 'message', message_id), [MailRecord.from_message(msg_data)])
+
+            for message_id in message_ids:
+                for record in found[message_id] or ():
+                    if len(records) >= skip:
+                        size += len(record.format()) + 2
+                    records.append(record)
+
+            request = service.users().messages().list_next(request, results)
+            if request is not None and (deadline_passed() or size >= MAX_RESPONSE_CHARS):
+                return records, True
+    except DeadlineExceeded:
+        return records, True
+
+    # A shard cut short by the response budget, or missing a message, must not be cached
+    return (records if stop.is_set() or not complete else cache_records(key, records)), False
+
+
+def read_gmail(query, cursor=None, group_similar=True):
+    """
+    Returns (emails, next cursor). The cursor pins the shard layout and records the shard,
+    offset and ID of the first message not shown, so a follow-up resumes there.
+
+    With group_similar, near-duplicates from one sender within a shard are shown once, as
+    their newest message with a count of the others.
+    """
+    creds = authenticate_gmail()
+    service = build_service('gmail', 'v1', creds)
+    user = user_cache_key(creds)
+    stop = threading.Event()
+
+    anchor = cursor['t'] if cursor else int(datetime.now(timezone.utc).timestamp()) // 3600 * 3600
+    shard_queries = shard_gmail_query(query, now=datetime.fromtimestamp(anchor, timezone.utc))
+    first_shard = cursor['s'] if cursor else 0
+    group_similar = cursor.get('g', group_similar) if cursor else group_similar
+    futures = {
+        index: submit_traced(_upstream_pool, fetch_gmail_shard, service, user, shard_queries[index], stop,
+                             cursor['o'] if cursor and index == first_shard else 0)
+        for index in range(first_shard, len(shard_queries))
+    }
+
+    def entries():
+        # Shards are disjoint and newest-first, so streaming them in order keeps the result ordered
+        for index, future in futures.items():
+            records, cut_short = future.result()
+            start = 0
+            if cursor and index == first_shard:
+                ids = [record.id for record in records]
+                start = ids.index(cursor['a']) if cursor.get('a') in ids else min(cursor['o'], len(records))
+            # Clusters span the whole shard, so members of a cluster shown on an earlier page stay hidden
+            clusters = cluster_similar(records) if group_similar else range(len(records))
+            sizes = Counter(clusters)
+            for offset in range(start, len(records)):
+                if clusters[offset] != offset:
+                    continue
+                text = records[offset].format()
+                if sizes[offset] > 1:
+                    text += f"\nSimilar: {sizes[offset] - 1} more like this from {records[offset].sender}"
+                yield (index, offset, records[offset].id), text
+            if cut_short:
+                # The deadline or response budget stopped this shard; the page ends here and resumes at its next message
+                yield (index, max(start, len(records)), None), None
+                return
+
+    emails, next_position = collect_page(entries(), stop=stop)
+    next_cursor = None
+    if next_position:
+        shard, offset, message_id = next_position
+        next_cursor = {'q': query, 't': anchor, 's': shard, 'o': offset, 'a': message_id, 'g': group_similar}
+        emails.append(more_results_hint())
+    return emails or ["No emails found matching the criteria."], next_cursor
+
+
+def _header_map(message):
+    return {h['name'].lower(): h['value'] for h in message.get('payload', {}).get('headers', [])}
+
+
+def summarize_thread(thread):
+    """Collapse a metadata-format thread into a single conversation record."""
+    messages = thread.get('messages', [])
+    participants = []
+    for message in messages:
+        sender = _header_map(message).get('from', '')
+        name = parseaddr(sender)[0] or parseaddr(sender)[1]
+        if name and name not in participants:
+            participants.append(name)
+
+    first = _header_map(messages[0]) if messages else {}
+    latest_message = max(messages, key=lambda m: int(m.get('internalDate', 0)), default={})
+    latest = _header_map(latest_message)
+    return {
+        'id': thread['id'],
+        'subject': first.get('subject', 'No Subject'),
+        'participants': participants,
+        'message_count': len(messages),
+        'unread': any('UNREAD' in m.get('labelIds', []) for m in messages),
+        'latest_from': latest.get('from', ''),
+        'latest_date': latest.get('date', ''),
+        'snippet': latest_message.get('snippet', ''),
+    }
+
+
+def _stream_threads(service, user, query, page_token=None, skip=0):
+    while True:
+        try:
+            results = execute_request(service.users().threads().list(
+                userId='me', q=query, maxResults=BATCH_SIZE, pageToken=page_token
+            ))
+            thread_ids = [t['id'] for t in results.get('threads', [])][skip:]
+            gets = [
+                service.users().threads().get(userId='me', id=thread_id, format='metadata',
+                                              metadataHeaders=['From', 'To', 'Cc', 'Subject', 'Date'])
+                for thread_id in thread_ids
+            ]
+            responses = execute_batch(service, gets)
+        except DeadlineExceeded:
+            yield (page_token, skip), None
+            return
+        for offset, (thread_id, (thread, error)) in enumerate(zip(thread_ids, responses), skip):
+            if error is not None:
+                logger.warning("Could not load thread %s: %s", thread_id, error)
+                continue
+            for message in thread.get('messages', []):
+                index_message_contacts(user, message)
+            record = summarize_thread(thread)
+            state = "unread" if record['unread'] else "read"
+            yield (page_token, offset), (
+                f"Thread ID: {record['id']}\nSubject: {record['subject']}\n"
+                f"Participants: {', '.join(record['participants'])}\n"
+                f"Messages: {record['message_count']} ({state})\n"
+                f"Latest: {record['latest_from']} on {record['latest_date']}\nSnippet: {record['snippet']}"
+            )
+        page_token, skip = results.get('nextPageToken'), 0
+        if not page_token:
+            return
+
+
+def read_gmail_threads(query, cursor=None):
+    """
+    Conversation view of read_gmail: one record per thread, fetched with batched threads.get calls.
+
+    Returns (threads, next cursor); the cursor holds the page token and offset to resume from.
+    """
+    creds = authenticate_gmail()
+    service = build_service('gmail', 'v1', creds)
+    # Pages are only requested while the response budget has room
+    entries = _stream_threads(service, user_cache_key(creds), query, *((cursor['p'], cursor['o']) if cursor else ()))
+    threads, next_position = collect_page(entries)
+    next_cursor = None
+    if next_position:
+        page_token, offset = next_position
+        next_cursor = {'q': query, 'p': page_token, 'o': offset}
+        threads.append(more_results_hint())
+    return threads or ["No emails found matching the criteria."], next_cursor
+
+
+# ---------------- Gmail Message Bodies ----------------
+MAX_BODY_CHARS = int(os.environ.get('MAX_BODY_CHARS', '8000'))
+BODY_CACHE_BYTES = int(os.environ.get('BODY_CACHE_BYTES', str(8 * 1024 * 1024)))
+# HTML bigger than this is converted in a worker process so it does not hold the GIL
+HTML_PROCESS_THRESHOLD = 200_000
+RAW_DECODE_CHUNK = 64 * 1024  # multiple of 4 so base64 chunks decode independently
+
+_body_cache = LRUCache(maxsize=BODY_CACHE_BYTES, getsizeof=len)
+_html_pool = None
+_html_pool_lock = threading.Lock()
+
+
+class _HTMLTextExtractor(HTMLParser):
+    BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'table'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    extractor = _HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    text = ''.join(extractor.parts)
+    lines = (' '.join(line.split()) for line in text.splitlines())
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def _html_executor():
+    """The shared HTML process pool, created once even when several fetch threads need it at the same time."""
+    global _html_pool
+    with _html_pool_lock:
+        if _html_pool is None:
+            _html_pool = ProcessPoolExecutor(max_workers=2)
+        return _html_pool
+
+
+def _convert_html(html):
+    global _html_pool
+    if len(html) < HTML_PROCESS_THRESHOLD:
+        return html_to_text(html)
+    pool = None
+    try:
+        pool = _html_executor()
+        return pool.submit(html_to_text, html).result()
+    except (OSError, NotImplementedError, BrokenProcessPool) as e:
+        # Lambda has no /dev/shm, so multiprocessing is unavailable there
+        logger.info("Converting HTML in-process: %s", e)
+        with _html_pool_lock:
+            # Another thread may already have replaced the failed pool
+            if pool is not None and _html_pool is pool:
+                _html_pool = None
+        return html_to_text(html)
+
+
+@traced('gmail.parse_raw_message')
+def parse_raw_message(raw, max_chars=None):
+    """
+    Decodes a base64url RFC 822 message chunk by chunk into an incremental MIME parser
+    and returns its headers and readable text body, truncated to max_chars.
+    """
+    max_chars = max_chars or MAX_BODY_CHARS
+    parser = BytesFeedParser(policy=email.policy.default)
+    for i in range(0, len(raw), RAW_DECODE_CHUNK):
+        chunk = raw[i:i + RAW_DECODE_CHUNK]
+        parser.feed(base64.urlsafe_b64decode(chunk + '=' * (-len(chunk) % 4)))
+    message = parser.close()
+
+    part = message.get_body(preferencelist=('plain', 'html'))
+    try:
+        content = part.get_content() if part is not None else ''
+    except (LookupError, UnicodeDecodeError):
+        content = part.get_payload(decode=True).decode('utf-8', errors='replace')
+    if part is not None and part.get_content_type() == 'text/html':
+        content = _convert_html(content)
+    content = content.strip()
+    if len(content) > max_chars:
+        content = content[:max_chars].rstrip() + "\n[... truncated]"
+
+    return {
+        'from': str(message.get('From', '')),
+        'subject': str(message.get('Subject', 'No Subject')),
+        'date': str(message.get('Date', '')),
+        'body': content,
+    }
+
+
+@traced('gmail.fetch_body')
+def _fetch_email_body(service, message_id):
+    msg_data = execute_request(service.users().messages().get(userId='me', id=message_id, format='raw'))
+    parsed = parse_raw_message(msg_data['raw'])
+    return (f"ID: {message_id}\nFrom: {parsed['from']}\nSubject: {parsed['subject']}\n"
+            f"Date: {parsed['date']}\n\n{parsed['body']}")
+
+
+def get_email_body(message_ids):
+    """Return the decoded text bodies of the given messages; bodies are cached by message ID."""
+    creds = authenticate_gmail()
+    user = user_cache_key(creds)
+    bodies = {message_id: _body_cache.get((user, message_id)) for message_id in message_ids}
+
+    missing = [message_id for message_id, body in bodies.items() if body is None]
+    if missing:
+        service = build_service('gmail', 'v1', creds)
+        futures = {message_id: submit_traced(_upstream_pool, _fetch_email_body, service, message_id) for message_id in missing}
+        for message_id, future in futures.items():
+            try:
+                bodies[message_id] = _body_cache[(user, message_id)] = future.result()
+            except Exception as e:
+                bodies[message_id] = f"ID: {message_id}\nCould not load message: {e}"
+
+    return collect_within_budget(bodies[message_id] for message_id in message_ids) or ["No message IDs given."]
+
+# ---------------- Gmail Attachments ----------------
+ATTACHMENT_DIR = os.environ.get('ATTACHMENT_DIR', '/tmp/attachments')
+ATTACHMENT_CACHE_BYTES = int(os.environ.get('ATTACHMENT_CACHE_BYTES', str(256 * 1024 * 1024)))
+ATTACHMENT_CHUNK = 256 * 1024  # multiple of 4 so base64 chunks decode independently
+ATTACHMENT_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/messages/{}/attachments/{}?fields=data'
+TEXT_MIME_TYPES = {'application/json', 'application/xml', 'application/csv', 'application/x-yaml', 'message/rfc822'}
+DATA_FIELD_RE = re.compile(rb'"data"\s*:\s*"')
+
+
+def _part_fields(depth):
+    fields = 'partId,filename,mimeType,body(size,attachmentId)'
+    return f"{fields},parts({_part_fields(depth - 1)})" if depth > 1 else fields
+
+
+ATTACHMENT_FIELDS = f"id,payload({_part_fields(5)})"
+# (user, message id) -> attachment parts; attachment IDs are too long for the agent to pass around
+_attachment_parts = LRUCache(maxsize=1000)
+# (user, message id, part id) -> sha256 of the downloaded content
+_attachment_files = LRUCache(maxsize=10000)
+_attachment_lock = threading.Lock()
+
+
+def _walk_attachments(part):
+    if part.get('filename') and part.get('body', {}).get('attachmentId'):
+        yield {
+            'part_id': part.get('partId', ''),
+            'filename': part['filename'],
+            'mime_type': part.get('mimeType', 'application/octet-stream'),
+            'size': part['body'].get('size', 0),
+            'attachment_id': part['body']['attachmentId'],
+        }
+    for child in part.get('parts', []):
+        yield from _walk_attachments(child)
+
+
+def _load_attachment_parts(service, user, message_ids):
+    """Attachment parts of each message, from the part tree only (no bodies are fetched)."""
+    parts = {message_id: _attachment_parts.get((user, message_id)) for message_id in message_ids}
+    missing = [message_id for message_id, found in parts.items() if found is None]
+    gets = [service.users().messages().get(userId='me', id=message_id, format='full', fields=ATTACHMENT_FIELDS)
+            for message_id in missing]
+    for message_id, (message, error) in zip(missing, execute_batch(service, gets)):
+        if error is not None:
+            parts[message_id] = error
+            continue
+        parts[message_id] = _attachment_parts[(user, message_id)] = list(_walk_attachments(message.get('payload', {})))
+    return parts
+
+
+def list_attachments(message_ids):
+    """List the attachments of the given messages without downloading them."""
+    creds = authenticate_gmail()
+    parts = _load_attachment_parts(build_service('gmail', 'v1', creds), user_cache_key(creds), message_ids)
+    lines = []
+    for message_id in message_ids:
+        found = parts[message_id]
+        if isinstance(found, Exception):
+            lines.append(f"ID: {message_id}\nCould not load message: {found}")
+        elif not found:
+            lines.append(f"ID: {message_id}\nNo attachments.")
+        else:
+            lines.append(f"ID: {message_id}\n" + "\n".join(
+                f"Part {part['part_id']}: {part['filename']} ({part['mime_type']}, {part['size']} bytes)" for part in found
+            ))
+    return collect_within_budget(lines) or ["No message IDs given."]
+
+
+def _stream_attachment(creds, message_id, attachment_id, out):
+    """
+    Download one attachment into out, decoding its base64url JSON payload as it arrives.
+
+    The response is read ATTACHMENT_CHUNK bytes at a time, so memory stays flat whatever the
+    size of the file. Returns the sha256 hex digest and size of the decoded content.
+    """
+    url = ATTACHMENT_URL.format(message_id, attachment_id)
+    headers = {'Accept-Encoding': 'identity'}
+    creds.before_request(AuthRequest(httplib2.Http()), 'GET', url, headers)
+    digest, size = hashlib.sha256(), 0
+    with span('google.attachment', {'message.id': message_id}, kind=SPAN_KIND_CLIENT), _upstream_slots:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=_request_timeout()) as response:
+            # Skip the JSON up to the opening quote of the data value
+            pending = b''
+            while (match := DATA_FIELD_RE.search(pending)) is None:
+                chunk = response.read(ATTACHMENT_CHUNK)
+                if not chunk:
+                    raise ValueError("The attachment response had no data")
+                pending = pending[-16:] + chunk
+            pending = pending[match.end():]
+            while True:
+                end = pending.find(b'"')
+                usable = end if end >= 0 else len(pending) - len(pending) % 4
+                if usable:
+                    decoded = base64.urlsafe_b64decode(pending[:usable] + b'=' * (-usable % 4))
+                    out.write(decoded)
+                    digest.update(decoded)
+                    size += len(decoded)
+                if end >= 0:
+                    break
+                if size > ATTACHMENT_CACHE_BYTES:
+                    raise ValueError("The attachment is larger than the attachment cache")
+                if deadline_passed():
+                    raise DeadlineExceeded("The attachment did not download in time")
+                chunk = response.read(ATTACHMENT_CHUNK)
+                if not chunk:
+                    raise ValueError("The attachment response ended early")
+                pending = pending[usable:] + chunk
+    return digest.hexdigest(), size
+
+
+def _evict_attachments():
+    """Delete the least recently used files until the cache fits ATTACHMENT_CACHE_BYTES."""
+    files = [entry for entry in os.scandir(ATTACHMENT_DIR) if entry.is_file() and not entry.name.endswith('.part')]
+    files.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in files)
+    for entry in files[:-1]:
+        if total <= ATTACHMENT_CACHE_BYTES:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def fetch_attachment(creds, user, message_id, part):
+    """
+    Path of the cached file for an attachment part, downloading it if needed.
+
+    Files are stored under their sha256, so the same file attached to several messages is kept once.
+    """
+    os.makedirs(ATTACHMENT_DIR, exist_ok=True)
+    key = (user, message_id, part['part_id'])
+    digest = _attachment_files.get(key)
+    path = digest and os.path.join(ATTACHMENT_DIR, digest)
+    if path and os.path.exists(path):
+        os.utime(path)
+        return path
+
+    with tempfile.NamedTemporaryFile(dir=ATTACHMENT_DIR, suffix='.part', delete=False) as out:
+        try:
+            digest, _ = _stream_attachment(creds, message_id, part['attachment_id'], out)
+        except BaseException:
+            out.close()
+            os.remove(out.name)
+            raise
+    path = os.path.join(ATTACHMENT_DIR, digest)
+    with _attachment_lock:
+        if os.path.exists(path):
+            os.remove(out.name)
+            os.utime(path)
+        else:
+            os.replace(out.name, path)
+        _attachment_files[key] = digest
+        _evict_attachments()
+    return path
+
+
+@contextmanager
+def attachment_view(path):
+    """Read-only memory map of a cached attachment, for text extraction without loading the file."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            yield view
+
+
+def extract_attachment_text(path, mime_type, max_chars=None):
+    """Leading text of a text-like attachment, or None for binary formats."""
+    max_chars = max_chars or MAX_BODY_CHARS
+    if not (mime_type.startswith('text/') or mime_type in TEXT_MIME_TYPES):
+        return None
+    with attachment_view(path) as view:
+        # 4 bytes per character is the UTF-8 worst case, so this slice always covers max_chars
+        text = view[:max_chars * 4].decode('utf-8', errors='ignore')
+        truncated = len(view) > max_chars * 4
+    if mime_type == 'text/html':
+        text = _convert_html(text)
+    text = text.strip()
+    if truncated or len(text) > max_chars:
+        text = text[:max_chars].rstrip() + "\n[... truncated]"
+    return text
+
+
+def get_attachment(message_id, part_id=None, filename=None):
+    """
+    Download one attachment of a message to the local cache and return its text where it has any.
+
+    The attachment is picked by part_id or filename; a message with a single attachment needs neither.
+    """
+    creds = authenticate_gmail()
+    user = user_cache_key(creds)
+    found = _load_attachment_parts(build_service('gmail', 'v1', creds), user, [message_id])[message_id]
+    if isinstance(found, Exception):
+        raise ValueError(f"could not load message {message_id}: {found}")
+    if part_id:
+        found = [part for part in found if part['part_id'] == str(part_id)]
+    elif filename:
+        found = [part for part in found if part['filename'].lower() == filename.lower()]
+    if not found:
+        raise ValueError(f"message {message_id} has no matching attachment")
+    if len(found) > 1:
+        raise ValueError("the message has several attachments; pass part_id or filename: "
+                         + ", ".join(f"{part['part_id']} ({part['filename']})" for part in found))
+
+    part = found[0]
+    path = fetch_attachment(creds, user, message_id, part)
+    header = (f"ID: {message_id}\nAttachment: {part['filename']} ({part['mime_type']}, "
+              f"{os.path.getsize(path)} bytes)\nSHA-256: {os.path.basename(path)}")
+    text = extract_attachment_text(path, part['mime_type'])
+    if text is None:
+        return [header + "\nNo text could be extracted from this file type."]
+    return [header + "\n\n" + text]
+
+#========== Contact Resolution =========
+def _seed_contacts(service, user, name):
+    # A cold index is seeded from the latest messages that mention the name in an address header
+    term = '"' + name.replace('"', '') + '"'
+    results = execute_request(service.users().messages().list(
+        userId='me', q=f"{{from:{term} to:{term} cc:{term}}}", maxResults=CONTACT_SEED_MESSAGES
+    ))
+    gets = [
+        service.users().messages().get(userId='me', id=msg['id'], format='metadata', metadataHeaders=['From', 'To', 'Cc'])
+        for msg in results.get('messages', [])
+    ]
+    for message, error in execute_batch(service, gets):
+        if error is None:
+            index_message_contacts(user, message)
+
+
+def resolve_contact(name, limit=5):
+    """
+    Email addresses for a person's name (or part of it), most frequent and recent correspondents first.
+
+    Answered from the contact index built out of mail and calendar data already fetched; only
+    when that has no match is Gmail searched for the name.
+    """
+    if not name or not name_tokens(name):
+        return ["No contact name given."]
+    creds = authenticate_gmail()
+    user = user_cache_key(creds)
+    matches = contact_index(user).lookup(name, limit)
+    if not matches:
+        _seed_contacts(build_service('gmail', 'v1', creds), user, name)
+        matches = contact_index(user).lookup(name, limit)
+    if not matches:
+        return [f"No contacts found matching '{name}'."]
+    return [
+        f"{formataddr((match.name, match.address))} (seen {match.count} time{'s' if match.count != 1 else ''}, last on "
+        f"{datetime.fromtimestamp(match.last_seen, timezone.utc).date().isoformat()})"
+        for match in matches
+    ]
+
+#========== Gmail Send =========
+def gmail_send_request(service, to_email, subject, body):
+    message = MIMEText(body)
+    message['to'] = to_email
+    message['subject'] = subject
+
+    raw_message = base64.urlsafe_b64encode(message.as_bytes())
 
-    while True:
-        results = service.users().messages().list(userId='me', q=query, pageToken=next_page_token).execute()
-        messages = results.get('messages', [])
-
-        for msg in messages:
-            msg_data = service.users().messages().get(userId='me', id=msg['id']).execute()
-            headers = msg_data['payload']['headers']
-            subject = [h['value'] for h in headers if h['name'] == 'Subject']
-            snippet = msg_data.get('snippet')
-            emails.append(f"Subject: {subject[0] if subject else 'No Subject'}\nSnippet: {snippet}")
-
-        next_page_token = results.get('nextPageToken')
-        if not next_page_token:
-            break
+    return service.users().messages().send(
+        userId='me',
+        body={'raw': raw_message.decode()}
+    )
 
-    return emails or ["No emails found matching the criteria."]
 
-#========== Gmail Send =========
-def send_gmail(to_email: str, subject: str, body: str) -> dict:
+def send_gmail(to_email: str, subject: str, body: str, async_mode: bool = False) -> dict:
     """
     Sends an email via Gmail API.
 
@@ -83,24 +1937,24 @@ def send_gmail(to_email: str, subject: str, body: str) -> dict:
     - to_email: Email address of the primary recipient (required)
     - subject: The subject line of the email (required)
     - body: The plain text content of the email (required)
+    - async_mode: Queue the email in the outbox and return without waiting for Gmail
 
     Returns:
-    - Dictionary with status and message ID if successful
+    - Dictionary with status and message ID if successful, or the operation ID if queued
     """
     try:
         creds = authenticate_gmail()
-        service = build('gmail', 'v1', credentials=creds)
-
-        message = MIMEText(body)
-        message['to'] = to_email
-        message['subject'] = subject
-
-        raw_message = base64.urlsafe_b64encode(message.as_bytes())
+        if async_mode:
+            operation_id = outbox().submit(user_cache_key(creds), 'send_gmail',
+                                           {'to_email': to_email, 'subject': subject, 'body': body})
+            return {
+                'status': 'queued',
+                'operation_id': operation_id,
+                'recipient': to_email
+            }
 
-        send_result = service.users().messages().send(
-            userId='me',
-            body={'raw': raw_message.decode()}
-        ).execute()
+        service = build_service('gmail', 'v1', creds)
+        send_result = execute_request(gmail_send_request(service, to_email, subject, body))
 
         return {
             'status': 'success',
@@ -115,7 +1969,91 @@ def send_gmail(to_email: str, subject: str, body: str) -> dict:
         }
 
 
+#========== Gmail Bulk Send =========
+MAX_BULK_RECIPIENTS = int(os.environ.get('MAX_BULK_RECIPIENTS', '100'))
+BULK_SEND_CONCURRENCY = int(os.environ.get('BULK_SEND_CONCURRENCY', '2'))
+TEMPLATE_FIELD_RE = re.compile(r'\{(\w+)\}')
+
+_bulk_send_slots = threading.BoundedSemaphore(BULK_SEND_CONCURRENCY)
+
+
+def render_template(template, fields):
+    """Fill {field} placeholders; unknown placeholders and other braces are left untouched."""
+    return TEMPLATE_FIELD_RE.sub(lambda m: str(fields.get(m.group(1), m.group(0))), template or '')
+
+
+def _recipient_fields(recipient):
+    if isinstance(recipient, dict):
+        fields = {k: v for k, v in recipient.items() if v is not None}
+        fields['email'] = fields.get('email') or fields.get('to_email', '')
+    else:
+        name, address = parseaddr(str(recipient))
+        fields = {'email': address, 'name': name}
+    fields.setdefault('name', '')
+    fields.setdefault('first_name', fields['name'].split(' ')[0] if fields['name'] else '')
+    return fields
+
+
+def _send_chunk(service, requests):
+    with _bulk_send_slots:
+        return execute_batch(service, requests)
+
+
+def send_gmail_bulk(recipients, subject: str, body: str) -> list:
+    """
+    Sends a templated email to many recipients via batched Gmail API requests.
+
+    Parameters:
+    - recipients: list of addresses ("Jane Doe <jane@example.com>") or dicts with an
+      'email' key plus any template fields
+    - subject, body: templates with {field} placeholders, e.g. {first_name}
+
+    Returns:
+    - List of per-recipient dictionaries with status and message ID or error
+    """
+    recipients = [_recipient_fields(r) for r in recipients]
+    if len(recipients) > MAX_BULK_RECIPIENTS:
+        raise ValueError(f"At most {MAX_BULK_RECIPIENTS} recipients per bulk send")
+
+    creds = authenticate_gmail()
+    service = build_service('gmail', 'v1', creds)
+
+    # Recipients sharing a rendered body share one MIME body encoding
+    encoded_bodies = {}
+    requests, statuses = [], []
+    for fields in recipients:
+        if not fields['email']:
+            statuses.append({'recipient': fields.get('name') or '?', 'status': 'error', 'error': 'Missing email address'})
+            continue
+        if '@' not in fields['email']:
+            statuses.append({'recipient': fields['email'], 'status': 'error', 'error': 'Not an email address'})
+            continue
+        rendered_body = render_template(body, fields)
+        encoded = encoded_bodies.get(rendered_body)
+        if encoded is None:
+            encoded = encoded_bodies[rendered_body] = MIMEText(rendered_body, 'plain', 'utf-8').as_bytes()
+        rendered_subject = render_template(subject, fields)
+        headers = (f"To: {formataddr((fields['name'], fields['email']))}\n"
+                   f"Subject: {Header(rendered_subject, 'utf-8').encode()}\n").encode()
+        raw = base64.urlsafe_b64encode(headers + encoded).decode()
+        requests.append(service.users().messages().send(userId='me', body={'raw': raw}))
+        statuses.append({'recipient': fields['email'], 'status': 'pending'})
+
+    chunks = [requests[i:i + BATCH_SIZE] for i in range(0, len(requests), BATCH_SIZE)]
+    futures = [submit_traced(_upstream_pool, _send_chunk, service, chunk) for chunk in chunks]
+    results = [result for future in futures for result in future.result()]
+
+    pending = (s for s in statuses if s['status'] == 'pending')
+    for status, (response, error) in zip(pending, results):
+        if error is None:
+            status.update(status='success', message_id=response['id'])
+        else:
+            status.update(status='error', error=str(error))
+    return statuses
+
+
 # ---------------- Calendar Support ----------------
+@traced('auth.calendar')
 def authenticate_calendar():
     if os.path.exists('calendar_token.json'):
         creds = Credentials.from_authorized_user_file('calendar_token.json', CALENDAR_READ_SCOPE)
@@ -127,27 +2065,31 @@ def authenticate_calendar():
     return creds
 
 
-def build_calendar_filter(next_x_days=None, specific_date=None, specific_day=None, specific_time=None, title_keyword=None):
-    tz = timezone.utc
+def build_calendar_filter(next_x_days=None, specific_date=None, specific_day=None, specific_time=None, title_keyword=None,
+                          when=None, time_zone=None, expand_recurring=False):
+    tz_name = time_zone or DEFAULT_TIMEZONE
+    tz = resolve_timezone(tz_name)
     now = datetime.now(tz)
     time_min = now
     time_max = None
     time_range = None
 
-    if next_x_days:
-        next_x_days = min(int(next_x_days), 7)
+    span = parse_time_expression(when, tz_name, now) if when else None
+    if span:
+        time_min = max(span.start, now) if span.start.date() == now.date() and not span.has_time else span.start
+        time_max = span.end
+    elif next_x_days:
+        next_x_days = min(int(next_x_days), MAX_WINDOW_DAYS)
         time_max = now + timedelta(days=next_x_days)
     elif specific_date:
         date = datetime.strptime(specific_date, "%Y-%m-%d").replace(tzinfo=tz)
         time_min = date
         time_max = date + timedelta(days=1)
     elif specific_day:
-        weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-        target = weekdays.index(specific_day.lower())
-        delta = (target - now.weekday() + 7) % 7
-        target_date = now + timedelta(days=delta)
-        time_min = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
-        time_max = time_min + timedelta(days=1)
+        day_span = parse_time_expression(specific_day, tz_name, now)
+        if day_span is None:
+            raise ValueError(f"Unrecognized day: {specific_day}")
+        time_min, time_max = day_span.start, day_span.end
 
     if specific_time:
         if '-' in specific_time:
@@ -163,70 +2105,367 @@ def build_calendar_filter(next_x_days=None, specific_date=None, specific_day=Non
         "timeMin": time_min.isoformat(),
         "timeMax": time_max.isoformat() if time_max else None,
         "titleKeyword": title_keyword.lower() if title_keyword else None,
-        "approxTimeRange": time_range
+        "approxTimeRange": time_range,
+        # All-day events have no time of day, so they never match a window that has one
+        "hasTime": bool(span and span.has_time) or time_range is not None,
+        "timeZone": tz_name,
+        "expandRecurring": str(expand_recurring).lower() == 'true'
     }
 
 
-def read_calendar(filters):
-    print(1)
-    creds = authenticate_calendar()
-    print(2)
-    service = build('calendar', 'v3', credentials=creds)
-    print(3)
-    time_min = filters['timeMin']
-    time_max = filters['timeMax']
+CALENDAR_LIST_TTL = int(os.environ.get('CALENDAR_LIST_TTL', '900'))
+_calendar_list_cache = TTLCache(maxsize=256, ttl=CALENDAR_LIST_TTL)
 
-    results = service.events().list(
-        calendarId='primary',
+
+@traced('calendar.list_calendars')
+def list_calendars(service, creds):
+    """Return the selected calendars for the user, cached for CALENDAR_LIST_TTL seconds."""
+    key = user_cache_key(creds)
+    calendars = _calendar_list_cache.get(key)
+    if calendars is not None:
+        return calendars
+
+    calendars = []
+    request = service.calendarList().list(
+        minAccessRole='reader',
+        fields='items(id,summary,summaryOverride,primary,selected,timeZone),nextPageToken'
+    )
+    while request is not None:
+        response = execute_request(request)
+        for item in response.get('items', []):
+            if item.get('primary') or item.get('selected'):
+                calendars.append({
+                    'id': item['id'],
+                    'name': item.get('summaryOverride') or item.get('summary') or item['id'],
+                    'primary': bool(item.get('primary')),
+                    'timeZone': item.get('timeZone'),
+                })
+        request = service.calendarList().list_next(request, response)
+
+    calendars = calendars or [{'id': 'primary', 'name': 'primary', 'primary': True}]
+    _calendar_list_cache[key] = calendars
+    return calendars
+
+
+def event_start_key(event, tz=timezone.utc):
+    """Sort key for an event: its start as a UTC epoch (all-day events start at local midnight)."""
+    start = event.get('start', {})
+    if 'dateTime' in start:
+        return datetime.fromisoformat(start['dateTime']).timestamp()
+    if 'date' in start:
+        return datetime.fromisoformat(start['date']).replace(tzinfo=tz).timestamp()
+    return 0.0
+
+
+EVENT_FIELDS = ('items(id,iCalUID,etag,status,summary,start,end,organizer(email,displayName,self),'
+                'attendees(email,displayName,self),hangoutLink,location),nextPageToken')
+
+
+@traced('calendar.fetch_events')
+def fetch_calendar_events(service, user, calendar, time_min, time_max, stop=None, fresh=False):
+    """
+    Fetch every event instance of one calendar in the window as EventRecords sorted by start.
+
+    fresh skips the cache lookup (the result is still cached), for callers that need current etags.
+    """
+    key = (user, 'calendar', calendar['id'], time_min, time_max)
+    cached = None if fresh else cached_records(key)
+    if cached is not None:
+        return cached
+
+    tz = resolve_timezone(calendar.get('timeZone'))
+    records = []
+    request = service.events().list(
+        calendarId=calendar['id'],
         timeMin=time_min,
         timeMax=time_max,
         singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-    print(4)
-
-    events = results.get('items', [])
-    summaries = []
-
-    for event in events:
-        summary = event.get('summary', 'No Title')
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        end = event['end'].get('dateTime', event['end'].get('date'))
-        description = event.get('description', '')
-        location = event.get('location', '')
-        link = event.get('hangoutLink', '')
-        organizer = event.get('organizer', {}).get('email', '')
-
-        if filters["titleKeyword"] and filters["titleKeyword"] not in summary.lower():
+        orderBy='startTime',
+        fields=EVENT_FIELDS
+    )
+    while request is not None and not (stop and stop.is_set()):
+        response = execute_request(request)
+        for event in response.get('items', []):
+            records.append(EventRecord.from_event(event, calendar, tz))
+            index_event_contacts(user, event, tz)
+        request = service.events().list_next(request, response)
+    return records if stop and stop.is_set() else cache_records(key, records)
+
+
+SERIES_CACHE_TTL = int(os.environ.get('SERIES_CACHE_TTL', '600'))
+LOCAL_EXPANSION_MIN_DAYS = 30
+SERIES_CACHE_BYTES = int(os.environ.get('SERIES_CACHE_BYTES', str(16 * 1024 * 1024)))
+# Raw series are measured by their serialized size
+_series_cache = TTLCache(maxsize=SERIES_CACHE_BYTES, ttl=SERIES_CACHE_TTL,
+                         getsizeof=lambda entry: len(json.dumps(entry[2], separators=(',', ':'))))
+
+
+@traced('calendar.fetch_series')
+def fetch_calendar_series(service, creds, calendar, time_min, time_max):
+    """
+    Fetch recurring masters, one-off events and instance overrides without server-side expansion.
+
+    Results are cached per calendar together with the window they cover, so any later
+    window inside it is answered without another upstream call.
+    """
+    key = (user_cache_key(creds), calendar['id'])
+    with _cache_lock:
+        cached = _series_cache.get(key)
+    if cached and cached[0] <= time_min and time_max <= cached[1]:
+        return cached[2]
+
+    fetch_max = max(time_max, time_min + timedelta(days=LOCAL_EXPANSION_MIN_DAYS))
+    items = []
+    request = service.events().list(
+        calendarId=calendar['id'],
+        timeMin=time_min.isoformat(),
+        timeMax=fetch_max.isoformat(),
+        singleEvents=False,
+        showDeleted=True,
+        maxResults=2500
+    )
+    while request is not None:
+        response = execute_request(request)
+        items.extend(response.get('items', []))
+        request = service.events().list_next(request, response)
+
+    tz = resolve_timezone(calendar.get('timeZone'))
+    for item in items:
+        if item.get('status') != 'cancelled':
+            index_event_contacts(key[0], item, tz)
+
+    with _cache_lock:
+        try:
+            _series_cache[key] = (time_min, fetch_max, items)
+        except ValueError:
+            pass  # larger than the whole cache
+    return items
+
+
+def _fetch_instances(service, calendar, master, time_min, time_max):
+    # Server-side fallback for rules expand_recurrence does not understand
+    instances = []
+    request = service.events().instances(
+        calendarId=calendar['id'],
+        eventId=master['id'],
+        timeMin=time_min.isoformat(),
+        timeMax=time_max.isoformat()
+    )
+    while request is not None:
+        response = execute_request(request)
+        instances.extend(response.get('items', []))
+        request = service.events().instances_next(request, response)
+    return instances
+
+
+@traced('calendar.expand_events')
+def expand_calendar_events(service, creds, calendar, time_min, time_max):
+    """Expand one calendar's recurring events locally, merging instance overrides, sorted by start."""
+    tz = resolve_timezone(calendar.get('timeZone'))
+    items = fetch_calendar_series(service, creds, calendar, time_min, time_max)
+    window_min, window_max = time_min.timestamp(), time_max.timestamp()
+
+    def overlaps(event):
+        end = dict(event, start=event['end'])
+        return event_start_key(event, tz) < window_max and event_start_key(end, tz) > window_min
+
+    overrides = {}
+    for item in items:
+        if item.get('recurringEventId') and 'originalStartTime' in item:
+            overrides[(item['recurringEventId'], event_start_key({'start': item['originalStartTime']}, tz))] = item
+
+    events = []
+    for item in items:
+        if item.get('status') == 'cancelled' or item.get('recurringEventId'):
+            continue
+        if not item.get('recurrence'):
+            if overlaps(item):
+                events.append(item)
             continue
+        try:
+            instances = expand_recurrence(item, time_min, time_max, tz)
+        except UnsupportedRecurrence as e:
+            logger.info("Falling back to server expansion for %s: %s", item['id'], e)
+            instances = _fetch_instances(service, calendar, item, time_min, time_max)
+        for instance in instances:
+            if (item['id'], event_start_key({'start': instance['originalStartTime']}, tz)) not in overrides:
+                events.append(instance)
+
+    events.extend(o for o in overrides.values() if o.get('status') != 'cancelled' and overlaps(o))
+    records = [EventRecord.from_event(event, calendar, tz) for event in events]
+    records.sort(key=lambda r: r.start)
+    return records
+
+
+def merge_event_streams(streams):
+    """K-way merge of per-calendar sorted EventRecord streams, dropping events shared between calendars."""
+    seen = set()
+    for record in heapq.merge(*streams, key=lambda r: r.start):
+        identity = (record.ical_uid, record.start)
+        if identity in seen:
+            continue
+        seen.add(identity)
+        yield record
+
+
+def read_calendar(filters, cursor=None):
+    """
+    Returns (summaries, next cursor). The cursor records the start time of the first event
+    not shown and how many events sharing that start were already shown.
+    """
+    if cursor:
+        filters = dict(cursor['q'], timeMin=datetime.fromtimestamp(cursor['t'], timezone.utc).isoformat())
+    creds = authenticate_calendar()
+    service = build_service('calendar', 'v3', creds)
+    user = user_cache_key(creds)
+    time_min = filters['timeMin']
+    time_max = filters['timeMax']
+    tz = resolve_timezone(filters.get("timeZone"))
+
+    calendars = list_calendars(service, creds)
+    stop = threading.Event()
+    window_min = datetime.fromisoformat(time_min)
+    if filters.get("expandRecurring"):
+        window_max = datetime.fromisoformat(time_max) if time_max else window_min + timedelta(days=LOCAL_EXPANSION_MIN_DAYS)
+        futures = [
+            submit_traced(_upstream_pool, expand_calendar_events, service, creds, calendar, window_min, window_max)
+            for calendar in calendars
+        ]
+        streams = [_future_stream(future) for future in futures]
+    else:
+        streams = calendar_streams(service, user, calendars, window_min, time_max, stop)
+
+    records = (r for r in merge_event_streams(streams) if r.end > window_min.timestamp())
+    entries = _format_calendar_events(records, filters, tz)
+    if cursor:
+        # Events that started before the cursor were shown already, as were the first k at it
+        entries = (entry for entry in entries if entry[0] >= (cursor['t'], cursor['k']))
+    resume_at = (cursor['t'], cursor['k']) if cursor else (int(window_min.timestamp()), 0)
+    summaries, next_position = collect_page(_until_deadline(entries, resume_at), stop=stop)
+    next_cursor = None
+    if next_position:
+        start, shown_at_start = next_position
+        next_cursor = {'q': {k: v for k, v in filters.items() if k != 'timeMin'}, 't': start, 'k': shown_at_start}
+        summaries.append(more_results_hint())
+    return summaries or ["No calendar events found matching the criteria."], next_cursor
+
+
+def _until_deadline(entries, position):
+    # At the deadline the page ends after the last event fetched in time and resumes from there
+    try:
+        for entry in entries:
+            (start, at_start), _ = entry
+            position = (start, at_start + 1)
+            yield entry
+    except DeadlineExceeded:
+        yield position, None
+
+
+def calendar_shards(window_min, time_max):
+    """Fetch shards for a window, widened to whole hours so fetch windows (and their cache keys) stay stable between calls."""
+    fetch_min = window_min.replace(minute=0, second=0, microsecond=0)
+    if not time_max:
+        return [(fetch_min, None)]
+    window_max = datetime.fromisoformat(time_max) if isinstance(time_max, str) else time_max
+    fetch_max = window_max.replace(minute=0, second=0, microsecond=0)
+    if fetch_max < window_max:
+        fetch_max += timedelta(hours=1)
+    return split_window(fetch_min, fetch_max)
+
+
+def calendar_streams(service, user, calendars, window_min, time_max, stop=None, fresh=False):
+    """Start fetching every calendar in shards; returns one start-ordered record stream per calendar."""
+    shards = calendar_shards(window_min, time_max)
+    until = datetime.fromisoformat(time_max).timestamp() if time_max else None
+    # One task per (calendar, shard); all of them share the upstream concurrency limit
+    streams = []
+    for calendar in calendars:
+        shard_futures = [
+            submit_traced(_upstream_pool, fetch_calendar_events, service, user, calendar, start.isoformat(),
+                          end.isoformat() if end else None, stop, fresh)
+            for start, end in shards
+        ]
+        streams.append(_shard_stream(shard_futures, shards, until))
+    return streams
+
+
+def _future_stream(future):
+    yield from future.result()
+
+
+def _shard_stream(futures, shards, until=None):
+    # Events spanning a shard boundary are listed by both shards; only the first keeps them.
+    # The last shard runs to the next whole hour, so events starting after the window are dropped.
+    for i, (future, (shard_start, _)) in enumerate(zip(futures, shards)):
+        for record in future.result():
+            if until is not None and record.start >= until:
+                return
+            if i == 0 or record.start >= shard_start.timestamp():
+                yield record
 
-        if filters["approxTimeRange"] and 'dateTime' in event['start']:
-            event_dt = datetime.fromisoformat(event['start']['dateTime'])
-            hour, minute = event_dt.hour, event_dt.minute
-            (sh, sm), (eh, em) = filters["approxTimeRange"]
-            if not (sh <= hour < eh or (sh == hour and sm <= minute)):
-                continue
 
-        summaries.append(f"Summary: {summary}\nStart: {start}\nEnd: {end}\nOrganizer: {organizer}\nLink: {link or location or 'N/A'}")
+def matches_calendar_filter(record, filters, tz):
+    """Apply the title keyword and approximate time-of-day criteria of a calendar filter."""
+    if filters["titleKeyword"] and filters["titleKeyword"] not in record.summary.lower():
+        return False
+    if record.all_day and filters.get("hasTime"):
+        return False
+
+    if filters["approxTimeRange"] and not record.all_day:
+        event_dt = datetime.fromtimestamp(record.start, tz)
+        hour, minute = event_dt.hour, event_dt.minute
+        (sh, sm), (eh, em) = filters["approxTimeRange"]
+        if not (sh <= hour < eh or (sh == hour and sm <= minute)):
+            return False
+    return True
+
+
+def _format_calendar_events(records, filters, tz):
+    """Yield ((start, events already yielded at that start), formatted event) pairs."""
+    last_start, at_start = None, 0
+    for record in records:
+        if not matches_calendar_filter(record, filters, tz):
+            continue
+        at_start = at_start + 1 if record.start == last_start else 0
+        last_start = record.start
+        yield (record.start, at_start), record.format(tz)
+
 
-    return summaries or ["No calendar events found matching the criteria."]
-    
 # ---------------- Add Calendar ----------------
-def build_event_body(summary, start_time_str, end_time_str=None, guests=None, add_meet_link=True):
-    # Convert UTC-7 to UTC (manual offset)
-    start_dt = datetime.fromisoformat(start_time_str) + timedelta(hours=7)
-    start_dt = start_dt.replace(tzinfo=timezone.utc)
+def resolve_event_time(value, tz_name=None, default_day=None):
+    """Parse an ISO timestamp or natural-language expression into an aware datetime span."""
+    tz = resolve_timezone(tz_name)
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        span = parse_time_expression(value, tz_name, default_day=default_day)
+        if span is None or not span.has_time:
+            raise ValueError(f"Could not understand the time '{value}'")
+        return span
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tz)
+    return TimeSpan(dt, dt + timedelta(hours=1), True)
+
+
+def build_event_body(summary, start_time_str, end_time_str=None, guests=None, add_meet_link=True, time_zone=None):
+    # Naive times are interpreted in the user's time zone
+    tz_name = time_zone or DEFAULT_TIMEZONE
+    start_span = resolve_event_time(start_time_str, tz_name)
+    start_dt = start_span.start
 
     if end_time_str:
-        end_dt = datetime.fromisoformat(end_time_str) + timedelta(hours=7)
-        end_dt = end_dt.replace(tzinfo=timezone.utc)
+        # "5pm" as an end time means 5pm on the start's day, not today
+        start_day = start_dt.astimezone(resolve_timezone(tz_name)).date()
+        end_dt = resolve_event_time(end_time_str, tz_name, default_day=start_day).start
     else:
-        end_dt = start_dt + timedelta(hours=1)
+        end_dt = start_span.end
+    if end_dt <= start_dt:
+        raise ValueError(f"the end ({end_dt.isoformat()}) is not after the start ({start_dt.isoformat()})")
 
     event = {
         "summary": summary,
-        "start": {"dateTime": start_dt.isoformat(), "timeZone": "UTC"},
-        "end": {"dateTime": end_dt.isoformat(), "timeZone": "UTC"},
+        "start": {"dateTime": start_dt.isoformat(), "timeZone": tz_name},
+        "end": {"dateTime": end_dt.isoformat(), "timeZone": tz_name},
         "attendees": [{"email": email} for email in guests or []],
     }
 
@@ -241,24 +2480,660 @@ def build_event_body(summary, start_time_str, end_time_str=None, guests=None, ad
     return event
 
 
-def create_calendar_event(event_body):
+def calendar_insert_request(service, event_body):
+    return service.events().insert(
+        calendarId='primary',
+        body=event_body,
+        conferenceDataVersion=1,
+        sendUpdates='all'
+    )
+
+
+def create_calendar_event(event_body, async_mode=False):
     try:
         creds = authenticate_calendar()
-        service = build('calendar', 'v3', credentials=creds)
+        if async_mode:
+            operation_id = outbox().submit(user_cache_key(creds), 'create_calendar_event', event_body)
+            return f"Event queued. Operation ID: {operation_id}"
 
-        event = service.events().insert(
-            calendarId='primary',
-            body=event_body,
-            conferenceDataVersion=1,
-            sendUpdates='all'
-        ).execute()
+        service = build_service('calendar', 'v3', creds)
+        event = execute_request(calendar_insert_request(service, event_body))
 
         return f"Event created: {event.get('htmlLink')}"
     except Exception as e:
         return f"Error creating event: {e}"
 
 
+# ---------------- Calendar Changes ----------------
+# Larger selections are refused so one misunderstood request cannot rewrite a whole calendar
+MAX_BULK_EVENTS = int(os.environ.get('MAX_BULK_EVENTS', '50'))
+SHIFT_RE = re.compile(r'([+-]?\s*\d+)\s*(minute|min|hour|hr|day|week)s?\b')
+SHIFT_UNITS = {'minute': 'minutes', 'min': 'minutes', 'hour': 'hours', 'hr': 'hours', 'day': 'days', 'week': 'weeks'}
+
+
+def parse_move_target(expression, tz_name=None):
+    """Returns (new day or None, new (hour, minute) or None) for a "move to" expression like "monday 2pm"."""
+    if not expression:
+        return None, None
+    normalized = ' '.join(str(expression).lower().replace(',', ' ').split())
+    today = datetime.now(resolve_timezone(tz_name)).date()
+    # ISO dates look like clock ranges ("05-01"), so keep them away from the clock parser
+    iso_date = ISO_DATE_RE.search(normalized)
+    clock, remainder = _parse_clock(ISO_DATE_RE.sub(' ', normalized))
+    days = _parse_days(iso_date.group(0) if iso_date else remainder, today)
+    if days is None and clock is None:
+        raise ValueError(f"Could not understand the new time '{expression}'")
+    return days[0] if days else None, clock[0] if clock else None
+
+
+def parse_shift(expression):
+    """Parse an offset like "+2 hours", "-30 minutes" or "1 day 2 hours" into a timedelta."""
+    if not expression:
+        return timedelta()
+    matches = SHIFT_RE.findall(str(expression).lower())
+    if not matches:
+        raise ValueError(f"Could not understand the shift '{expression}'")
+    return sum((timedelta(**{SHIFT_UNITS[unit]: int(amount.replace(' ', ''))}) for amount, unit in matches),
+               timedelta())
+
+
+def select_calendar_events(service, creds, filters):
+    """Every event instance matching the filters, fetched fresh so etags are current."""
+    if not filters['timeMax']:
+        raise ValueError("Say which day or range of days the events are in.")
+    user = user_cache_key(creds)
+    tz = resolve_timezone(filters.get('timeZone'))
+    window_min = datetime.fromisoformat(filters['timeMin'])
+    streams = calendar_streams(service, user, list_calendars(service, creds), window_min, filters['timeMax'], fresh=True)
+    return [record for record in merge_event_streams(streams)
+            if record.end > window_min.timestamp() and matches_calendar_filter(record, filters, tz)]
+
+
+def plan_new_times(record, new_day, new_clock, shift, tz):
+    """
+    New (start, end) for an event; the duration is kept and all-day events stay all-day,
+    moving only by the whole days of the shift (a "-30 minutes" shift leaves them alone).
+    """
+    start = record.local_start(tz)
+    if record.all_day:
+        # Counted in calendar days: a span over a DST change is 23 or 25 hours long
+        days = (record.local_end(tz).date() - start.date()).days
+        day = (new_day or start.date()) + timedelta(days=int(shift / timedelta(days=1)))
+        return day, day + timedelta(days=days)
+    duration = timedelta(seconds=record.end - record.start)
+    start = datetime.combine(new_day or start.date(), time(*new_clock) if new_clock else start.time(), tz)
+    start += shift
+    return start, start + duration
+
+
+def _event_time_body(start, end, tz_name):
+    if isinstance(start, datetime):
+        return {'start': {'dateTime': start.isoformat(), 'timeZone': tz_name},
+                'end': {'dateTime': end.isoformat(), 'timeZone': tz_name}}
+    return {'start': {'date': start.isoformat()}, 'end': {'date': end.isoformat()}}
+
+
+def _describe_time(value, tz=None):
+    if isinstance(value, (int, float)):
+        value = datetime.fromtimestamp(value, tz)
+    return value.strftime('%a %Y-%m-%d %H:%M') if isinstance(value, datetime) else value.strftime('%a %Y-%m-%d')
+
+
+def _describe_start(record, tz):
+    start = record.local_start(tz)
+    return _describe_time(start.date() if record.all_day else start)
+
+
+def _change_error(error):
+    status = error.resp.status if isinstance(error, HttpError) else None
+    if status == 412:
+        return "it changed since it was read, so it was left alone"
+    if status in (404, 410):
+        return "it no longer exists"
+    if status == 403:
+        return "you do not have permission to change it"
+    return str(error)
+
+
+def invalidate_calendar_cache(user):
+    """Drop cached listings for a user after their events were changed."""
+    with _cache_lock:
+        for key in list(_record_cache.keys()):
+            if key[0] == user and key[1] == 'calendar':
+                _record_cache.pop(key, None)
+        for key in list(_series_cache.keys()):
+            if key[0] == user:
+                _series_cache.pop(key, None)
+
+
+def _apply_changes(service, creds, records, requests):
+    """Send the prepared requests in batches, guarded by each event's etag; returns (response, error) pairs."""
+    for record, request in zip(records, requests):
+        request.headers['If-Match'] = record.etag
+    results = execute_batch(service, requests)
+    invalidate_calendar_cache(user_cache_key(creds))
+    return results
+
+
+def update_calendar_events(filters, move_to=None, shift_by=None, dry_run=False):
+    """
+    Reschedule every event matching the filters, to a new day and/or time of day
+    (move_to) and/or by an offset (shift_by). Returns one report line per event.
+    """
+    tz_name = filters.get('timeZone') or DEFAULT_TIMEZONE
+    tz = resolve_timezone(tz_name)
+    new_day, new_clock = parse_move_target(move_to, tz_name)
+    shift = parse_shift(shift_by)
+    if new_day is None and new_clock is None and not shift:
+        raise ValueError("Say where to move the events (move_to) or by how much (shift_by).")
+
+    creds = authenticate_calendar()
+    service = build_service('calendar', 'v3', creds)
+    records = select_calendar_events(service, creds, filters)
+    if not records:
+        return ["No calendar events found matching the criteria."]
+    if len(records) > MAX_BULK_EVENTS:
+        return [f"{len(records)} events match; narrow the selection to at most {MAX_BULK_EVENTS}. Nothing was changed."]
+
+    planned = [(record, plan_new_times(record, new_day, new_clock, shift, tz)) for record in records]
+    # All-day events that a change of less than a day does not move are left out, not patched in place
+    moving = [(record, plan) for record, plan in planned
+              if not (record.all_day and plan[0] == record.local_start(tz).date())]
+    unmoved = len(planned) - len(moving)
+    skipped = [f"Left {unmoved} all-day events alone; they only move by whole days."] if unmoved else []
+    if not moving:
+        return skipped
+    records, plans = [record for record, _ in moving], [plan for _, plan in moving]
+    if dry_run:
+        return collect_within_budget(skipped + [
+            f"{record.summary} ({_describe_start(record, tz)} -> {_describe_time(start)}): would move"
+            for record, (start, _) in zip(records, plans)
+        ])
+
+    requests = [
+        service.events().patch(calendarId=record.calendar['id'], eventId=record.id,
+                               body=_event_time_body(start, end, tz_name), sendUpdates='all')
+        for record, (start, end) in zip(records, plans)
+    ]
+    results = _apply_changes(service, creds, records, requests)
+    moved = sum(1 for _, error in results if error is None)
+    lines = [
+        f"{record.summary} ({_describe_start(record, tz)} -> {_describe_time(start)}): "
+        + ("moved" if error is None else f"not moved, {_change_error(error)}")
+        for record, (start, _), (_, error) in zip(records, plans, results)
+    ]
+    return collect_within_budget([f"Moved {moved} of {len(records)} events."] + skipped + lines)
+
+
+def delete_calendar_events(filters, dry_run=False):
+    """Cancel every event matching the filters; returns one report line per event."""
+    tz = resolve_timezone(filters.get('timeZone'))
+    creds = authenticate_calendar()
+    service = build_service('calendar', 'v3', creds)
+    records = select_calendar_events(service, creds, filters)
+    if not records:
+        return ["No calendar events found matching the criteria."]
+    if len(records) > MAX_BULK_EVENTS:
+        return [f"{len(records)} events match; narrow the selection to at most {MAX_BULK_EVENTS}. Nothing was changed."]
+
+    if dry_run:
+        return collect_within_budget(f"{record.summary} ({_describe_start(record, tz)}): would cancel"
+                                     for record in records)
+
+    requests = [
+        service.events().delete(calendarId=record.calendar['id'], eventId=record.id, sendUpdates='all')
+        for record in records
+    ]
+    results = _apply_changes(service, creds, records, requests)
+    cancelled = sum(1 for _, error in results if error is None)
+    lines = [
+        f"{record.summary} ({_describe_start(record, tz)}): "
+        + ("cancelled" if error is None else f"not cancelled, {_change_error(error)}")
+        for record, (_, error) in zip(records, results)
+    ]
+    return collect_within_budget([f"Cancelled {cancelled} of {len(records)} events."] + lines)
+
+
+# ---------------- Stats ----------------
+STATS_TTL = int(os.environ.get('STATS_TTL', '60'))
+STATS_DEFAULT_DAYS = 7
+STATS_EVENT_FIELDS = 'items(id,iCalUID,summary,start,end),nextPageToken'
+
+_stats_cache = TTLCache(maxsize=1024, ttl=STATS_TTL)
+
+# System label IDs are upper case; user label IDs (Label_123) are case-sensitive
+GMAIL_SYSTEM_LABELS = {'INBOX', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'UNREAD', 'STARRED', 'IMPORTANT',
+                       'CHAT', 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS',
+                       'CATEGORY_UPDATES', 'CATEGORY_FORUMS'}
+
+
+def gmail_label_id(label):
+    """Label ID as Gmail expects it: system labels in any case, user labels untouched."""
+    label = (label or 'INBOX').strip()
+    return label.upper() if label.upper() in GMAIL_SYSTEM_LABELS else label
+
+
+def mail_stats(query=None, label='INBOX'):
+    """
+    Answer count questions with one cheap call: the counters of a label (by ID) when there is
+    no query, otherwise Gmail's resultSizeEstimate for it. Answers are cached for STATS_TTL seconds.
+    """
+    # Unread counts alone come straight from the label counters
+    use_estimate = bool(query) and query != 'is:unread'
+    creds = authenticate_gmail()
+    key = (user_cache_key(creds), 'mail_stats', query if use_estimate else label)
+    cached = _stats_cache.get(key)
+    if cached is not None:
+        return cached
+
+    service = build_service('gmail', 'v1', creds)
+    if use_estimate:
+        response = execute_request(service.users().messages().list(
+            userId='me', q=query, maxResults=1, fields='resultSizeEstimate'
+        ))
+        estimate = response.get('resultSizeEstimate', 0)
+        output = [f"About {estimate} messages match \"{query}\"." if estimate else f"No messages match \"{query}\"."]
+    else:
+        counts = execute_request(service.users().labels().get(
+            userId='me', id=label, fields='name,messagesTotal,messagesUnread,threadsTotal,threadsUnread'
+        ))
+        output = [
+            f"{counts.get('name', label).title()}: {counts.get('messagesUnread', 0)} unread of "
+            f"{counts.get('messagesTotal', 0)} messages, {counts.get('threadsUnread', 0)} unread of "
+            f"{counts.get('threadsTotal', 0)} conversations."
+        ]
+    _stats_cache[key] = output
+    return output
+
+
+def _cached_calendar_records(user, calendar, shards):
+    # Shard listings cached by read_calendar answer the question without any upstream call
+    records = []
+    for i, (start, end) in enumerate(shards):
+        cached = cached_records((user, 'calendar', calendar['id'], start.isoformat(), end.isoformat() if end else None))
+        if cached is None:
+            return None
+        records.extend(r for r in cached if i == 0 or r.start >= start.timestamp())
+    return records
+
+
+def _count_calendar_events(service, calendar, time_min, time_max):
+    tz = resolve_timezone(calendar.get('timeZone'))
+    records = []
+    request = service.events().list(
+        calendarId=calendar['id'], timeMin=time_min.isoformat(), timeMax=time_max.isoformat(),
+        singleEvents=True, maxResults=2500, fields=STATS_EVENT_FIELDS
+    )
+    while request is not None:
+        response = execute_request(request)
+        records.extend(EventRecord.from_event(event, calendar, tz) for event in response.get('items', []))
+        request = service.events().list_next(request, response)
+    return sorted(records, key=lambda r: r.start)
+
+
+def calendar_stats(filters):
+    """
+    Per-day event counts for the filtered window. Uses cached listings where read_calendar left
+    them, otherwise one fields-masked list call per calendar.
+    """
+    tz = resolve_timezone(filters.get('timeZone'))
+    window_min = datetime.fromisoformat(filters['timeMin'])
+    window_max = (datetime.fromisoformat(filters['timeMax']) if filters['timeMax']
+                  else window_min + timedelta(days=STATS_DEFAULT_DAYS))
+
+    creds = authenticate_calendar()
+    service = build_service('calendar', 'v3', creds)
+    user = user_cache_key(creds)
+    # The same shards read_calendar fetches for this window, or its open-ended listing without one
+    shards = calendar_shards(window_min, window_max)
+    open_ended = calendar_shards(window_min, None)
+    streams = []
+    for calendar in list_calendars(service, creds):
+        records = _cached_calendar_records(user, calendar, shards)
+        if records is None and not filters['timeMax']:
+            records = _cached_calendar_records(user, calendar, open_ended)
+        if records is None:
+            records = _count_calendar_events(service, calendar, window_min, window_max)
+        streams.append(records)
+
+    per_day = {}
+    for record in merge_event_streams(streams):
+        if record.end <= window_min.timestamp() or record.start >= window_max.timestamp():
+            continue
+        if not matches_calendar_filter(record, filters, tz):
+            continue
+        day = record.local_start(tz).date()
+        count, busy = per_day.get(day, (0, 0))
+        per_day[day] = (count + 1, busy + (0 if record.all_day else record.end - record.start))
+
+    total = sum(count for count, _ in per_day.values())
+    output = [f"{total} events from {window_min.strftime('%a %Y-%m-%d')} to {window_max.strftime('%a %Y-%m-%d')}."]
+    day = window_min.date()
+    while day < window_max.date() or (day == window_max.date() and window_max.time() != time()):
+        count, busy = per_day.get(day, (0, 0))
+        output.append(f"{day.strftime('%a %Y-%m-%d')}: {count} events, {busy // 3600}h {busy % 3600 // 60:02d}m scheduled")
+        day += timedelta(days=1)
+    return ["\n".join(output)]
+
+
+# ---------------- Outbox ----------------
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', '/tmp/outbox.sqlite3')
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '20'))  # operations of different users per batch
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_DELAY = 2.0  # seconds before the first retry, doubled after each failed attempt
+OUTBOX_POLL_INTERVAL = 1.0  # seconds between drain passes when nothing wakes the worker
+OUTBOX_SCAN_LIMIT = 500  # pending operations looked at per drain pass
+OUTBOX_KEEP_SECONDS = 7 * 86400  # finished operations stay queryable this long
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Operation(NamedTuple):
+    id: str
+    user: str
+    kind: str
+    payload: Dict[str, Any]
+    attempts: int
+    retry_at: float
+
+
+class OperationStatus(NamedTuple):
+    id: str
+    kind: str
+    state: str  # pending, running, done or failed
+    attempts: int
+    result: Optional[str]
+    error: Optional[str]
+
+
+class OutboxKind(NamedTuple):
+    api: str
+    version: str
+    authenticate: Any
+    request: Any  # (service, operation) -> HttpRequest
+    describe: Any  # (operation, response) -> result text
+    idempotent: bool  # safe to run again if an earlier run may have completed
+
+
+class OutboxQueue:
+    """
+    Durable storage behind the outbox. Implementations must hand out each user's pending
+    operations in the order they were put.
+    """
+
+    def put(self, operation_id, user, kind, payload):
+        raise NotImplementedError
+
+    def pending(self, limit):
+        """Pending operations, oldest first, including those waiting for a retry."""
+        raise NotImplementedError
+
+    def start(self, operation_ids):
+        raise NotImplementedError
+
+    def finish(self, operation_id, result):
+        raise NotImplementedError
+
+    def retry(self, operation_id, error, retry_at):
+        raise NotImplementedError
+
+    def fail(self, operation_id, error):
+        raise NotImplementedError
+
+    def status(self, operation_ids):
+        """OperationStatus for each known ID."""
+        raise NotImplementedError
+
+    def recover(self, idempotent_kinds):
+        """Settle operations left running by a process that stopped mid-write."""
+        raise NotImplementedError
+
+
+class SQLiteOutbox(OutboxQueue):
+    """Outbox in a local SQLite file; every state change is committed before it is acted on."""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, user TEXT NOT NULL, "
+                "kind TEXT NOT NULL, payload TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'pending', "
+                "attempts INTEGER NOT NULL DEFAULT 0, retry_at REAL NOT NULL DEFAULT 0, "
+                "result TEXT, error TEXT, updated_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, seq)")
+            self._db.execute("DELETE FROM outbox WHERE state IN ('done', 'failed') AND updated_at < ?",
+                             (_now() - OUTBOX_KEEP_SECONDS,))
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def put(self, operation_id, user, kind, payload):
+        self._execute("INSERT INTO outbox (id, user, kind, payload, updated_at) VALUES (?, ?, ?, ?, ?)",
+                      (operation_id, user, kind, json.dumps(payload), _now()))
+
+    def pending(self, limit):
+        rows = self._execute(
+            "SELECT id, user, kind, payload, attempts, retry_at FROM outbox "
+            "WHERE state = 'pending' ORDER BY seq LIMIT ?", (limit,))
+        return [Operation(id, user, kind, json.loads(payload), attempts, retry_at)
+                for id, user, kind, payload, attempts, retry_at in rows]
+
+    def start(self, operation_ids):
+        placeholders = ','.join('?' * len(operation_ids))
+        self._execute(f"UPDATE outbox SET state = 'running', attempts = attempts + 1, updated_at = ? "
+                      f"WHERE id IN ({placeholders})", (_now(), *operation_ids))
+
+    def finish(self, operation_id, result):
+        self._execute("UPDATE outbox SET state = 'done', result = ?, error = NULL, updated_at = ? WHERE id = ?",
+                      (result, _now(), operation_id))
+
+    def retry(self, operation_id, error, retry_at):
+        self._execute("UPDATE outbox SET state = 'pending', error = ?, retry_at = ?, updated_at = ? WHERE id = ?",
+                      (error, retry_at, _now(), operation_id))
+
+    def fail(self, operation_id, error):
+        self._execute("UPDATE outbox SET state = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                      (error, _now(), operation_id))
+
+    def status(self, operation_ids):
+        placeholders = ','.join('?' * len(operation_ids))
+        rows = self._execute(f"SELECT id, kind, state, attempts, result, error FROM outbox "
+                             f"WHERE id IN ({placeholders})", tuple(operation_ids))
+        return {row[0]: OperationStatus(*row) for row in rows}
+
+    def recover(self, idempotent_kinds):
+        placeholders = ','.join('?' * len(idempotent_kinds))
+        self._execute(f"UPDATE outbox SET state = 'pending', updated_at = ? "
+                      f"WHERE state = 'running' AND kind IN ({placeholders})", (_now(), *idempotent_kinds))
+        self._execute("UPDATE outbox SET state = 'failed', error = ?, updated_at = ? WHERE state = 'running'",
+                      ("Interrupted while running; it may or may not have completed", _now()))
+
+
+def _now():
+    return datetime.now(timezone.utc).timestamp()
+
+
+def _describe_sent(operation, response):
+    return f"Email sent to {operation.payload['to_email']}. Message ID: {response['id']}"
+
+
+def _describe_created(operation, response):
+    return f"Event created: {response.get('htmlLink')}"
+
+
+OUTBOX_KINDS = {
+    'send_gmail': OutboxKind(
+        'gmail', 'v1', authenticate_gmail,
+        lambda service, operation: gmail_send_request(service, **operation.payload),
+        _describe_sent, idempotent=False),
+    # The operation ID doubles as the event ID, so a repeated insert fails with 409 instead of duplicating
+    'create_calendar_event': OutboxKind(
+        'calendar', 'v3', authenticate_calendar,
+        lambda service, operation: calendar_insert_request(service, dict(operation.payload, id=operation.id)),
+        _describe_created, idempotent=True),
+}
+
+
+def _retryable(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, (TimeoutError, OSError, httplib2.HttpLib2Error))
+
+
+class OutboxWorker:
+    """
+    Drains the outbox on a background thread. Each pass takes every user's oldest pending
+    operation and sends those of one kind together as batch requests of up to OUTBOX_BATCH_SIZE.
+    Google does not order the parts of a batch, so a batch never holds two operations of the
+    same user; an operation waiting for a retry holds back everything that user queued after it.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._wake = threading.Event()
+        self._drain_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        queue.recover([kind for kind, spec in OUTBOX_KINDS.items() if spec.idempotent])
+
+    def submit(self, user, kind, payload):
+        operation_id = uuid.uuid4().hex
+        self.queue.put(operation_id, user, kind, payload)
+        self.start()
+        self._wake.set()
+        return operation_id
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(OUTBOX_POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                while self.drain():
+                    pass
+            except Exception:
+                logger.exception("Outbox drain failed")
+
+    def drain(self, blocking=True):
+        """Run one pass; returns how many operations were sent."""
+        if not self._drain_lock.acquire(blocking=blocking):
+            return 0
+        try:
+            now = _now()
+            heads, seen = {}, set()
+            for operation in self.queue.pending(OUTBOX_SCAN_LIMIT):
+                if operation.user in seen:
+                    continue
+                seen.add(operation.user)
+                if operation.retry_at <= now:
+                    heads.setdefault(operation.kind, []).append(operation)
+            batches = [operations[i:i + OUTBOX_BATCH_SIZE]
+                       for operations in heads.values() for i in range(0, len(operations), OUTBOX_BATCH_SIZE)]
+            for batch in batches:
+                self._dispatch(batch)
+            return sum(len(batch) for batch in batches)
+        finally:
+            self._drain_lock.release()
+
+    def _dispatch(self, batch):
+        spec = OUTBOX_KINDS[batch[0].kind]
+        self.queue.start([operation.id for operation in batch])
+        with span('outbox.dispatch', {'outbox.kind': batch[0].kind, 'batch.size': len(batch)}):
+            try:
+                service = build_service(spec.api, spec.version, spec.authenticate())
+                results = execute_batch(service, [spec.request(service, operation) for operation in batch])
+            except Exception as e:
+                results = [(None, e)] * len(batch)
+
+        for operation, (response, error) in zip(batch, results):
+            attempt = operation.attempts + 1
+            if error is None:
+                self.queue.finish(operation.id, spec.describe(operation, response))
+            elif spec.idempotent and isinstance(error, HttpError) and error.resp.status == 409 and attempt > 1:
+                self.queue.finish(operation.id, "Completed by an earlier attempt")
+            elif _retryable(error) and attempt < OUTBOX_MAX_ATTEMPTS:
+                logger.warning("Outbox operation %s failed (attempt %d), retrying: %s", operation.id, attempt, error)
+                self.queue.retry(operation.id, str(error), _now() + OUTBOX_RETRY_DELAY * 2 ** operation.attempts)
+            else:
+                logger.error("Outbox operation %s failed: %s", operation.id, error)
+                self.queue.fail(operation.id, str(error))
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def configure_outbox(queue):
+    """Replace the outbox storage, e.g. with a queue shared between containers."""
+    global _outbox
+    with _outbox_lock:
+        _outbox = OutboxWorker(queue)
+    return _outbox
+
+
+def outbox():
+    with _outbox_lock:
+        worker = _outbox
+    return worker or configure_outbox(SQLiteOutbox(OUTBOX_PATH))
+
+
+def resume_outbox():
+    """Restart draining operations queued by an earlier invocation of this container."""
+    if _outbox is not None or os.path.exists(OUTBOX_PATH):
+        outbox().start()
+
+
+def get_operation_status(operation_ids):
+    """Report on queued writes; pending ones get a drain pass first unless the worker is already on it."""
+    worker = outbox()
+    statuses = worker.queue.status(operation_ids)
+    if any(status.state == 'pending' for status in statuses.values()):
+        worker.drain(blocking=False)
+        statuses = worker.queue.status(operation_ids)
+
+    output = []
+    for operation_id in operation_ids:
+        status = statuses.get(operation_id)
+        if status is None:
+            output.append(f"Operation {operation_id}: not found.")
+        elif status.state == 'done':
+            output.append(f"Operation {operation_id}: done. {status.result}")
+        elif status.state == 'failed':
+            output.append(f"Operation {operation_id}: failed after {status.attempts} "
+                          f"attempt{'s' if status.attempts != 1 else ''}: {status.error}")
+        elif status.state == 'running':
+            output.append(f"Operation {operation_id}: in progress.")
+        elif status.attempts:
+            output.append(f"Operation {operation_id}: queued for retry (attempt {status.attempts} failed: {status.error}).")
+        else:
+            output.append(f"Operation {operation_id}: queued.")
+    return output or ["No operation IDs given."]
+
+
 # ---------------- Main Lambda Handler ----------------
+def calendar_filter_from_params(params, time_zone):
+    return build_calendar_filter(
+        next_x_days=params.get('next_x_days'),
+        specific_date=params.get('specific_date'),
+        specific_day=params.get('specific_day'),
+        specific_time=params.get('specific_time'),
+        title_keyword=params.get('title_keyword'),
+        when=params.get('when'),
+        time_zone=time_zone,
+        expand_recurring=params.get('expand_recurring', False)
+    )
+
+
+@profiled
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     try:
         action_group = event['actionGroup']
@@ -267,26 +3142,67 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         raw_parameters = event.get('parameters', [])
 
         params = parse_parameters(raw_parameters)
+        set_deadline(context)
+        resume_outbox()
+        session_attributes = dict(event.get('sessionAttributes') or {})
+        time_zone = params.get('time_zone') or session_attributes.get('timeZone') or DEFAULT_TIMEZONE
+        # None when not given: a repeat of the same query then resumes its cursor
+        show_more = None if params.get('show_more') is None else str(params['show_more']).lower() == 'true'
 
         if function == 'read_gmail':
-            query = build_gmail_query(
+            cursor, fingerprint = resume_cursor(session_attributes, function, params, show_more)
+            query = cursor['q'] if cursor else build_gmail_query(
                 from_last_x_days=params.get('from_last_x_days'),
                 show_only_unread=params.get('show_only_unread', 'true'),
                 subject_contains=params.get('subject_contains'),
                 sender_email=params.get('sender_email')
             )
-            output = read_gmail(query)
+            # Thread cursors carry a page token, message cursors a shard position
+            threaded = str(params.get('group_by_thread', 'false')).lower() == 'true' or bool(cursor and 'p' in cursor)
+            if threaded:
+                output, next_cursor = read_gmail_threads(query, cursor)
+            else:
+                group_similar = str(params.get('group_similar', 'true')).lower() == 'true'
+                output, next_cursor = read_gmail(query, cursor, group_similar)
+            store_cursor(session_attributes, function, next_cursor and dict(next_cursor, f=fingerprint))
 
         elif function == 'read_calendar':
-            filters = build_calendar_filter(
-                next_x_days=params.get('next_x_days'),
-                specific_date=params.get('specific_date'),
-                specific_day=params.get('specific_day'),
-                specific_time=params.get('specific_time'),
-                title_keyword=params.get('title_keyword')
+            cursor, fingerprint = resume_cursor(session_attributes, function, params, show_more)
+            filters = calendar_filter_from_params(params, time_zone)
+            output, next_cursor = read_calendar(filters, cursor)
+            store_cursor(session_attributes, function, next_cursor and dict(next_cursor, f=fingerprint))
+
+        elif function == 'mail_stats':
+            query = build_gmail_query(
+                from_last_x_days=params.get('from_last_x_days'),
+                show_only_unread=params.get('show_only_unread', 'false'),
+                subject_contains=params.get('subject_contains'),
+                sender_email=params.get('sender_email')
             )
-            # print(filters)
-            output = read_calendar(filters)
+            output = mail_stats(query, label=gmail_label_id(params.get('label')))
+
+        elif function == 'calendar_stats':
+            output = calendar_stats(calendar_filter_from_params(params, time_zone))
+
+        elif function == 'update_calendar_events':
+            try:
+                output = update_calendar_events(
+                    calendar_filter_from_params(params, time_zone),
+                    move_to=params.get('move_to'),
+                    shift_by=params.get('shift_by'),
+                    dry_run=str(params.get('dry_run', 'false')).lower() == 'true'
+                )
+            except ValueError as e:
+                output = [f"No events were changed: {e}"]
+
+        elif function == 'delete_calendar_events':
+            try:
+                output = delete_calendar_events(
+                    calendar_filter_from_params(params, time_zone),
+                    dry_run=str(params.get('dry_run', 'false')).lower() == 'true'
+                )
+            except ValueError as e:
+                output = [f"No events were cancelled: {e}"]
         
         elif function == 'create_calendar_event':
             guests = params.get('guests')
@@ -298,24 +3214,73 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 except Exception:
                     guests = [guests]
 
-            event_data = build_event_body(
-                summary=params.get('summary'),
-                start_time_str=params.get('start_time_str'),
-                end_time_str=params.get('end_time_str'),
-                guests=guests,
-                add_meet_link=str(params.get('add_meet_link', 'true')).lower() == 'true'
-            )
-            output = [create_calendar_event(event_data)]
+            try:
+                event_data = build_event_body(
+                    summary=params.get('summary'),
+                    start_time_str=params.get('start_time_str'),
+                    end_time_str=params.get('end_time_str'),
+                    guests=guests,
+                    add_meet_link=str(params.get('add_meet_link', 'true')).lower() == 'true',
+                    time_zone=time_zone
+                )
+            except ValueError as e:
+                output = [f"Event not created: {e}"]
+            else:
+                output = [create_calendar_event(event_data, async_mode=str(params.get('async_mode', 'false')).lower() == 'true')]
         
+        elif function == 'get_email_body':
+            output = get_email_body(parse_list_parameter(params.get('message_ids')))
+
+        elif function == 'list_attachments':
+            output = list_attachments(parse_list_parameter(params.get('message_ids')))
+
+        elif function == 'get_attachment':
+            try:
+                output = get_attachment(params.get('message_id'), part_id=params.get('part_id'), filename=params.get('filename'))
+            except ValueError as e:
+                output = [f"Could not get the attachment: {e}"]
+
+        elif function == 'resolve_contact':
+            output = resolve_contact(params.get('name'), limit=int(params.get('limit', 5)))
+
+        elif function == 'send_gmail' and '@' not in (params.get('to_email') or ''):
+            # Saves a failed send: the agent gets the candidate addresses to confirm instead
+            output = [f"Email not sent: '{params.get('to_email')}' is not an email address. Matching contacts:"]
+            output += resolve_contact(params.get('to_email'))
+
         elif function == 'send_gmail':
             result = send_gmail(
                 to_email=params.get('to_email'),
                 subject=params.get('subject'),
-                body=params.get('body')
+                body=params.get('body'),
+                async_mode=str(params.get('async_mode', 'false')).lower() == 'true'
             )
 
-            output = [f"Email sent to {result['recipient']}. Message ID: {result['message_id']}"] if result['status'] == 'success' else [f"Failed to send email: {result['error']}"]
+            if result['status'] == 'queued':
+                output = [f"Email to {result['recipient']} queued. Operation ID: {result['operation_id']}"]
+            else:
+                output = [f"Email sent to {result['recipient']}. Message ID: {result['message_id']}"] if result['status'] == 'success' else [f"Failed to send email: {result['error']}"]
+
+        elif function == 'get_operation_status':
+            output = get_operation_status(parse_list_parameter(params.get('operation_ids')))
+
 
+        elif function == 'send_gmail_bulk':
+            try:
+                results = send_gmail_bulk(
+                    recipients=parse_list_parameter(params.get('recipients')),
+                    subject=params.get('subject'),
+                    body=params.get('body')
+                )
+            except ValueError as e:
+                output = [f"Emails not sent: {e}"]
+            else:
+                sent = sum(1 for r in results if r['status'] == 'success')
+                output = [f"Sent {sent} of {len(results)} emails."] + [
+                    f"{r['recipient']}: sent (Message ID: {r['message_id']})" if r['status'] == 'success'
+                    else f"{r['recipient']}: failed ({r['error']})"
+                    for r in results
+                ]
 
         else:
             output = [f"No handler for function: {function}"]
@@ -334,6 +3299,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'responseBody': response_body
                 }
             },
+            'sessionAttributes': session_attributes,
             'messageVersion': message_version
         }
 
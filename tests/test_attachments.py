@@ -0,0 +1,130 @@
+import base64
+import hashlib
+import io
+import os
+from itertools import cycle
+
+import pytest
+
+import lambda_handler
+from lambda_handler import _evict_attachments, _stream_attachment, fetch_attachment
+
+
+class FakeCredentials:
+    def before_request(self, request, method, url, headers):
+        headers['authorization'] = 'Bearer token'
+
+
+class FakeResponse:
+    """An HTTP response that hands out its body in small, uneven reads."""
+
+    def __init__(self, body, sizes=(1, 3, 7, 2, 5, 11)):
+        self.body = body
+        self.sizes = cycle(sizes)
+
+    def read(self, limit):
+        size = min(limit, next(self.sizes))
+        chunk, self.body = self.body[:size], self.body[size:]
+        return chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def respond(monkeypatch):
+    """Serve the given JSON body for the next attachment download."""
+    def serve(body, sizes=(1, 3, 7, 2, 5, 11)):
+        monkeypatch.setattr(lambda_handler.urllib.request, 'urlopen',
+                            lambda request, timeout: FakeResponse(body, sizes))
+    monkeypatch.setattr(lambda_handler, 'ATTACHMENT_CHUNK', 6)
+    return serve
+
+
+def download():
+    out = io.BytesIO()
+    digest, size = _stream_attachment(FakeCredentials(), 'm1', 'att', out)
+    return out.getvalue(), digest, size
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 4, 5, 57, 1000])
+@pytest.mark.parametrize("padded", [True, False])
+def test_decodes_across_uneven_chunks(respond, length, padded):
+    content = os.urandom(length)
+    data = base64.urlsafe_b64encode(content)
+    if not padded:
+        data = data.rstrip(b'=')
+    respond(b'{"size": %d, "data" : "%s"}' % (length, data))
+    assert download() == (content, hashlib.sha256(content).hexdigest(), length)
+
+
+@pytest.mark.parametrize("sizes", [(1,), (2, 9), (13, 4, 1)])
+def test_finds_data_field_split_across_reads(respond, sizes):
+    content = b'x' * 300
+    padding = b'{"size": 300, "attachmentId": "' + b'A' * 40 + b'",\n  '
+    respond(padding + b'"data": "' + base64.urlsafe_b64encode(content) + b'"}', sizes)
+    assert download()[0] == content
+
+
+def test_missing_data_field(respond):
+    respond(b'{"size": 0}')
+    with pytest.raises(ValueError, match="no data"):
+        download()
+
+
+def test_truncated_response(respond):
+    respond(b'{"data": "' + base64.urlsafe_b64encode(b'y' * 100)[:50])
+    with pytest.raises(ValueError, match="ended early"):
+        download()
+
+
+def test_refuses_files_larger_than_the_cache(respond, monkeypatch):
+    monkeypatch.setattr(lambda_handler, 'ATTACHMENT_CACHE_BYTES', 64)
+    respond(b'{"data": "' + base64.urlsafe_b64encode(b'z' * 500) + b'"}')
+    with pytest.raises(ValueError, match="larger than the attachment cache"):
+        download()
+
+
+@pytest.fixture
+def attachment_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(lambda_handler, 'ATTACHMENT_DIR', str(tmp_path))
+    monkeypatch.setattr(lambda_handler, '_attachment_files', lambda_handler.LRUCache(maxsize=100))
+    return tmp_path
+
+
+def write(directory, name, size, mtime):
+    path = directory / name
+    path.write_bytes(b'.' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_eviction_drops_least_recently_used_files(attachment_dir, monkeypatch):
+    monkeypatch.setattr(lambda_handler, 'ATTACHMENT_CACHE_BYTES', 250)
+    write(attachment_dir, 'old', 100, 1000)
+    write(attachment_dir, 'middle', 100, 2000)
+    write(attachment_dir, 'new', 100, 3000)
+    write(attachment_dir, 'download.part', 500, 500)
+    _evict_attachments()
+    assert sorted(os.listdir(attachment_dir)) == ['download.part', 'middle', 'new']
+
+
+def test_eviction_keeps_the_newest_file_even_if_too_big(attachment_dir, monkeypatch):
+    monkeypatch.setattr(lambda_handler, 'ATTACHMENT_CACHE_BYTES', 50)
+    write(attachment_dir, 'old', 10, 1000)
+    write(attachment_dir, 'new', 100, 2000)
+    _evict_attachments()
+    assert os.listdir(attachment_dir) == ['new']
+
+
+def test_same_content_is_stored_once(attachment_dir, respond):
+    content = b'report contents'
+    respond(b'{"data": "' + base64.urlsafe_b64encode(content) + b'"}')
+    first = fetch_attachment(FakeCredentials(), 'user', 'm1', {'part_id': '1', 'attachment_id': 'a'})
+    respond(b'{"data": "' + base64.urlsafe_b64encode(content) + b'"}')
+    second = fetch_attachment(FakeCredentials(), 'user', 'm2', {'part_id': '1', 'attachment_id': 'b'})
+    assert first == second == str(attachment_dir / hashlib.sha256(content).hexdigest())
+    assert os.listdir(attachment_dir) == [os.path.basename(first)]
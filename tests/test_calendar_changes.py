@@ -0,0 +1,55 @@
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from lambda_handler import EventRecord, build_calendar_filter, matches_calendar_filter, parse_shift, plan_new_times
+
+NEW_YORK = "America/New_York"
+TZ = ZoneInfo(NEW_YORK)
+CALENDAR = {"id": "primary", "timeZone": NEW_YORK}
+
+
+def all_day(start, days=1):
+    begin = datetime.combine(start, datetime.min.time(), TZ)
+    end = datetime.combine(start + timedelta(days=days), datetime.min.time(), TZ)
+    return EventRecord("a", "a", "", CALENDAR, "Offsite", int(begin.timestamp()), int(end.timestamp()), True, "", "")
+
+
+def timed(start, hours=1):
+    return EventRecord("t", "t", "", CALENDAR, "Review", int(start.timestamp()),
+                       int((start + timedelta(hours=hours)).timestamp()), False, "", "")
+
+
+@pytest.mark.parametrize("shift, day", [
+    ("-30 minutes", date(2026, 10, 20)),
+    ("-1 hour", date(2026, 10, 20)),
+    ("+5 hours", date(2026, 10, 20)),
+    ("-1 day", date(2026, 10, 19)),
+    ("1 day 2 hours", date(2026, 10, 21)),
+])
+def test_all_day_events_move_by_whole_days(shift, day):
+    start, end = plan_new_times(all_day(date(2026, 10, 20)), None, None, parse_shift(shift), TZ)
+    assert (start, end) == (day, day + timedelta(days=1))
+
+
+def test_all_day_span_over_dst_keeps_its_days():
+    start, end = plan_new_times(all_day(date(2026, 3, 7), days=3), None, None, parse_shift("1 day"), TZ)
+    assert (start, end) == (date(2026, 3, 8), date(2026, 3, 11))
+
+
+def test_timed_events_take_the_whole_shift():
+    start, end = plan_new_times(timed(datetime(2026, 10, 20, 14, 0, tzinfo=TZ)), None, None,
+                                parse_shift("-30 minutes"), TZ)
+    assert (start.hour, start.minute, end.hour, end.minute) == (13, 30, 14, 30)
+
+
+@pytest.mark.parametrize("kwargs, matches", [
+    ({"when": "tomorrow afternoon"}, False),
+    ({"specific_date": "2030-01-02", "specific_time": "13:00-17:00"}, False),
+    ({"when": "tomorrow"}, True),
+    ({"specific_date": "2030-01-02"}, True),
+])
+def test_all_day_events_only_match_day_windows(kwargs, matches):
+    filters = build_calendar_filter(time_zone=NEW_YORK, **kwargs)
+    assert matches_calendar_filter(all_day(date(2030, 1, 2)), filters, TZ) is matches
@@ -0,0 +1,31 @@
+from lambda_handler import resume_cursor, store_cursor
+
+UNREAD = {"show_only_unread": "true"}
+
+
+def stored(params):
+    """Session attributes after a truncated read_gmail call with these filters."""
+    session = {}
+    _, fingerprint = resume_cursor(session, "read_gmail", params, None)
+    store_cursor(session, "read_gmail", {"o": 20, "f": fingerprint})
+    return session
+
+
+def test_same_filters_resume():
+    cursor, _ = resume_cursor(stored(UNREAD), "read_gmail", dict(UNREAD), None)
+    assert cursor["o"] == 20
+
+
+def test_show_more_without_filters_continues_last_listing():
+    cursor, fingerprint = resume_cursor(stored(UNREAD), "read_gmail", {"show_more": "true"}, True)
+    assert cursor["o"] == 20 and fingerprint == cursor["f"]
+
+
+def test_different_filters_start_over():
+    cursor, _ = resume_cursor(stored(UNREAD), "read_gmail", {"sender_email": "a@b.c"}, None)
+    assert cursor is None
+
+
+def test_show_more_false_starts_over():
+    cursor, _ = resume_cursor(stored(UNREAD), "read_gmail", dict(UNREAD, show_more="false"), False)
+    assert cursor is None
@@ -0,0 +1,111 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import lambda_handler
+from lambda_handler import OutboxKind, OutboxWorker, SQLiteOutbox
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'error')
+
+
+class FakeGoogle:
+    """Stands in for execute_batch; answers each request from a per-operation script."""
+
+    def __init__(self):
+        self.batches = []
+        self.script = {}
+
+    def __call__(self, service, requests):
+        self.batches.append([operation.id for operation in requests])
+        return [self._answer(operation) for operation in requests]
+
+    def _answer(self, operation):
+        answers = self.script.get(operation.id)
+        status = answers.pop(0) if answers else 200
+        return ({'id': operation.id}, None) if status == 200 else (None, http_error(status))
+
+
+@pytest.fixture
+def google(monkeypatch):
+    fake = FakeGoogle()
+    monkeypatch.setattr(lambda_handler, 'execute_batch', fake)
+    monkeypatch.setattr(lambda_handler, 'build_service', lambda *args: None)
+    monkeypatch.setattr(lambda_handler, 'OUTBOX_RETRY_DELAY', 0)
+    for kind, idempotent in (('insert', True), ('send', False)):
+        monkeypatch.setitem(lambda_handler.OUTBOX_KINDS, kind, OutboxKind(
+            'api', 'v1', lambda: None, lambda service, operation: operation,
+            lambda operation, response: f"sent {response['id']}", idempotent))
+    return fake
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return SQLiteOutbox(str(tmp_path / 'outbox.sqlite3'))
+
+
+def drain_all(worker):
+    while worker.drain():
+        pass
+
+
+def state(queue, operation_id):
+    return queue.status([operation_id])[operation_id]
+
+
+def test_user_operations_are_never_batched_together(google, queue):
+    for operation_id, user in (('a1', 'alice'), ('a2', 'alice'), ('b1', 'bob'), ('a3', 'alice'), ('b2', 'bob')):
+        queue.put(operation_id, user, 'send', {})
+    drain_all(OutboxWorker(queue))
+    assert google.batches == [['a1', 'b1'], ['a2', 'b2'], ['a3']]
+    assert all(state(queue, i).state == 'done' for i in ('a1', 'a2', 'a3', 'b1', 'b2'))
+
+
+def test_retry_holds_back_later_operations_of_the_same_user(google, monkeypatch, queue):
+    monkeypatch.setattr(lambda_handler, 'OUTBOX_RETRY_DELAY', 3600)
+    google.script['a1'] = [503]
+    for operation_id, user in (('a1', 'alice'), ('a2', 'alice'), ('b1', 'bob')):
+        queue.put(operation_id, user, 'send', {})
+    drain_all(OutboxWorker(queue))
+    assert google.batches == [['a1', 'b1']]
+    assert (state(queue, 'a1').state, state(queue, 'a1').attempts) == ('pending', 1)
+    assert (state(queue, 'a2').state, state(queue, 'a2').attempts) == ('pending', 0)
+    assert state(queue, 'b1').state == 'done'
+
+
+def test_conflict_after_a_retry_counts_as_done(google, queue):
+    google.script['e1'] = [503, 409]
+    queue.put('e1', 'alice', 'insert', {})
+    drain_all(OutboxWorker(queue))
+    status = state(queue, 'e1')
+    assert (status.state, status.attempts, status.result) == ('done', 2, "Completed by an earlier attempt")
+
+
+def test_conflict_on_the_first_attempt_fails(google, queue):
+    google.script['e1'] = [409]
+    queue.put('e1', 'alice', 'insert', {})
+    drain_all(OutboxWorker(queue))
+    assert state(queue, 'e1').state == 'failed'
+
+
+def test_gives_up_after_max_attempts(google, monkeypatch, queue):
+    monkeypatch.setattr(lambda_handler, 'OUTBOX_MAX_ATTEMPTS', 3)
+    google.script['a1'] = [503] * 10
+    queue.put('a1', 'alice', 'send', {})
+    queue.put('a2', 'alice', 'send', {})
+    drain_all(OutboxWorker(queue))
+    assert google.batches == [['a1'], ['a1'], ['a1'], ['a2']]
+    assert (state(queue, 'a1').state, state(queue, 'a1').attempts) == ('failed', 3)
+    assert state(queue, 'a2').state == 'done'
+
+
+def test_recovery_resends_only_idempotent_operations(google, queue):
+    queue.put('e1', 'alice', 'insert', {})
+    queue.put('m1', 'alice', 'send', {})
+    queue.start(['e1', 'm1'])  # the process stopped while both were being written
+    worker = OutboxWorker(queue)
+    assert state(queue, 'e1').state == 'pending'
+    assert state(queue, 'm1').state == 'failed'
+    drain_all(worker)
+    assert state(queue, 'e1').state == 'done'
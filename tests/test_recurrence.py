@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from lambda_handler import UnsupportedRecurrence, expand_recurrence
+
+rrule = pytest.importorskip("dateutil.rrule")
+
+PHOENIX = ZoneInfo("America/Phoenix")
+NEW_YORK = ZoneInfo("America/New_York")
+
+
+def master(rule, start, end, tz_name, extra=()):
+    return {
+        "id": "series",
+        "summary": "Standup",
+        "start": {"dateTime": start.isoformat(), "timeZone": tz_name},
+        "end": {"dateTime": end.isoformat(), "timeZone": tz_name},
+        "recurrence": [f"RRULE:{rule}", *extra],
+    }
+
+
+def expanded_starts(event, window_start, window_end, tz):
+    starts = [datetime.fromisoformat(i["start"]["dateTime"]) for i in expand_recurrence(event, window_start, window_end, tz)]
+    return [s for s in starts if window_start <= s < window_end]
+
+
+def reference_starts(rule, dtstart, window_start, window_end):
+    starts = rrule.rrulestr(rule, dtstart=dtstart).between(window_start, window_end, inc=True)
+    return [s for s in starts if s < window_end]
+
+
+@pytest.mark.parametrize("rule", [
+    "FREQ=WEEKLY;INTERVAL=2;BYDAY=SA,SU;WKST=SU",
+    "FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE,FR;WKST=SU",
+    "FREQ=WEEKLY;INTERVAL=3;BYDAY=SU,TU;WKST=TH",
+    "FREQ=WEEKLY;INTERVAL=2;BYDAY=SA,SU",
+    "FREQ=WEEKLY;BYDAY=TU,TH;COUNT=10",
+    "FREQ=WEEKLY;INTERVAL=2;UNTIL=20270301T000000Z",
+    "FREQ=DAILY;INTERVAL=3",
+    "FREQ=DAILY;BYDAY=MO,TU,WE,TH,FR",
+    "FREQ=MONTHLY;BYDAY=-1FR",
+    "FREQ=MONTHLY;BYDAY=2TU,4TU;COUNT=12",
+    "FREQ=MONTHLY;BYMONTHDAY=31",
+    "FREQ=MONTHLY;INTERVAL=2;BYMONTHDAY=1,-1",
+    "FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=29",
+    "FREQ=YEARLY;BYMONTH=3,9;BYDAY=1MO",
+])
+@pytest.mark.parametrize("window_offset_days", [0, 200])
+def test_matches_dateutil(rule, window_offset_days):
+    # Thursday, so week-start handling matters for every weekly rule
+    dtstart = datetime(2026, 1, 8, 9, 30, tzinfo=NEW_YORK)
+    event = master(rule, dtstart, dtstart + timedelta(minutes=30), "America/New_York")
+    window_start = dtstart + timedelta(days=window_offset_days)
+    window_end = window_start + timedelta(days=120)
+
+    assert expanded_starts(event, window_start, window_end, PHOENIX) == \
+        reference_starts(rule, dtstart, window_start, window_end)
+
+
+def test_keeps_wall_clock_time_across_dst():
+    dtstart = datetime(2026, 3, 2, 9, 0, tzinfo=NEW_YORK)
+    event = master("FREQ=WEEKLY;COUNT=3", dtstart, dtstart + timedelta(hours=1), "America/New_York")
+    starts = expanded_starts(event, dtstart, dtstart + timedelta(days=30), PHOENIX)
+    assert [s.hour for s in starts] == [9, 9, 9]
+    assert starts[1].utcoffset() != starts[0].utcoffset()
+
+
+def test_exdate_and_rdate():
+    dtstart = datetime(2026, 1, 5, 10, 0, tzinfo=NEW_YORK)
+    event = master("FREQ=DAILY;COUNT=4", dtstart, dtstart + timedelta(hours=1), "America/New_York",
+                   ["EXDATE;TZID=America/New_York:20260106T100000", "RDATE;TZID=America/New_York:20260110T100000"])
+    starts = expanded_starts(event, dtstart, dtstart + timedelta(days=10), PHOENIX)
+    assert [s.day for s in starts] == [5, 7, 8, 10]
+
+
+def test_all_day_series():
+    event = {
+        "id": "series",
+        "start": {"date": "2026-01-01"},
+        "end": {"date": "2026-01-02"},
+        "recurrence": ["RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=SU;WKST=SU"],
+    }
+    window_start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    instances = expand_recurrence(event, window_start, window_start + timedelta(days=30), PHOENIX)
+    # The first Sunday, Dec 28, is in the week of DTSTART but before it
+    assert [i["start"]["date"] for i in instances] == ["2026-01-11", "2026-01-25"]
+
+
+@pytest.mark.parametrize("rule", [
+    "FREQ=HOURLY",
+    "FREQ=WEEKLY;BYSETPOS=1",
+    "FREQ=WEEKLY;BYDAY=1MO",
+    "FREQ=WEEKLY;WKST=XX",
+])
+def test_unsupported_rules_raise(rule):
+    dtstart = datetime(2026, 1, 8, 9, 30, tzinfo=NEW_YORK)
+    event = master(rule, dtstart, dtstart + timedelta(minutes=30), "America/New_York")
+    with pytest.raises(UnsupportedRecurrence):
+        expand_recurrence(event, dtstart, dtstart + timedelta(days=30), PHOENIX)
@@ -0,0 +1,65 @@
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from lambda_handler import build_event_body, parse_time_expression
+
+PHOENIX = "America/Phoenix"
+NOW = datetime(2026, 10, 19, 8, 0, tzinfo=ZoneInfo(PHOENIX))
+
+
+@pytest.mark.parametrize("expression, start, end", [
+    ("10 to 2", (10, 0), (14, 0)),
+    ("9-5", (9, 0), (17, 0)),
+    ("2-4pm", (14, 0), (16, 0)),
+    ("from 10:30 to 11", (10, 30), (11, 0)),
+    ("7pm-9", (19, 0), (21, 0)),
+    ("9am-5", (9, 0), (17, 0)),
+    ("11am-1", (11, 0), (13, 0)),
+    ("tonight 7 to 9", (19, 0), (21, 0)),
+    ("tonight at 8", (20, 0), (21, 0)),
+    ("this evening 8:30", (20, 30), (21, 30)),
+    ("at 3", (15, 0), (16, 0)),
+])
+def test_clock_ranges(expression, start, end):
+    span = parse_time_expression(expression, PHOENIX, NOW)
+    assert (span.start.hour, span.start.minute) == start
+    assert (span.end.hour, span.end.minute) == end
+    assert span.end.date() == span.start.date()
+
+
+def test_overnight_range_with_meridiem_ends_next_day():
+    span = parse_time_expression("10pm to 2", PHOENIX, NOW)
+    assert span.end.date() == date(2026, 10, 20) and span.end.hour == 2
+
+
+@pytest.mark.parametrize("expression", ["10pm-1", "tonight 10 to 1"])
+def test_evening_range_runs_past_midnight(expression):
+    span = parse_time_expression(expression, PHOENIX, NOW)
+    assert (span.start.hour, span.end.date(), span.end.hour) == (22, date(2026, 10, 20), 1)
+
+
+@pytest.mark.parametrize("expression, day", [
+    ("2 days from now", date(2026, 10, 21)),
+    ("a week from now", date(2026, 10, 26)),
+    ("now", date(2026, 10, 19)),
+])
+def test_days_from_now(expression, day):
+    span = parse_time_expression(expression, PHOENIX, NOW)
+    assert (span.start.date(), span.end.date()) == (day, day + timedelta(days=1))
+
+
+def test_bare_clock_uses_default_day():
+    span = parse_time_expression("5pm", PHOENIX, NOW, default_day=date(2026, 10, 22))
+    assert span.start == datetime(2026, 10, 22, 17, 0, tzinfo=ZoneInfo(PHOENIX))
+
+
+def test_event_end_is_resolved_on_the_start_day():
+    event = build_event_body("Review", "2026-11-02T15:00:00", "5pm", add_meet_link=False, time_zone=PHOENIX)
+    assert event["end"]["dateTime"] == "2026-11-02T17:00:00-07:00"
+
+
+def test_event_end_before_start_is_rejected():
+    with pytest.raises(ValueError):
+        build_event_body("Review", "2026-11-02T15:00:00", "2pm", add_meet_link=False, time_zone=PHOENIX)